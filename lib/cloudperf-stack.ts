@@ -8,6 +8,8 @@ import * as iam from 'aws-cdk-lib/aws-iam';
 import * as rds from 'aws-cdk-lib/aws-rds';
 import * as elasticache from 'aws-cdk-lib/aws-elasticache';
 import * as lambda from 'aws-cdk-lib/aws-lambda';
+import * as events from 'aws-cdk-lib/aws-events';
+import * as eventstargets from 'aws-cdk-lib/aws-events-targets';
 import * as cr from 'aws-cdk-lib/custom-resources';
 import * as elbv2 from 'aws-cdk-lib/aws-elasticloadbalancingv2';
 import * as targets from 'aws-cdk-lib/aws-elasticloadbalancingv2-targets';
@@ -229,6 +231,8 @@ export class CloudperfStack extends cdk.Stack {
     lambdaRoleAdmin.addManagedPolicy(iam.ManagedPolicy.fromAwsManagedPolicyName("service-role/AWSLambdaVPCAccessExecutionRole"));
     lambdaRoleAdmin.addManagedPolicy(iam.ManagedPolicy.fromAwsManagedPolicyName("AmazonS3FullAccess"));
     lambdaRoleAdmin.attachInlinePolicy(secretsManagerPolicy);
+    // 导入大文件时在超时前重新调用自己，从断点继续
+    adminLambda.grantInvoke(lambdaRoleAdmin);
 
     lambdaRoleWeb.addManagedPolicy(iam.ManagedPolicy.fromAwsManagedPolicyName("service-role/AWSLambdaBasicExecutionRole"));
 
@@ -237,6 +241,28 @@ export class CloudperfStack extends cdk.Stack {
     s3Bucket.addEventNotification(s3.EventType.OBJECT_CREATED, s3nadmin, { prefix: 'import-sql/', suffix: '.sql' });
     s3Bucket.addEventNotification(s3.EventType.OBJECT_CREATED, s3nadmin, { prefix: 'import-sql/', suffix: '.zip' });
 
+    // 每分钟补充 ping 任务，/job 请求只取任务
+    new events.Rule(this, stackPrefix + 'produce-ping-jobs', {
+      schedule: events.Schedule.rate(cdk.Duration.minutes(1)),
+      targets: [new eventstargets.LambdaFunction(adminLambda, {
+        event: events.RuleTargetInput.fromObject({ action: 'produce_ping_jobs' }),
+      })],
+    });
+    // 每天删除长时间没有探测到的可ping ip
+    new events.Rule(this, stackPrefix + 'sweep-pingable', {
+      schedule: events.Schedule.rate(cdk.Duration.days(1)),
+      targets: [new eventstargets.LambdaFunction(adminLambda, {
+        event: events.RuleTargetInput.fromObject({ action: 'sweep_pingable' }),
+      })],
+    });
+    // 每30分钟从数据库重新统计状态页面的计数
+    new events.Rule(this, stackPrefix + 'reconcile-status-counters', {
+      schedule: events.Schedule.rate(cdk.Duration.minutes(30)),
+      targets: [new eventstargets.LambdaFunction(adminLambda, {
+        event: events.RuleTargetInput.fromObject({ action: 'reconcile_status_counters' }),
+      })],
+    });
+
     // alb 配置
     const listener = alb.addListener(stackPrefix + 'api-listener', {
       port: 80,
@@ -22,7 +22,7 @@ aws lambda invoke --function-name ${ADMIN_LAMBDA} --payload "{\"action\":\"${act
 if [ "${action}" == "mysql_dump" ]; then
     S3_BUCKET=$(aws cloudformation describe-stacks --stack-name CloudperfStack --query 'Stacks[0].Outputs[?OutputKey==`s3Bucket`].OutputValue' --output text --region ${DEPLOY_REGION})
     echo 'check file in s3://'${S3_BUCKET}'/export-sql/'
-    aws s3 ls s3://${S3_BUCKET}/export-sql/
+    aws s3 ls --recursive s3://${S3_BUCKET}/export-sql/
 fi
 
 # action: create_user
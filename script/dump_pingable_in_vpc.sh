@@ -8,4 +8,7 @@ SECRET_JSON=$(aws secretsmanager get-secret-value --secret-id ${DB_SECRET} --que
 DB_USER=$(echo ${SECRET_JSON} | jq -r '.username')
 DB_PASS=$(echo ${SECRET_JSON} | jq -r '.password')
 
-mysqldump -h rds.cloudperf.vpc -u admin -p${DB_PASS} cloudperf pingable --where="lastresult>=15" | zip stable_pingable.zip -
+# 稳定可ping ip：上一个或当前发现周期探测到，且最近4个周期都探测到，与 reconcile_status_counters 的 ping-stable 一致
+# 发现周期为天数除以 PINGABLE_EPOCH_DAYS（默认14）
+LIVE_EPOCH=$(( $(date +%s) / 86400 / 14 - 1 ))
+mysqldump -h rds.cloudperf.vpc -u admin -p${DB_PASS} cloudperf pingable --where="last_epoch>=${LIVE_EPOCH} and seen>=15" | zip stable_pingable.zip -
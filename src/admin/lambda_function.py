@@ -5,17 +5,39 @@ import sys
 import zipfile
 import subprocess
 import tempfile
+import resource
 import boto3
-from boto3.s3.transfer import TransferConfig
+import pymysql
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from urllib.parse import urlparse
 import data_layer
+import fping_parser
+from s3_stream import S3MultipartWriter, S3ObjectReader
+import sql_stream
 from datetime import datetime
 import settings
 import secrets
 import string
+import random
+import time
+import ipaddress
 
-def mysql_dump_table_to_zipfile(table_name, zip_entry, batch_size=1000):
-    conn = data_layer.get_mysql_connect()
+def mysql_dump_value(value):
+    if value is None:
+        return "NULL"
+    elif isinstance(value, (int, float)):
+        return str(value)
+    elif isinstance(value, bytes):
+        return "X'{}'".format(value.hex())
+    elif isinstance(value, datetime):
+        return "'{}'".format(value.strftime('%Y-%m-%d %H:%M:%S'))
+    # 转义字符串中的特殊字符
+    escaped_value = str(value).replace("'", "''").replace("\\", "\\\\")
+    return "'{}'".format(escaped_value)
+
+# 使用服务端游标（SSCursor）逐批读取，边读边写入 zip_entry，不把整个表读到内存中，返回数据行数
+# conn 需要已经开启一致性快照，游标读取期间同一个连接不能执行其他查询，所以先查询表结构和列名
+def mysql_dump_table_to_zipfile(table_name, zip_entry, conn, batch_size=1000):
     zip_entry.write(f'''
 -- MySQL dump by Python
 -- 创建时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
@@ -27,191 +49,773 @@ SET FOREIGN_KEY_CHECKS = 0;
 
 '''.encode('utf-8'))
 
-    cursor = conn.cursor()
-    cursor.execute(f"SHOW CREATE TABLE `{table_name}`".encode('utf-8'))
-    create_table = cursor.fetchone()[1]
+    with conn.cursor() as cursor:
+        cursor.execute(f"SHOW CREATE TABLE `{table_name}`".encode('utf-8'))
+        create_table = cursor.fetchone()[1]
+        # 获取列名
+        cursor.execute(f"SHOW COLUMNS FROM `{table_name}`")
+        columns = [column[0] for column in cursor.fetchall()]
     zip_entry.write(f"\n--\n-- 表结构 `{table_name}`\n--\n\n".encode('utf-8'))
     zip_entry.write(f"DROP TABLE IF EXISTS `{table_name}`;\n".encode('utf-8'))
     zip_entry.write((create_table + ";\n\n").encode('utf-8'))
-
-    cursor.execute(f"SELECT * FROM `{table_name}`")
-    rows = cursor.fetchall()
-    if not rows:
-        return
-    zip_entry.write(f"\n--\n-- 表数据 `{table_name}`\n--\n\n".encode('utf-8'))
-    zip_entry.write("LOCK TABLES `{}` WRITE;\n".format(table_name).encode('utf-8'))
-    zip_entry.write("/*!40000 ALTER TABLE `{}` DISABLE KEYS */;\n".format(table_name).encode('utf-8'))
-
-    # 获取列名
-    cursor.execute(f"SHOW COLUMNS FROM `{table_name}`")
-    columns = [column[0] for column in cursor.fetchall()]
     column_names = "`, `".join(columns)
-    
-    # 分批处理数据，避免生成过大的 INSERT 语句
-    total_rows = len(rows)
-    for i in range(0, total_rows, batch_size):
-        batch = rows[i:i + batch_size]
-        values_list = []
-        
-        for row in batch:
-            values = []
-            for value in row:
-                if value is None:
-                    values.append("NULL")
-                elif isinstance(value, (int, float)):
-                    values.append(str(value))
-                elif isinstance(value, bytes):
-                    values.append("_binary '{}'".format(value.hex()))
-                elif isinstance(value, datetime):
-                    values.append("'{}'".format(value.strftime('%Y-%m-%d %H:%M:%S')))
-                else:
-                    # 转义字符串中的特殊字符
-                    escaped_value = str(value).replace("'", "''").replace("\\", "\\\\")
-                    values.append("'{}'".format(escaped_value))
-            values_list.append("(" + ", ".join(values) + ")")
-        
-        if values_list:
+
+    total_rows = 0
+    with conn.cursor(pymysql.cursors.SSCursor) as cursor:
+        cursor.execute(f"SELECT * FROM `{table_name}`")
+        # 分批处理数据，避免生成过大的 INSERT 语句
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return 0
+        zip_entry.write(f"\n--\n-- 表数据 `{table_name}`\n--\n\n".encode('utf-8'))
+        zip_entry.write("LOCK TABLES `{}` WRITE;\n".format(table_name).encode('utf-8'))
+        zip_entry.write("/*!40000 ALTER TABLE `{}` DISABLE KEYS */;\n".format(table_name).encode('utf-8'))
+        while rows:
+            values_list = ["(" + ", ".join(mysql_dump_value(value) for value in row) + ")" for row in rows]
             zip_entry.write(f"INSERT INTO `{table_name}` (`{column_names}`) VALUES\n".encode('utf-8'))
             zip_entry.write((",\n".join(values_list) + ";\n").encode('utf-8'))
-    
+            total_rows += len(rows)
+            rows = cursor.fetchmany(batch_size)
+
     zip_entry.write("/*!40000 ALTER TABLE `{}` ENABLE KEYS */;\n".format(table_name).encode('utf-8'))
     zip_entry.write("UNLOCK TABLES;\n".encode('utf-8'))
+    return total_rows
+
+# 导出一个表到 s3://{s3_bucket}/{s3_prefix}/{table}.zip，zip 直接写入 S3 分片上传，内存占用与表大小无关
+def mysql_dump_table_to_s3(s3, s3_bucket, s3_prefix, table, conn):
+    start = time.perf_counter()
+    s3_key = f'{s3_prefix}/{table}.zip'
+    try:
+        with S3MultipartWriter(s3, s3_bucket, s3_key, settings.MYSQL_DUMP_PART_SIZE) as writer:
+            with zipfile.ZipFile(writer, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+                # 写入前不知道大小，强制使用 zip64，支持超过 2GB 的表
+                with zip_file.open(table + '.sql', 'w', force_zip64=True) as zip_entry:
+                    rows = mysql_dump_table_to_zipfile(table, zip_entry, conn)
+        return {'table': table, 'key': s3_key, 'rows': rows, 'bytes': writer.size, 'seconds': round(time.perf_counter() - start, 2)}
+    except Exception as e:
+        return {'table': table, 'key': s3_key, 'error': str(e), 'seconds': round(time.perf_counter() - start, 2)}
+    finally:
+        conn.close()
+
+# 多个表使用各自的连接并行导出，每个表一个 zip 文件
+# 导出前在写实例的另一个连接上短暂 LOCK TABLES ... READ，各连接开启一致性快照后解锁，所有表的数据是同一时刻的
+# 没有 LOCK TABLES 权限时每个连接单独开启快照，单个表的数据仍然一致
+def mysql_dump_table(s3_bucket, s3_prefix, dump_tables = []):
+    # 锁和快照都在写实例上：只读节点上的 LOCK TABLES 不会阻塞写入，多个只读连接也可能落在不同的副本上
+    conns = []
+    lock_conn = data_layer.get_mysql_connect(need_write=True)
+    consistent = True
+    try:
+        conns = [data_layer.get_mysql_connect(need_write=True) for table in dump_tables]
+        try:
+            with lock_conn.cursor() as cursor:
+                cursor.execute('LOCK TABLES ' + ', '.join(f'`{table}` READ' for table in dump_tables))
+        except Exception as e:
+            print('lock tables failed, dump tables with separate snapshots.', repr(e))
+            consistent = False
+        for conn in conns:
+            with conn.cursor() as cursor:
+                cursor.execute('SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+                cursor.execute('START TRANSACTION WITH CONSISTENT SNAPSHOT')
+    except Exception:
+        for conn in conns:
+            conn.close()
+        raise
+    finally:
+        if consistent:
+            with lock_conn.cursor() as cursor:
+                cursor.execute('UNLOCK TABLES')
+        lock_conn.close()
 
-def mysql_dump_table(s3_bucket, s3_key, dump_tables = []):
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
-        for table in dump_tables:
-            with zip_file.open(table + '.sql', 'w') as zip_entry:
-                mysql_dump_table_to_zipfile(table, zip_entry)
-    # 将缓冲区内容上传到 S3
-    zip_buffer.seek(0)
     s3 = boto3.client('s3')
-    config = TransferConfig(
-        multipart_threshold=1024 * 25,  # 25MB
-        max_concurrency=10,
-        multipart_chunksize=1024 * 25,  # 25MB
-        use_threads=True
-    )
-    s3.upload_fileobj(zip_buffer, s3_bucket, s3_key, Config=config)
+    with ThreadPoolExecutor(max_workers=max(min(settings.MYSQL_DUMP_WORKERS, len(dump_tables)), 1)) as executor:
+        tables = list(executor.map(lambda args: mysql_dump_table_to_s3(s3, s3_bucket, s3_prefix, *args), zip(dump_tables, conns)))
+    failed = [table['table'] for table in tables if 'error' in table]
     return {
-        'statusCode': 200,
-        'body': f'successfully exported to s3://{s3_bucket}/{s3_key}'
+        'statusCode': 500 if failed else 200,
+        'body': f'failed to export {",".join(failed)}' if failed else f'successfully exported to s3://{s3_bucket}/{s3_prefix}/',
+        'consistent': consistent,
+        # 进程的内存峰值（MB），Linux 下 ru_maxrss 单位为 KB
+        'max_memory_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'tables': tables
     }
 
 def mysql_dump(tables):
     timestr = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-    return mysql_dump_table(settings.S3_BUCKET, f"export-sql/{timestr}.zip", tables.split(','))
-
-def download_from_s3(s3_path):
-    """
-    Download file from S3
-    Args:
-        s3_path: S3 URL (s3://bucket-name/path/to/file)
-    Returns:
-        str: Path to downloaded file
-    """
-    parsed = urlparse(s3_path)
-    bucket = parsed.netloc
-    key = parsed.path.lstrip('/')
-    
-    # Create temp directory if it doesn't exist
-    temp_dir = '/tmp/s3_files'
-    os.makedirs(temp_dir, exist_ok=True)
-    
-    # Download file
-    local_path = os.path.join(temp_dir, os.path.basename(key))
-    s3_client = boto3.client('s3')
-    print(f'download file form s3://{bucket}/{key} to {local_path}')
-    s3_client.download_file(bucket, key, local_path)
-    
-    return local_path
+    return mysql_dump_table(settings.S3_BUCKET, f"export-sql/{timestr}", tables.split(','))
 
 def get_city_id(ip:str):
     cityid = data_layer.get_cityid_by_ip(ip)
     return cityid
 
+def refresh_iprange_index():
+    version = data_layer.refresh_iprange_index()
+    return {
+        "status": 200,
+        "msg": f"iprange index version {version}"
+    }
+
+# 删除 redis 中所有城市的可ping ip集合，下次分配任务时从数据库重建
+def reset_pingable_pool():
+    count = data_layer.pingable_pool.reset()
+    return {
+        "status": 200,
+        "msg": f"{count} pingable pool keys deleted"
+    }
+
+# 补充 ping 任务到高水位，由 EventBridge 定时执行，param 为高水位（可选）
+def produce_ping_jobs(high_water = None):
+    if high_water:
+        return data_layer.produce_ping_jobs(int(high_water))
+    return data_layer.produce_ping_jobs()
+
+# 对比 iprange 内存索引和数据库范围查询的耗时
+def benchmark_iprange_index(count = 1000):
+    count = int(count)
+    start = time.perf_counter()
+    if not data_layer.iprange_index.refresh():
+        return {"status": 500, "msg": "iprange index not available"}
+    build_time = time.perf_counter() - start
+    index = data_layer.iprange_index
+    if len(index.starts) == 0:
+        return {"status": 404, "msg": "iprange index is empty, import iprange data first"}
+    if count <= 0:
+        return {"status": 400, "msg": "count must be positive"}
+    ips = []
+    for i in range(count):
+        n = random.randrange(len(index.starts))
+        ips.append(str(ipaddress.IPv4Address(random.randint(index.starts[n], index.ends[n]))))
+
+    start = time.perf_counter()
+    for ip in ips:
+        data_layer.get_cityid_by_ip(ip)
+    index_time = time.perf_counter() - start
+
+    # 数据库查询较慢，最多取100个
+    sql_ips = ips[:100]
+    mismatch = 0
+    start = time.perf_counter()
+    for ip in sql_ips:
+        ipno = ipaddress.IPv4Address(ip)._ip
+        rows = data_layer.mysql_select('select city_id from iprange where start_ip<=%s and end_ip>=%s limit 1', (ipno, ipno), False)
+        if rows and rows[0][0] != data_layer.get_cityid_by_ip(ip):
+            mismatch += 1
+    sql_time = time.perf_counter() - start
+    return {
+        "status": 200,
+        "msg": {
+            "index": index.get_metrics(),
+            "refresh_ms": round(build_time * 1000, 2),
+            "index_lookup_us": round(index_time * 1000000 / len(ips), 2),
+            "sql_lookup_us": round(sql_time * 1000000 / len(sql_ips), 2),
+            "mismatch": mismatch
+        }
+    }
+
+# 对比逐条写入和批量写入可ping ip的速度，使用 pingable_bench 表，不影响正式数据
+def benchmark_pingable_upsert(count = 2000):
+    count = int(count)
+    table = 'pingable_bench'
+    data_layer.mysql_execute(f'CREATE TABLE IF NOT EXISTS `{table}` LIKE `pingable`')
+    rows = [(0, str(ipaddress.IPv4Address(0x0a000000 + i))) for i in range(count)]
+    # 还没有执行 migrate_pingable_epoch 时按旧的 lastresult 表结构写入
+    if data_layer.pingable_epoch_enabled(table):
+        sql = data_layer.PINGABLE_UPSERT_SQL.format(table)
+        extra = (data_layer.pingable_epoch(),)
+    else:
+        sql = data_layer.PINGABLE_LEGACY_UPSERT_SQL.format(table)
+        extra = ()
+    result = {}
+    try:
+        # 原逻辑：每个ip新建连接，单独执行并提交，逐条写入较慢，最多取200条
+        sample = rows[:200]
+        start = time.perf_counter()
+        for city_id, ip in sample:
+            conn = data_layer.get_mysql_connect(True)
+            with conn.cursor() as cursor:
+                cursor.execute(sql, (ipaddress.IPv4Address(ip)._ip, city_id) + extra)
+            conn.commit()
+            conn.close()
+        result['row_new_conn'] = round(len(sample) / (time.perf_counter() - start), 1)
+
+        # 逐条写入，但使用连接池
+        start = time.perf_counter()
+        for city_id, ip in sample:
+            data_layer.mysql_execute(sql, (ipaddress.IPv4Address(ip)._ip, city_id) + extra)
+        result['row_pooled'] = round(len(sample) / (time.perf_counter() - start), 1)
+
+        # 批量写入
+        start = time.perf_counter()
+        data_layer.update_pingable_ips(rows, table=table)
+        result['batch'] = round(len(rows) / (time.perf_counter() - start), 1)
+    finally:
+        data_layer.mysql_execute(f'DROP TABLE IF EXISTS `{table}`')
+    return {
+        "status": 200,
+        "msg": {
+            "rows": count,
+            "batch_size": settings.PINGABLE_BATCH_SIZE,
+            "rows_per_sec": result
+        }
+    }
+
+# 把 statistics 表转换为槽位保留方式：每个cityid对只保留最新的 MAX_RECORDS_PER_CITYID 条并编号槽位
+# 通过新建表复制后原子改名完成，复制期间写入的少量数据会丢失
+def migrate_statistics_slot():
+    limit = settings.MAX_RECORDS_PER_CITYID
+    if data_layer.mysql_select("SHOW COLUMNS FROM `statistics` LIKE 'slot'"):
+        return {"status": 200, "msg": "statistics already has slot column"}
+    data_layer.mysql_execute('DROP TABLE IF EXISTS `statistics_slot`')
+    data_layer.mysql_execute('CREATE TABLE `statistics_slot` LIKE `statistics`')
+    data_layer.mysql_execute('''ALTER TABLE `statistics_slot`
+ADD COLUMN `slot` TINYINT UNSIGNED NOT NULL DEFAULT 0 COMMENT '槽位，每个cityid对循环使用' AFTER `dist_city_id`,
+DROP INDEX `idx_src_dist_city`,
+ADD UNIQUE KEY `idx_src_dist_slot` (`src_city_id`, `dist_city_id`, `slot`)''')
+    # 复制原表的所有列，已经执行过 migrate_statistics_columns 的表中的 sketch 和 lost 也会保留
+    columns = ','.join(f"`{row['Field']}`" for row in data_layer.mysql_select('SHOW COLUMNS FROM `statistics`'))
+    data_layer.mysql_execute(f'''INSERT INTO `statistics_slot`({columns},slot)
+SELECT {columns},rn-1
+FROM (
+    SELECT *, ROW_NUMBER() OVER (PARTITION BY src_city_id, dist_city_id ORDER BY update_time DESC) AS rn FROM `statistics`
+) t WHERE rn <= %s''', (limit,))
+    data_layer.mysql_execute('RENAME TABLE `statistics` TO `statistics_old`, `statistics_slot` TO `statistics`')
+    data_layer.mysql_execute('DROP TABLE `statistics_old`')
+    data_layer.clear_table_columns()
+    rows = data_layer.mysql_select_onevalue('select count(1) from statistics')
+    return {
+        "status": 200,
+        "msg": f"statistics migrated to slot retention, {rows} rows kept"
+    }
+
+# 新版本给 statistics 和 statistics_rollup 表增加的列：(表, 列, 定义, 在哪一列之后)
+STATISTICS_NEW_COLUMNS = [
+    ('statistics', 'sketch', "BLOB NULL COMMENT '延迟分布，可合并计算分位数'", 'latency_p95'),
+    ('statistics_rollup', 'sketch', "BLOB NULL COMMENT '合并后的延迟分布'", 'ewma_p95'),
+    ('statistics', 'lost', "INT UNSIGNED NOT NULL DEFAULT 0 COMMENT '丢包数'", 'samples'),
+    ('statistics_rollup', 'lost', "INT UNSIGNED NOT NULL DEFAULT 0 COMMENT '丢包数'", 'samples'),
+]
+
+# 为已有的 statistics 和 statistics_rollup 表增加缺少的列
+# 旧数据没有延迟分布，查询时回退到按样本数加权平均；旧数据的丢包数为0
+def migrate_statistics_columns():
+    added = []
+    for table, column, definition, after in STATISTICS_NEW_COLUMNS:
+        # statistics_rollup 还没有创建时跳过，重新导入 init.sql 时会按完整的定义创建
+        if not data_layer.mysql_select(f"SHOW TABLES LIKE '{table}'"):
+            continue
+        if not data_layer.mysql_select(f"SHOW COLUMNS FROM `{table}` LIKE '{column}'"):
+            data_layer.mysql_execute(f"ALTER TABLE `{table}` ADD COLUMN `{column}` {definition} AFTER `{after}`")
+            added.append(f'{table}.{column}')
+    data_layer.clear_table_columns()
+    return {
+        "status": 200,
+        "msg": f"statistics columns added: {','.join(added)}" if added else "statistics columns already up to date"
+    }
+
+# 把 pingable 表的 lastresult 位图转换为 last_epoch 和 seen：lastresult 的最高位是该ip段最近一次检查的结果，
+# 按当前存活周期计算，最高的1所在位决定 last_epoch，seen 左移相同位数，转换后删除 lastresult 列
+def migrate_pingable_epoch():
+    if data_layer.mysql_select("SHOW COLUMNS FROM `pingable` LIKE 'last_epoch'"):
+        return {"status": 200, "msg": "pingable already has last_epoch column"}
+    live, keep = data_layer.pingable_epoch_bounds()
+    data_layer.mysql_execute('''ALTER TABLE `pingable`
+ADD COLUMN `last_epoch` SMALLINT UNSIGNED NOT NULL DEFAULT 0 COMMENT '最近一次探测到的发现周期' AFTER `city_id`,
+ADD COLUMN `seen` TINYINT UNSIGNED NOT NULL DEFAULT 0 COMMENT '最近4个周期是否探测到的位图，最高位为last_epoch' AFTER `last_epoch`''')
+    data_layer.mysql_execute('''UPDATE `pingable` SET
+last_epoch = %s - CASE WHEN lastresult >= 8 THEN 0 WHEN lastresult >= 4 THEN 1 WHEN lastresult >= 2 THEN 2 ELSE 3 END,
+seen = (lastresult << (%s - last_epoch)) & 15''', (live, live))
+    data_layer.mysql_execute('''ALTER TABLE `pingable` DROP INDEX `lastresult`, DROP COLUMN `lastresult`,
+ALTER COLUMN `last_epoch` DROP DEFAULT, ALTER COLUMN `seen` DROP DEFAULT, ADD KEY `last_epoch` (`last_epoch`)''')
+    data_layer.clear_table_columns()
+    rows = data_layer.reconcile_status_counters()['ping-new']
+    return {
+        "status": 200,
+        "msg": f"pingable migrated to epoch {live + 1}, {rows} live ips"
+    }
+
+# 删除连续4个周期没有探测到的ip，由 EventBridge 每天执行
+def sweep_pingable():
+    return data_layer.sweep_pingable()
+
+# 从数据库重新统计状态页面的计数，由 EventBridge 每30分钟执行，修正增量维护的误差和ip段过期带来的变化
+def reconcile_status_counters():
+    start = time.perf_counter()
+    counters = data_layer.reconcile_status_counters()
+    return {
+        "status": 200,
+        "msg": {**counters, 'seconds': round(time.perf_counter() - start, 2)}
+    }
+
+# 模拟 SQS 客户端：每次调用固定延迟，按比例随机返回可重试的失败条目
+class StubSqsClient:
+    def __init__(self, latency:float = 0.02, failure:float = 0.05):
+        self.latency = latency
+        self.failure = failure
+        self.calls = 0
+        self.received = set()
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.calls += 1
+        time.sleep(self.latency)
+        response = {'Successful': [], 'Failed': []}
+        for entry in Entries:
+            if random.random() < self.failure:
+                response['Failed'].append({'Id': entry['Id'], 'SenderFault': False, 'Code': 'InternalError', 'Message': 'stub failure'})
+            else:
+                self.received.add(entry['Id'])
+                response['Successful'].append({'Id': entry['Id'], 'MessageId': entry['Id']})
+        return response
+
+# 使用模拟的 SQS 客户端，对比原来逐批顺序发送（失败不重试）和 SqsBatchSender 并发发送的速度和丢失的消息数
+def benchmark_sqs_sender(count = 2000):
+    count = int(count)
+    messages = [{"type": "pingable", "start_ip": i * 16384, "end_ip": i * 16384 + 16383, "city_id": i} for i in range(count)]
+    result = {}
+
+    client = StubSqsClient()
+    start = time.perf_counter()
+    for i in range(0, count, 10):
+        client.send_message_batch(QueueUrl='stub', Entries=[{'Id': str(n), 'MessageBody': json.dumps(messages[n])} for n in range(i, min(i + 10, count))])
+    result['sequential'] = {
+        'ms': round((time.perf_counter() - start) * 1000, 1),
+        'calls': client.calls,
+        'lost': count - len(client.received)
+    }
+
+    client = StubSqsClient()
+    sender = data_layer.SqsBatchSender(client, settings.SQS_SEND_WORKERS, settings.SQS_SEND_RETRIES, base_delay=0.01)
+    start = time.perf_counter()
+    ret = sender.send('stub', messages)
+    result['concurrent'] = {
+        'ms': round((time.perf_counter() - start) * 1000, 1),
+        'calls': client.calls,
+        'retries': ret['retries'],
+        'lost': count - len(client.received)
+    }
+    return {
+        "status": 200,
+        "msg": {
+            "messages": count,
+            "workers": settings.SQS_SEND_WORKERS,
+            "result": result
+        }
+    }
+
+# 模拟 fping -C 的输出：每个目标一行，ip 补齐空格，按 loss 比例出现 - 丢包标记，部分目标有 duplicate 行
+def make_fping_count_output(targets:int, count:int = 11, loss:float = 0.02):
+    lines = ['[DEBUG] CPU time used: 0.083289 sec']
+    for i in range(targets):
+        ip = str(ipaddress.IPv4Address(0x02110000 + i))
+        base = random.uniform(1, 300)
+        values = ['-' if random.random() < loss else f'{base * random.uniform(0.95, 1.2):.{random.choice((0, 1, 2))}f}' for n in range(count)]
+        lines.append(f"{ip:<15} : {' '.join(values)}")
+        if i % 20 == 0:
+            lines.append(f'{ip} : duplicate for [0], 64 bytes, {base:.1f} ms')
+    return '\n'.join(lines)
+
+# 对比原来逐个 token 尝试 float() 的解析方式和 fping_parser 的耗时，并检查结果是否一致
+def benchmark_fping_parser(targets = 500):
+    targets = int(targets)
+    repeat = 20
+    output = make_fping_count_output(targets)
+    alive = '\n'.join(str(ipaddress.IPv4Address(0x02110000 + i)) for i in range(targets)) + '\nEnough hosts reachable (required: 100, reachable: 100)\n'
+
+    def legacy_count(output):
+        samples = []
+        for stderr in output.split('\n'):
+            if stderr.find('duplicate') != -1:
+                continue
+            for data in stderr.split(' '):
+                try:
+                    samples.append(float(data))
+                except ValueError:
+                    pass
+        return samples
+
+    def legacy_alive(output):
+        ips = []
+        for out in output.split('\n'):
+            if out == '' or out.startswith('[DEBUG]'):
+                continue
+            try:
+                ipaddress.ip_address(out)
+                ips.append(out)
+            except ValueError:
+                pass
+        return ips
+
+    result = {}
+    # 保留每种方式最后一次的解析结果，用于比较新旧方式的结果是否一致
+    parsed = {}
+    for name, func in (('count_legacy', legacy_count),
+            ('count_parser', fping_parser.parse_count_output),
+            ('alive_legacy', legacy_alive), ('alive_parser', fping_parser.parse_alive_output)):
+        data = alive if name.startswith('alive') else output
+        start = time.perf_counter()
+        for i in range(repeat):
+            parsed[name] = func(data)
+        result[name + '_ms'] = round((time.perf_counter() - start) * 1000 / repeat, 3)
+    legacy = parsed['count_legacy']
+    rtts, targets = parsed['count_parser']
+    result['targets'] = len(targets)
+    result['samples'] = len(rtts)
+    result['lost'] = sum(target[3] for target in targets)
+    # 原方式不区分丢包，且把 "[DEBUG] ... 0.083289 sec" 中的数字也当作延迟
+    result['legacy_samples'] = len(legacy)
+    result['mismatch'] = sum(1 for a, b in zip(sorted(legacy[1:]), sorted(rtts)) if abs(a - b) > 0.01)
+    result['alive_match'] = parsed['alive_legacy'] == parsed['alive_parser']
+    result['output_bytes'] = len(output)
+    return {
+        "status": 200,
+        "msg": result
+    }
+
+# 对比多个cityid对汇总时，按样本数加权平均各自的分位数（原方式）和合并延迟分布后计算分位数的准确度和耗时
+# 使用模拟的 fping -C 11 数据，每个cityid对的延迟为不同中位数的对数正态分布，以全部原始样本排序后的分位数为准
+def benchmark_latency_sketch(pairs = 1000):
+    pairs = int(pairs)
+    rows = []
+    for i in range(pairs):
+        median = random.uniform(1, 300)
+        rows.append([median * random.lognormvariate(0, 0.3) for n in range(11)])
+
+    start = time.perf_counter()
+    weighted = {p: 0 for p in (50, 70, 90, 95)}
+    for samples in rows:
+        sorted_data = sorted(samples)
+        for p in weighted:
+            weighted[p] += data_layer.np_percentile(sorted_data, p) * len(samples)
+    total = sum(len(samples) for samples in rows)
+    weighted = {p: v / total for p, v in weighted.items()}
+    percentile_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    blobs = [data_layer.make_latency_sketch(samples).encode() for samples in rows]
+    sketch_build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    merged = data_layer.merge_latency_sketches(data_layer.LatencySketch.decode(blob) for blob in blobs)
+    summary = data_layer.latency_sketch_summary(merged)
+    sketch_merge_time = time.perf_counter() - start
+
+    exact = sorted(sample for samples in rows for sample in samples)
+    result = {}
+    for p in (50, 70, 90, 95):
+        truth = data_layer.np_percentile(exact, p)
+        result[f'p{p}'] = {
+            'exact_ms': round(truth, 3),
+            'weighted_error': f'{abs(weighted[p] - truth) / truth:.2%}',
+            'sketch_error': f'{abs(summary[f"p{p}"] / 1000 - truth) / truth:.2%}',
+        }
+    return {
+        "status": 200,
+        "msg": {
+            "pairs": pairs,
+            "samples": total,
+            "percentile": result,
+            "sketch_bytes_avg": round(sum(len(blob) for blob in blobs) / pairs, 1),
+            "merged_sketch_bytes": len(merged.encode()),
+            "np_percentile_ms": round(percentile_time * 1000, 2),
+            "sketch_build_ms": round(sketch_build_time * 1000, 2),
+            "sketch_merge_ms": round(sketch_merge_time * 1000, 2),
+        }
+    }
+
+# 使用真实查询结果，对比不同缓存编码方式的编解码耗时和保存的字节数
+def benchmark_cache_codec(limit = 2000):
+    limit = int(limit)
+    payloads = {
+        'rawdata': data_layer.mysql_select(f'''
+select src_city_id as src, dist_city_id as dist, samples, latency_min as min, latency_max as max,
+latency_avg as avg,latency_p50 as p50,latency_p70 as p70,latency_p90 as p90,latency_p95 as p95,
+UNIX_TIMESTAMP(update_time) as update_time from statistics order by update_time desc limit {limit}'''),
+        'cityobject': data_layer.mysql_select(data_layer.get_cityobject_sql('c.country_code = %s group by c.id,c.asn', 200), ('US',)),
+        'country': data_layer.mysql_select('select code,name from country order by code'),
+    }
+    variants = {
+        'json': {'columnar': False, 'compress_threshold': 2 ** 31},
+        'json-zlib': {'columnar': False},
+        'columnar': {'columnar': True, 'compress_threshold': 2 ** 31},
+        'columnar-zlib': {'columnar': True},
+    }
+    repeat = 10
+    result = {}
+    for name, payload in payloads.items():
+        result[name] = {'rows': len(payload)}
+        for variant, kwargs in variants.items():
+            start = time.perf_counter()
+            for i in range(repeat):
+                data = data_layer.cache_codec.encode(payload, level=settings.CACHE_COMPRESS_LEVEL, **kwargs)
+            encode_time = time.perf_counter() - start
+            start = time.perf_counter()
+            for i in range(repeat):
+                data_layer.cache_codec.decode(data)
+            decode_time = time.perf_counter() - start
+            result[name][variant] = {
+                'bytes': len(data),
+                'encode_ms': round(encode_time * 1000 / repeat, 3),
+                'decode_ms': round(decode_time * 1000 / repeat, 3),
+            }
+    return {
+        "status": 200,
+        "msg": result
+    }
+
+def rebuild_statistics_rollup():
+    rows = data_layer.rebuild_statistics_rollup()
+    if rows == None:
+        return {
+            "status": 404,
+            "msg": "statistics_rollup does not exist, upload the latest init.sql first: ./script/upload_sql.sh src/data/import-sql/init.sql"
+        }
+    return {
+        "status": 200,
+        "msg": f"statistics_rollup rebuilt with {rows} city pairs"
+    }
+
 def exec_sql(sql):
     if sql == 'init_db':
         return data_layer.mysql_create_database()
-    ret = data_layer.mysql_batch_execute(sql)
+    ret = data_layer.mysql_batch_execute(sql, max_seconds=settings.ADMIN_QUERY_MAX_SECONDS)
     return {
         "status": 200,
         "msg": ret
     }
 
+# 当前调用的 Lambda context，导入大文件时用于计算剩余时间和重新调用自己
+lambda_context = None
+
+# 打开导入文件，返回 (可 seek 的二进制流, 文件标识)，S3 文件按范围读取，不下载到 /tmp
+def open_sql_source(sql_file):
+    if sql_file.startswith('s3://'):
+        parsed = urlparse(sql_file)
+        reader = S3ObjectReader(boto3.client('s3'), parsed.netloc, parsed.path.lstrip('/'))
+        return io.BufferedReader(reader, settings.SQL_IMPORT_READ_SIZE), f'{reader.bucket}/{reader.key}:{reader.etag}'
+    stat = os.stat(sql_file)
+    return open(sql_file, 'rb'), f'{os.path.abspath(sql_file)}:{stat.st_size}:{int(stat.st_mtime)}'
+
+def import_deadline():
+    if lambda_context is None:
+        return float('inf')
+    return time.time() + lambda_context.get_remaining_time_in_millis() / 1000 - settings.SQL_IMPORT_TIME_MARGIN
+
+# 从 offset 开始导入一个 SQL 文件流，每 SQL_IMPORT_BATCH_STATEMENTS 条语句提交一次并保存断点
+# 超过 deadline 时在提交后停止，下次从断点继续；执行出错时回滚未提交的语句，断点停在最后一次提交的位置
+# 使用单独的连接，文件中的 LOCK TABLES 和会话变量不会影响连接池中的连接
+def import_sql_stream(name, stream, checkpoint, offset, deadline):
+    start = time.perf_counter()
+    result = {'file': name, 'statements': 0, 'offset': offset, 'done': False}
+    if offset > 0:
+        stream.seek(offset)
+    pending = 0
+    sql = ''
+    conn = data_layer.get_mysql_connect(True)
+    try:
+        with conn.cursor() as cursor:
+            for sql, end in sql_stream.iter_sql_statements(stream, offset):
+                cursor.execute(sql)
+                result['statements'] += 1
+                pending += 1
+                if pending >= settings.SQL_IMPORT_BATCH_STATEMENTS:
+                    conn.commit()
+                    pending = 0
+                    result['offset'] = end
+                    checkpoint.save(name, end)
+                    if time.time() > deadline:
+                        break
+            else:
+                conn.commit()
+                result['done'] = True
+                checkpoint.save(name, checkpoint.DONE)
+    except Exception as e:
+        conn.rollback()
+        print(f"{sql[:200]}\n错误: {str(e)}")
+        result['error'] = str(e)
+        result['sql'] = sql[:200]
+    finally:
+        conn.close()
+    result['seconds'] = round(time.perf_counter() - start, 2)
+    print(f"exec_sql {name} {result['statements']} statements in {result['seconds']}s, offset {result['offset']}")
+    return result
+
+# 把 zip 中的 sql 文件按操作的表分组：操作相同表的文件在同一组中按文件名顺序执行，不同的组可以并行
+# 组之间按外键依赖（数据库中已有的外键和文件中 CREATE TABLE 的 REFERENCES）排序，被引用的表先导入
+# 有文件识别不到表名（如只有 SET 语句）或依赖有环时无法判断，所有文件按文件名顺序在一组中执行
+def plan_sql_members(zip_ref):
+    members = sorted(info.filename for info in zip_ref.infolist() if info.filename.endswith('.sql'))
+    scans = {}
+    for name in members:
+        with zip_ref.open(name) as member:
+            scans[name] = sql_stream.scan_sql_tables(member)
+    sequential = [{'files': members, 'tables': sorted(set().union(*[scans[name][0] for name in members])), 'depends': set()}]
+    if any(len(scans[name][0]) == 0 for name in members):
+        return sequential
+    groups = []
+    for name in members:
+        tables, references = scans[name]
+        group = {'files': [name], 'tables': set(tables), 'references': set(references)}
+        for other in [other for other in groups if other['tables'] & tables]:
+            group['files'] = other['files'] + group['files']
+            group['tables'] |= other['tables']
+            group['references'] |= other['references']
+            groups.remove(other)
+        groups.append(group)
+    for row in data_layer.mysql_select('SELECT TABLE_NAME, REFERENCED_TABLE_NAME FROM information_schema.KEY_COLUMN_USAGE '
+            'WHERE TABLE_SCHEMA=%s AND REFERENCED_TABLE_NAME IS NOT NULL', (settings.DB_DATABASE,), False):
+        for group in groups:
+            if row[0].lower() in group['tables']:
+                group['references'].add(row[1].lower())
+    for group in groups:
+        group['files'].sort()
+        group['depends'] = {i for i, other in enumerate(groups) if other is not group and other['tables'] & group['references']}
+    # 检查依赖是否有环
+    done = set()
+    while len(done) < len(groups):
+        ready = {i for i, group in enumerate(groups) if i not in done and group['depends'] <= done}
+        if not ready:
+            return sequential
+        done |= ready
+    return [{'files': group['files'], 'tables': sorted(group['tables']), 'depends': group['depends']} for group in groups]
+
+def set_table_keys(tables, action:str):
+    # InnoDB 不支持 DISABLE KEYS，只有警告，MyISAM 表导入时不更新非唯一索引，完成后统一重建
+    for table in tables:
+        try:
+            data_layer.mysql_execute(f'ALTER TABLE `{table}` {action} KEYS')
+        except Exception as e:
+            print(f'{action} keys for {table} failed.', repr(e))
+
+# 导入一组文件，使用单独打开的文件流，与其他组并行读取时互不影响
+def import_sql_group(sql_file, group, offsets, deadline):
+    start = time.perf_counter()
+    stream, source = open_sql_source(sql_file)
+    checkpoint = data_layer.get_import_checkpoint(source)
+    results = []
+    set_table_keys(group['tables'], 'DISABLE')
+    try:
+        with zipfile.ZipFile(stream) as zip_ref:
+            for name in group['files']:
+                offset = offsets.get(name, '0')
+                if offset == checkpoint.DONE:
+                    results.append({'file': name, 'done': True, 'skipped': True})
+                    continue
+                with zip_ref.open(name) as member:
+                    result = import_sql_stream(name, member, checkpoint, int(offset), deadline)
+                results.append(result)
+                if not result['done']:
+                    break
+    finally:
+        stream.close()
+        set_table_keys(group['tables'], 'ENABLE')
+    return {
+        'tables': group['tables'],
+        'files': results,
+        'seconds': round(time.perf_counter() - start, 2),
+        'done': len(results) == len(group['files']) and all(result['done'] for result in results)
+    }
+
+# 在最多 SQL_IMPORT_WORKERS 个线程（每个线程一个写连接）中执行各组，依赖的组都完成后才开始
+# 有组出错或到达 deadline 没有完成时不再开始新的组，返回已经执行的组的结果
+def run_sql_groups(sql_file, groups, offsets, deadline):
+    results = {}
+    pending = list(range(len(groups)))
+    running = {}
+    stop = False
+    with ThreadPoolExecutor(max_workers=settings.SQL_IMPORT_WORKERS) as executor:
+        while True:
+            for i in list(pending):
+                if stop or len(running) >= settings.SQL_IMPORT_WORKERS:
+                    break
+                if all(d in results and results[d]['done'] for d in groups[i]['depends']):
+                    running[executor.submit(import_sql_group, sql_file, groups[i], offsets, deadline)] = i
+                    pending.remove(i)
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i = running.pop(future)
+                results[i] = future.result()
+                print(f"exec_sql tables {','.join(results[i]['tables'])} in {results[i]['seconds']}s, done: {results[i]['done']}")
+                if not results[i]['done']:
+                    stop = True
+    return [results[i] for i in sorted(results)]
+
 def exec_sqlfile(sql_file):
     """
     Execute SQL from a file or zip archive, supporting both local and S3 files
+    Statements are streamed from the file (zip members are read without extracting),
+    committed in batches and checkpointed in redis; an import that does not finish
+    before the Lambda timeout re-invokes itself and resumes from the checkpoint.
     Args:
         sql_file: Path to .sql file or .zip containing SQL files
                  Can be local path or S3 URL (s3://bucket-name/path/to/file)
     Returns:
         dict: Execution result
     """
+    if not sql_file.endswith(('.zip', '.sql')):
+        return {
+            'status': 404,
+            'msg': 'Invalid file type. Must be .sql or .zip'
+        }
+    stream = None
     try:
         print(f'exec_sql {sql_file}')
-        # Handle S3 files
-        if sql_file.startswith('s3://'):
-            local_file = download_from_s3(sql_file)
-            sql_file = local_file
-
-        # Handle zip files
+        stream, source = open_sql_source(sql_file)
+        checkpoint = data_layer.get_import_checkpoint(source)
+        offsets = checkpoint.load()
+        deadline = import_deadline()
+        results = []
+        groups = []
         if sql_file.endswith('.zip'):
-            temp_dir = '/tmp/sql_files'
-            os.makedirs(temp_dir, exist_ok=True)
-            
-            with zipfile.ZipFile(sql_file, 'r') as zip_ref:
-                zip_ref.extractall(temp_dir)
-            
-            results = []
-            for root, _, files in os.walk(temp_dir):
-                for file in files:
-                    print(f'exec_sql zipfile {file}')
-                    if file.endswith('.sql'):
-                        sql_path = os.path.join(root, file)
-                        with open(sql_path, 'r') as f:
-                            sql_content = f.read()
-                        data_layer.mysql_batch_execute(sql_content)
-                        print(f'exec_sql zipfile {file} finish.')
-                        results.append(f'Executed {file}')
-            
-            # Cleanup
-            os.system(f'rm -rf {temp_dir}')
-            return {
-                'status': 200,
-                'msg': 'Executed all SQL files from zip',
-                'details': results
-            }
-        
-        # Handle SQL files
-        elif sql_file.endswith('.sql'):
-            with open(sql_file, 'r') as f:
-                sql_content = f.read()
-            data_layer.mysql_batch_execute(sql_content)
-            print(f'exec_sql {sql_file} finish.')
+            with zipfile.ZipFile(stream) as zip_ref:
+                plan = plan_sql_members(zip_ref)
+            groups = run_sql_groups(sql_file, plan, offsets, deadline)
+            results = [result for group in groups for result in group['files']]
+            finished = len(groups) == len(plan) and all(group['done'] for group in groups)
+        else:
+            name = os.path.basename(sql_file)
+            offset = offsets.get(name, '0')
+            if offset != checkpoint.DONE:
+                results.append(import_sql_stream(name, stream, checkpoint, int(offset), deadline))
+            finished = all(result['done'] for result in results)
+        # 每组表的耗时，全部导入的耗时取决于最大的一组
+        tables = [{'tables': group['tables'], 'seconds': group['seconds'], 'done': group['done']} for group in groups]
+
+        if any('error' in result for result in results):
             return {
-                'status': 200,
-                'msg': f'Executed SQL file: {sql_file}'
+                'status': 500,
+                'msg': f'Failed to execute {sql_file}, fix the error and run again to resume',
+                'details': results,
+                'tables': tables
             }
-        
-        else:
+        if not finished:
+            # 剩余时间不够，重新调用自己从断点继续
+            boto3.client('lambda').invoke(FunctionName=lambda_context.invoked_function_arn, InvocationType='Event',
+                Payload=json.dumps({'action': 'exec_sqlfile', 'param': sql_file}).encode('utf-8'))
             return {
-                'status': 404,
-                'msg': 'Invalid file type. Must be .sql or .zip'
+                'status': 202,
+                'msg': f'Import of {sql_file} continues in next invocation',
+                'details': results,
+                'tables': tables
             }
-            
+        checkpoint.clear()
+        data_layer.refresh_iprange_index()
+        data_layer.pingable_pool.reset()
+        data_layer.reconcile_status_counters()
+        return {
+            'status': 200,
+            'msg': f'Executed all SQL files from {sql_file}',
+            'details': results,
+            'tables': tables
+        }
+
     except Exception as e:
         return {
             'status': 500,
             'msg': str(e)
         }
     finally:
-        # Cleanup any downloaded S3 files
-        if sql_file.startswith('/tmp/s3_files/'):
-            try:
-                os.remove(sql_file)
-            except:
-                pass
+        if stream is not None:
+            stream.close()
 
 def create_user(username):
     password = secrets.choice(string.ascii_uppercase) + ''.join(secrets.choice(string.ascii_lowercase) for _ in range(3)) + ''.join(secrets.choice(string.digits) for _ in range(3)) + secrets.choice(".,;@#$%^!")
@@ -229,8 +833,25 @@ def create_user(username):
 # event = {"action":"exec_sql","param":"select * from asn;"}
 # event = {"action":"create_user","param":"myuser"}
 # event = {"action":"mysql_dump","param":"country,city,asn,iprange,cityset"}
+# event = {"action":"refresh_iprange_index"}
+# event = {"action":"reset_pingable_pool"}
+# event = {"action":"benchmark_iprange_index","param":"1000"}
+# event = {"action":"benchmark_pingable_upsert","param":"2000"}
+# event = {"action":"migrate_statistics_slot"}
+# event = {"action":"rebuild_statistics_rollup"}
+# event = {"action":"benchmark_cache_codec","param":"2000"}
+# event = {"action":"migrate_statistics_columns"}
+# event = {"action":"benchmark_fping_parser","param":"500"}
+# event = {"action":"benchmark_latency_sketch","param":"1000"}
+# event = {"action":"produce_ping_jobs"}
+# event = {"action":"benchmark_sqs_sender","param":"2000"}
+# event = {"action":"migrate_pingable_epoch"}
+# event = {"action":"sweep_pingable"}
+# event = {"action":"reconcile_status_counters"}
 # or s3 notify message
 def lambda_handler(event, context):
+    global lambda_context
+    lambda_context = context
     try:
         # Handle S3 notifications
         ret = {"status":404, "msg":"not found"}
@@ -1,6 +1,9 @@
 import json
+import gzip
+import base64
 import settings
 import data_layer
+import fping_parser
 import ipaddress
 from urllib.parse import unquote_plus
 from datetime import datetime, timedelta
@@ -33,6 +36,11 @@ def webapi_statistics(requests):
         'result': data
     }
 
+# 丢包率百分比，samples 为收到的回包数
+def loss_percent(samples, lost):
+    total = samples + lost
+    return round(float(lost) * 100 / float(total), 2) if total > 0 else 0
+
 # //fixme，由于相同asn在同一个城市有多个asn号码，会造成选择cityid时少了，如：RU,Moscow,PJSC Rostelecom
 def webapi_performance(requests):
     if 'src' not in requests['query'] or 'dist' not in requests['query']:
@@ -42,20 +50,20 @@ def webapi_performance(requests):
     srclist = src.split(',')
     distlist = dist.split(',')
     # 找到所有相关的city_id对应对象
-    cityobjs = {}
-    for city_id in chain(srclist, distlist):
-        city_id = int(city_id)
-        city_obj = data_layer.get_cityobject_by_id(city_id)
-        # print(city_id, city_obj)
-        if city_obj and len(city_obj) > 0:
-            cityobjs[city_id] = city_obj[0]
+    cityobjs = data_layer.get_cityobjects_by_ids(chain(srclist, distlist))
 
+    headers = {"Content-Type": "application/json"}
     if 'rawData' in requests['query']:
         # 由于 alb 调用 Lambda 有 1MB 限制，所以把数据进行了拆分，原始数据和延迟数据分别给出
-        # 1000 条记录大概 330KB 2000条记录大概 670KB
-        rawData = data_layer.get_latency_rawdata_cross_city(src, dist, 2000)
+        # 原始数据按页返回，下一页的 cursor 放在 X-Next-Cursor 响应头中，客户端带上 cursor 参数继续获取
+        # 1000 条记录大概 330KB 2000条记录大概 670KB，gzip 压缩后每页可以返回更多
+        limit = settings.RAWDATA_GZIP_PAGE_SIZE if requests['acceptgzip'] else settings.RAWDATA_PAGE_SIZE
+        cursor = requests['query']['cursor'] if 'cursor' in requests['query'] else None
+        rawData, nextCursor = data_layer.get_latency_rawdata_cross_city(src, dist, limit, cursor)
         if rawData == None:
-            return {'statusCode': 400, 'result': 'param src and dist invalid!'}
+            return {'statusCode': 400, 'result': 'param src, dist or cursor invalid!'}
+        if nextCursor:
+            headers['X-Next-Cursor'] = nextCursor
         outdata = []
         # 原始数据处理
         for item in rawData:
@@ -70,6 +78,7 @@ def webapi_performance(requests):
                     'dA': data_layer.friendly_cityasn(distobj),
                     'dIP': f"{distobj['startIp']} - {distobj['endIp']}",
                     'sm': int(item['samples']),
+                    'ls': loss_percent(item['samples'], item['lost']),
                     'min': round(item['min']/1000, 2),
                     'max': round(item['max']/1000, 2),
                     'avg': round(item['avg']/1000, 2),
@@ -86,8 +95,13 @@ def webapi_performance(requests):
         # "1395638387,2228836286,10,23900,25500,24600.0000,24600.0000,24800.0000,25100.0000,25100.0000",
         if latencyData == None:
             return {'statusCode': 400, 'result': 'param src and dist invalid!'}
+        # 各cityid对的延迟分布，合并后计算真实的分位数，只要有一个cityid对缺少完整的分布，汇总时回退到按样本数加权平均
+        sketches = data_layer.get_latency_sketches_cross_city(src, dist)
+        allSketch = data_layer.merge_latency_sketches([])
+        groupSketches = {'asn': {}, 'city': {}}
         outdata = {
             "sm": 0,
+            "ls": 0,
             "srcCityIds": len(srclist),
             "distCityIds": len(distlist),
             "asnData": [],
@@ -99,8 +113,16 @@ def webapi_performance(requests):
             'city': {}
         }
         for item in latencyData:
+            sketch = sketches.get((item['src'], item['dist']))
+            if sketch and sketch.count == item['samples']:
+                item = {**item, **data_layer.latency_sketch_summary(sketch)}
+            else:
+                sketch = None
+            if allSketch != None:
+                allSketch = allSketch.merge(sketch) if sketch else None
             # samples数据汇总
             outdata['sm'] += item['samples']
+            outdata['ls'] += item['lost']
             # 各种Latency数据汇总
             for key in ('min','max','avg','p50','p70','p90','p95'):
                 if key not in outdata:
@@ -122,6 +144,7 @@ def webapi_performance(requests):
                     'dLa': distobj['latitude'],
                     'dLo': distobj['longitude'],
                     'sm': int(item['samples']),
+                    'ls': loss_percent(item['samples'], item['lost']),
                     'min': round(item['min']/1000, 1),
                     'max': round(item['max']/1000, 1),
                     'avg': round(item['avg']/1000, 1),
@@ -143,15 +166,22 @@ def webapi_performance(requests):
                             data[key][subkey] = {'sm':0,'isS': subkey in srcsubkey}
                             for datakey in ('min','max','avg','p50','p70','p90','p95'):
                                 data[key][subkey][datakey] = 0
+                            groupSketches[key][subkey] = data_layer.merge_latency_sketches([])
+                        if groupSketches[key][subkey] != None:
+                            groupSketches[key][subkey] = groupSketches[key][subkey].merge(sketch) if sketch else None
                         data[key][subkey]['sm'] += item['samples']
                         for datakey in ('min','max','avg','p50','p70','p90','p95'):
                             data[key][subkey][datakey] += item[datakey] * item['samples']
         latencyData = None
 
         # 各种Latency数据汇总
+        outdata['ls'] = loss_percent(outdata['sm'], outdata['ls'])
         outdata['sm'] = int(outdata['sm'])
+        summary = data_layer.latency_sketch_summary(allSketch) if allSketch and allSketch.count > 0 else None
         for key in ('min','max','avg','p50','p70','p90','p95'):
-            if key in outdata:
+            if summary:
+                outdata[key] = round(summary[key] / 1000, 1)
+            elif key in outdata:
                 outdata[key] = round(outdata[key]['data'] / outdata[key]['sm'] / 1000, 1)
             else:
                 outdata[key] = 0
@@ -163,13 +193,19 @@ def webapi_performance(requests):
                     key: k,
                     'isS': data[key][k]['isS']
                 }
+                sketch = groupSketches[key][k]
+                summary = data_layer.latency_sketch_summary(sketch) if sketch and sketch.count > 0 else None
                 for datakey in ('min','max','avg','p50','p70','p90','p95'):
-                    datas[datakey] = round(data[key][k][datakey] / data[key][k]['sm'] / 1000, 1)
+                    if summary:
+                        datas[datakey] = round(summary[datakey] / 1000, 1)
+                    else:
+                        datas[datakey] = round(data[key][k][datakey] / data[key][k]['sm'] / 1000, 1)
                 outdata[key+'Data'].append(datas)
         data = None
 
     return {
         'statusCode': 200,
+        'headers': headers,
         'result': outdata
     }
 
@@ -202,6 +238,11 @@ def webapi_uninstall(requests):
         'result': content
     }
 
+def token_cookie(ret):
+    expiration = datetime.utcnow() + timedelta(seconds=ret['expire'])
+    expstr = expiration.strftime("%a, %d %b %Y %H:%M:%S GMT")
+    return f"cp_token={ret['token']}|{ret['user']}|{ret['auth']}; Path=/; Expires={expstr}"
+
 # {username: "admin", password: "admin"}
 # {username: "admin", domain: "sso", password: "admin", url: "redirecturl"}
 def webapi_login(requests):
@@ -219,14 +260,12 @@ def webapi_login(requests):
             ret = data_layer.validate_user(data['username'], None, data['password'], expire)
         if ret != None:
             if 'url' in data:
-                expiration = datetime.utcnow() + timedelta(seconds=ret['expire'])
-                expstr = expiration.strftime("%a, %d %b %Y %H:%M:%S GMT")
                 return {
                     'statusCode': 307,
                     'headers': {
                         'Content-Type': 'text/plain; charset=utf-8',
                         'Cache-Control': 'no-cache',
-                        'Set-Cookie': f"cp_token={ret['token']}|{ret['user']}|{ret['auth']}; Path=/; Expires={expstr}",
+                        'Set-Cookie': token_cookie(ret),
                         'Location': data['url']
                     },
                     'result': 'login successs, redirecting ...'
@@ -244,17 +283,31 @@ def webapi_updateuser(requests):
     obj = json.loads(requests['body'])
     return data_layer.create_user(obj['username'], obj['password'], obj['role'])
 
+# 修改密码后之前签发的 token 全部失效，给当前用户签发新的 token，不需要重新登录
 def webapi_changepasswd(requests):
     obj = json.loads(requests['body'])
     cp_token = data_layer.get_cookie(requests['cookie'], 'cp_token').split('|')
     userobj = data_layer.get_user_info_by_token(cp_token[0])
     if userobj:
-        return data_layer.create_user(userobj['user'], obj['password'], userobj['auth'])
+        ret = data_layer.create_user(userobj['user'], obj['password'], userobj['auth'])
+        if ret['statusCode'] == 200:
+            token = data_layer.issue_user_token(userobj['user'], userobj['auth'])
+            ret['headers'] = {'Content-Type': 'application/json', 'Set-Cookie': token_cookie(token)}
+        return ret
     return {
         'statusCode': 403,
         'result': "username or password error!"
     }
 
+def webapi_logout(requests):
+    cp_token = data_layer.get_cookie(requests['cookie'], 'cp_token').split('|')
+    data_layer.revoke_user_token(cp_token[0])
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Set-Cookie': 'cp_token=; Path=/; Expires=Thu, 01 Jan 1970 00:00:01 GMT'},
+        'result': 'success'
+    }
+
 # country=US&city=US-NYC
 def webapi_asn(requests):
     cityset = 0
@@ -327,7 +380,7 @@ def webapi_cityset(requests):
 
 def webapi_runsql(requests):
     sql = json.loads(requests['body'])
-    ret = data_layer.mysql_batch_execute(sql['sql'])
+    ret = data_layer.mysql_batch_execute(sql['sql'], int(sql.get('maxRows', settings.QUERY_MAX_ROWS)), bool(sql.get('explain', False)))
     return {
         "statusCode": 200,
         "result": ret
@@ -390,13 +443,6 @@ def webapi_asninfo(requests):
         'result': citys
     }
 
-def is_ip_address(ip_string):
-    try:
-        ipaddress.ip_address(ip_string)
-        return True
-    except ValueError:
-        return False
-
 '''
 requests: {
     version: "apigw-httpapi2.0",
@@ -418,24 +464,26 @@ def fping_logic(requests):
         else:
             next = ''
         # print(f"receive {len(jobResult)} job")
+        # 所有 ping 任务发现的 ip 和 data 任务的统计结果，汇总后一次写入
+        pingable_ips = []
+        statistics_datas = []
+        leaseids = []
         for obj in jobResult:
             jobtype = obj['jobid'][:4]
-            jobid = int(obj['jobid'][4:])
+            # ping 任务的 jobid 为 ping{city_id}-{任务id}
+            jobid, _, leaseid = obj['jobid'][4:].partition('-')
+            jobid = int(jobid)
+            if leaseid:
+                leaseids.append(leaseid)
             if jobtype == 'ping':
                 # obj['status'] = 0 success 256 partial success or not found any pingable ip
                 # obj['stderr'] -> 1.6.81.7 : duplicate for [0], 64 bytes, 468 ms
-                stdout = obj['stdout'].split('\n')
-                ips = []
-                for out in stdout:
-                    # Enough hosts reachable (required: 100, reachable: 100)
-                    if out == '' or out.startswith('[DEBUG]'):
-                        continue
-                    if is_ip_address(out):
-                        ips.append(out)
+                # 只取每行一个 ip 的输出，忽略 [DEBUG] 和 Enough hosts reachable (required: 100, reachable: 100)
+                ips = fping_parser.parse_alive_output(obj['stdout'])
                 #print(f"pingjob: {jobid} status: {obj['status']} ips: {len(ips)}")
                 # print(ips)
                 if len(ips) > 0:
-                    data_layer.update_pingable_ip(jobid, ips)
+                    pingable_ips.extend((jobid, ip) for ip in ips)
                     data_layer.update_speed_status(jobtype, len(ips), False)
             elif jobtype == 'data':
                 #print(f"datajob: {jobid} status: {obj['status']}")
@@ -448,15 +496,10 @@ def fping_logic(requests):
                 # 2.17.168.93 : 358 358 358 358 363 358 358 358 358 358 358
                 # 2.17.168.76 : 358 358 358 358 358 359 358 358 358 358 358
                 # 38.107.236.100 : duplicate for [0], 64 bytes, 34.4 ms
-                samples = []
-                for stderr in obj['stderr'].split('\n'):
-                    if stderr.find('duplicate') != -1:
-                        continue
-                    for data in stderr.split(' '):
-                        try:
-                            samples.append(float(data))
-                        except ValueError:
-                            pass
+                # 2.17.168.93 : 358 358 - 358 363 358 358 358 358 358 358
+                # - 表示丢包，全部丢包时没有延迟数据，不写入统计数据
+                samples, targets = fping_parser.parse_count_output(obj['stderr'])
+                lost = sum(target[3] for target in targets)
                 n = len(samples)
                 if len(samples)>0:
                     # numpy 库太大了，这里简单实现一下
@@ -466,6 +509,7 @@ def fping_logic(requests):
                         'src_city_id': city_id,
                         'dist_city_id': jobid,
                         'samples': n,
+                        'lost': lost,
                         'latency_min': int(sorted_data[0] * 1000), #min(samples), #np.min(arr),
                         'latency_max': int(sorted_data[n-1] * 1000), #max(samples), #np.max(arr),
                         'latency_avg': int(sum(sorted_data) * 1000 / n), #np.mean(arr),
@@ -474,36 +518,48 @@ def fping_logic(requests):
                         'latency_p90': int(data_layer.np_percentile(sorted_data, 90) * 1000), #np.percentile(arr, 90),
                         'latency_p95': int(data_layer.np_percentile(sorted_data, 95) * 1000), #np.percentile(arr, 95),
                     }
-                    data_layer.update_statistics_data(datas)
-                    data_layer.delete_oldest_statistics_data(city_id, jobid)
+                    if data_layer.statistics_sketch_enabled():
+                        # 保存可合并的延迟分布，多个cityid对汇总时计算真实的分位数
+                        datas['sketch'] = data_layer.make_latency_sketch(sorted_data).encode()
+                    statistics_datas.append(datas)
                     data_layer.update_speed_status(jobtype, len(samples), False)
+        if len(pingable_ips) > 0:
+            data_layer.update_pingable_ips(pingable_ips)
+        if len(statistics_datas) > 0:
+            data_layer.update_statistics_datas(statistics_datas)
+        # 结果写入后再确认任务，写入失败时任务租约到期会重新执行
+        if len(leaseids) > 0:
+            data_layer.ack_ping_jobs(leaseids)
+        returned = len(jobResult)
+    else:
+        returned = 0
 
-    if requests['useragent'].startswith('fping-pingable'):
+    agent = 'ping' if requests['useragent'].startswith('fping-pingable') else 'data'
+    # 按客户端的处理能力决定本次下发的任务数和下次请求间隔，没有提交结果直接请求时上一批任务按丢失处理
+    capacity = data_layer.get_detector_capacity(requests['srcip'], agent)
+    batch = capacity.record_results(returned)
+    if agent == 'ping':
         ttl = data_layer.update_client_status(requests['srcip'], 'ping')
         # need pause
         if isinstance(ttl, str):
             ret["interval"] = int(ttl)
         else:
-            # get ping job here, ensure buffer data enough
-            data_layer.refresh_iprange_check()
-            for i in range(0, 20):
-                obj = data_layer.cache_pop(settings.CACHEKEY_PINGABLE)
-                if obj:
-                    stip = ipaddress.IPv4Address(obj['start_ip'])
-                    etip = ipaddress.IPv4Address(obj['end_ip'])
-                    #print(f"fetch ping job: {stip} {etip} {obj['city_id']}")
-                    ret["job"].append({
-                        "jobid": 'ping' + str(obj['city_id']),
-                        # disable stderr log here with 2> /dev/null , but it will cause error
-                        # only found 100 max pingable ip to save time
-                        "command": f"fping -g {stip} {etip} -r 2 -a -q -X 100",
-                    })
-                else:
-                    break
+            # 只取任务，任务由 admin Lambda 定时执行 produce_ping_jobs 补充
+            # 一次原子地取出最多 batch 个任务，提交结果时按 jobid 中的任务id确认，没有确认的任务租约到期后重新放回队列
+            for leaseid, obj in data_layer.lease_ping_jobs(batch):
+                stip = ipaddress.IPv4Address(obj['start_ip'])
+                etip = ipaddress.IPv4Address(obj['end_ip'])
+                #print(f"fetch ping job: {stip} {etip} {obj['city_id']}")
+                ret["job"].append({
+                    "jobid": 'ping' + str(obj['city_id']) + '-' + leaseid,
+                    # disable stderr log here with 2> /dev/null , but it will cause error
+                    # only found 100 max pingable ip to save time
+                    "command": f"fping -g {stip} {etip} -r 2 -a -q -X 100",
+                })
             # print(f"fetch {len(ret['job'])} ping job")
+            ret["interval"] = capacity.record_dispatch(len(ret["job"]))
             if len(ret["job"]) > 0:
                 ret["next"] = 'ping'
-                ret["interval"] = 1
                 data_layer.update_speed_status('ping', len(ret["job"]), True)
     else:
         ttl = data_layer.update_client_status(requests['srcip'], 'data')
@@ -511,7 +567,7 @@ def fping_logic(requests):
         if isinstance(ttl, str):
             ret["interval"] = int(ttl)
         else:
-            for i in range(0, 10):
+            for i in range(0, batch):
                 job = data_layer.get_pingjob_by_cityid(city_id)
                 #print(job)
                 if job != None:
@@ -524,9 +580,9 @@ def fping_logic(requests):
                 else:
                     break
             # print(f"fetch {len(ret['job'])} data job")
+            ret["interval"] = capacity.record_dispatch(len(ret["job"]))
             if len(ret['job']) > 0:
                 ret["next"] = "data"
-                ret["interval"] = 1
                 data_layer.update_speed_status('data', len(ret["job"]), True)
     return {
         'statusCode': 200,
@@ -550,6 +606,7 @@ def lambda_handler(event, context):
                 'path': event['requestContext']['http']['path'],
                 'query': event['queryStringParameters'],
                 'cookie': event['headers']['cookie'] if 'cookie' in event['headers'] else '',
+                'acceptencoding': event['headers']['accept-encoding'] if 'accept-encoding' in event['headers'] else '',
             }
         elif event['version'] == '1.0':
             requests = {
@@ -562,6 +619,7 @@ def lambda_handler(event, context):
                 'path': event['requestContext']['path'],
                 'query': event['queryStringParameters'],
                 'cookie': event['headers']['cookie'] if 'cookie' in event['headers'] else '',
+                'acceptencoding': event['headers'].get('Accept-Encoding', event['headers'].get('accept-encoding', '')),
             }
     else:
         # 兼容 ALB
@@ -580,7 +638,9 @@ def lambda_handler(event, context):
             'path': event['path'],
             'query': event['queryStringParameters'],
             'cookie': event['headers']['cookie'] if 'cookie' in event['headers'] else '',
+            'acceptencoding': event['headers']['accept-encoding'] if 'accept-encoding' in event['headers'] else '',
         }
+    requests['acceptgzip'] = 'gzip' in requests['acceptencoding']
     requests['next'] = requests['query']['next'] if 'next' in requests['query'] else ''
     apimapping = {
         '/job':[fping_logic, settings.AUTH_NOTNEED],
@@ -596,6 +656,7 @@ def lambda_handler(event, context):
         '/api/asn': [webapi_asn, settings.AUTH_BASEUSER],
         '/api/performance': [webapi_performance, settings.AUTH_BASEUSER],
         '/api/changepasswd': [webapi_changepasswd, settings.AUTH_BASEUSER],
+        '/api/logout': [webapi_logout, settings.AUTH_BASEUSER],
 
         #'/api/status': [webapi_status, settings.AUTH_READONLY],
         '/api/statistics': [webapi_statistics, settings.AUTH_READONLY],
@@ -621,6 +682,15 @@ def lambda_handler(event, context):
     #ret['result']['requests'] = requests;
     headers = ret['headers'] if 'headers' in ret else {"Content-Type": "application/json"}
     body = json.dumps(ret['result']) if headers['Content-Type'] == 'application/json' else ret['result']
+    if requests['acceptgzip'] and len(body) >= settings.RESPONSE_GZIP_MIN_SIZE:
+        # alb 和 api gateway 都需要把二进制响应体用 base64 编码
+        headers['Content-Encoding'] = 'gzip'
+        return {
+            'statusCode': ret['statusCode'],
+            "headers": headers,
+            'body': base64.b64encode(gzip.compress(body.encode('utf-8'), 6)).decode('ascii'),
+            'isBase64Encoded': True
+        }
     return {
         'statusCode': ret['statusCode'],
         "headers": headers,
@@ -46,16 +46,19 @@ CREATE TABLE IF NOT EXISTS `iprange` (
 CREATE TABLE IF NOT EXISTS `pingable` (
     `ip` INT UNSIGNED NOT NULL PRIMARY KEY COMMENT 'ip',
     `city_id` INT UNSIGNED NOT NULL COMMENT '唯一标识',
-    `lastresult` INT UNSIGNED NOT NULL COMMENT '最近结果',
+    `last_epoch` SMALLINT UNSIGNED NOT NULL COMMENT '最近一次探测到的发现周期',
+    `seen` TINYINT UNSIGNED NOT NULL COMMENT '最近4个周期是否探测到的位图，最高位为last_epoch',
     `update_time` timestamp NOT NULL ON UPDATE CURRENT_TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '更新时间',
     KEY `city_id` (`city_id`),
-    KEY `lastresult` (`lastresult`)
+    KEY `last_epoch` (`last_epoch`)
 ) ENGINE = InnoDB DEFAULT CHARSET = utf8mb4 COLLATE = utf8mb4_0900_ai_ci COMMENT '可ping ip列表';
 
 CREATE TABLE IF NOT EXISTS `statistics` (
     `src_city_id` INT UNSIGNED NOT NULL COMMENT '源侧',
     `dist_city_id` INT UNSIGNED NOT NULL COMMENT '目标侧',
+    `slot` TINYINT UNSIGNED NOT NULL DEFAULT 0 COMMENT '槽位，每个cityid对循环使用',
     `samples` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT '样本数',
+    `lost` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT '丢包数',
     `latency_min` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT '最小延时us',
     `latency_max` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT '最大延时us',
     `latency_avg` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT '平均延时us',
@@ -63,13 +66,36 @@ CREATE TABLE IF NOT EXISTS `statistics` (
     `latency_p70` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'p70延时us',
     `latency_p90` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'p90延时us',
     `latency_p95` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'p95延时us',
+    `sketch` BLOB NULL COMMENT '延迟分布，可合并计算分位数',
     `update_time` timestamp NOT NULL ON UPDATE CURRENT_TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '更新时间',
     KEY `src_city_id` (`src_city_id`),
     KEY `dist_city_id` (`dist_city_id`),
     KEY `update_time` (`update_time`),
-    INDEX `idx_src_dist_city` (`src_city_id`, `dist_city_id`)
+    UNIQUE KEY `idx_src_dist_slot` (`src_city_id`, `dist_city_id`, `slot`)
 ) ENGINE = InnoDB DEFAULT CHARSET = utf8mb4 COLLATE = utf8mb4_0900_ai_ci COMMENT '统计数据';
 
+CREATE TABLE IF NOT EXISTS `statistics_rollup` (
+    `src_city_id` INT UNSIGNED NOT NULL COMMENT '源侧',
+    `dist_city_id` INT UNSIGNED NOT NULL COMMENT '目标侧',
+    `records` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT '汇总的记录数',
+    `samples` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT '样本数',
+    `lost` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT '丢包数',
+    `latency_min` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT '最小延时us',
+    `latency_max` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT '最大延时us',
+    `latency_avg` DOUBLE NOT NULL DEFAULT 0 COMMENT '平均延时us',
+    `latency_p50` DOUBLE NOT NULL DEFAULT 0 COMMENT 'p50延时us',
+    `latency_p70` DOUBLE NOT NULL DEFAULT 0 COMMENT 'p70延时us',
+    `latency_p90` DOUBLE NOT NULL DEFAULT 0 COMMENT 'p90延时us',
+    `latency_p95` DOUBLE NOT NULL DEFAULT 0 COMMENT 'p95延时us',
+    `ewma_avg` DOUBLE NOT NULL DEFAULT 0 COMMENT '平均延时的指数加权移动平均us',
+    `ewma_p50` DOUBLE NOT NULL DEFAULT 0 COMMENT 'p50延时的指数加权移动平均us',
+    `ewma_p95` DOUBLE NOT NULL DEFAULT 0 COMMENT 'p95延时的指数加权移动平均us',
+    `sketch` BLOB NULL COMMENT '合并后的延迟分布',
+    `update_time` timestamp NOT NULL ON UPDATE CURRENT_TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '更新时间',
+    PRIMARY KEY (`src_city_id`, `dist_city_id`),
+    KEY `dist_city_id` (`dist_city_id`)
+) ENGINE = InnoDB DEFAULT CHARSET = utf8mb4 COLLATE = utf8mb4_0900_ai_ci COMMENT '统计数据按cityid对汇总';
+
 CREATE TABLE IF NOT EXISTS `cityset` (
     `id` INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY COMMENT 'id',
     `name` varchar(32) NOT NULL COMMENT '集合名字',
@@ -0,0 +1,103 @@
+import array
+import json
+import struct
+import zlib
+
+# 缓存数据的编码格式
+# 新格式以 MAGIC 开头，第二个字节为格式，最高位表示使用了 zlib 压缩
+# 没有 MAGIC 前缀的按 json 文本解码，兼容旧数据；较小的非表格数据仍然直接保存 json 文本
+MAGIC = b'\xcf'
+FORMAT_JSON = 1
+FORMAT_COLUMNAR = 2
+FLAG_ZLIB = 0x80
+LENGTH = struct.Struct('<I')
+# 'd' 列中允许的整数范围，超出后会丢失精度
+MAX_DOUBLE_INT = 2 ** 53
+
+def json_bytes(value):
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+# 是否为 fetch_all_to_dict 返回的表格形式：字典列表，且每行的列名和顺序一致
+def is_table(value, min_rows:int = 1):
+    if not isinstance(value, list) or len(value) < min_rows or not isinstance(value[0], dict):
+        return False
+    keys = list(value[0])
+    return all(isinstance(row, dict) and list(row) == keys for row in value)
+
+def encode_column(values):
+    # 整数列用 int64，数字列用 double，其他（字符串、None、嵌套对象）用 json
+    if all(type(v) is int for v in values):
+        try:
+            return 'q', array.array('q', values).tobytes()
+        except OverflowError:
+            pass
+    if all(type(v) is float or (type(v) is int and -MAX_DOUBLE_INT <= v <= MAX_DOUBLE_INT) for v in values):
+        return 'd', array.array('d', values).tobytes()
+    return 'j', json_bytes(values)
+
+# 列式编码：头部 json 保存列名、列类型和行数，然后每列为 长度 + 数据
+def encode_table(rows):
+    names = list(rows[0])
+    types = []
+    bodies = []
+    for name in names:
+        type, body = encode_column([row[name] for row in rows])
+        types.append(type)
+        bodies.append(body)
+    header = json_bytes({'c': names, 't': types, 'n': len(rows)})
+    out = [LENGTH.pack(len(header)), header]
+    for body in bodies:
+        out.append(LENGTH.pack(len(body)))
+        out.append(body)
+    return b''.join(out)
+
+def decode_table(data):
+    data = memoryview(data)
+    size = LENGTH.unpack_from(data, 0)[0]
+    header = json.loads(bytes(data[4:4 + size]))
+    pos = 4 + size
+    columns = []
+    for type in header['t']:
+        size = LENGTH.unpack_from(data, pos)[0]
+        pos += 4
+        body = data[pos:pos + size]
+        pos += size
+        if type == 'j':
+            columns.append(json.loads(bytes(body)))
+        else:
+            column = array.array(type)
+            column.frombytes(body)
+            columns.append(column.tolist())
+    if header['n'] == 0:
+        return []
+    names = header['c']
+    return [dict(zip(names, row)) for row in zip(*columns)]
+
+def encode(value, columnar:bool = True, compress_threshold:int = 1024, level:int = 6, min_rows:int = 16):
+    if columnar and is_table(value, min_rows):
+        format = FORMAT_COLUMNAR
+        body = encode_table(value)
+    else:
+        body = json_bytes(value)
+        if len(body) < compress_threshold:
+            # 小数据直接保存 json 文本，旧版本也可以读取
+            return body
+        format = FORMAT_JSON
+    if len(body) >= compress_threshold:
+        body = zlib.compress(body, level)
+        format |= FLAG_ZLIB
+    return MAGIC + bytes([format]) + body
+
+def decode(data):
+    if isinstance(data, str) or data[:1] != MAGIC:
+        return json.loads(data)
+    format = data[1]
+    body = data[2:]
+    if format & FLAG_ZLIB:
+        body = zlib.decompress(body)
+        format &= ~FLAG_ZLIB
+    if format == FORMAT_JSON:
+        return json.loads(body)
+    if format == FORMAT_COLUMNAR:
+        return decode_table(body)
+    raise ValueError(f'unknown cache format {format}')
@@ -5,6 +5,7 @@ import re
 import json
 import time
 import hashlib
+import base64
 import settings
 import boto3
 from onlineip_tracker import OnlineIPTracker
@@ -12,6 +13,23 @@ from typing import List, Dict, Any
 from botocore.exceptions import ClientError
 from password_validator import EnhancedPasswordValidator
 from speed_counter import SpeedCounter
+from iprange_index import IPRangeIndex
+from mysql_pool import MySQLPool
+from local_cache import LocalCache
+from pingable_pool import PingablePool
+from job_queue import JobQueue
+from detector_capacity import DetectorCapacity
+from redis_lock import FencedLock
+from sqs_sender import SqsBatchSender
+from query_console import QueryConsole
+from status_counters import StatusCounters
+from session_token import SessionTokens
+from sql_stream import SqlImportCheckpoint
+from latency_sketch import LatencySketch
+import cache_codec
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
 import pymysql
 from pymysql.constants import FIELD_TYPE
@@ -33,6 +51,21 @@ redis_pool = redis.ConnectionPool(
     socket_timeout=5,
     socket_connect_timeout=5)
 
+# 缓存数据使用二进制编码（见 cache_codec），需要不解码的连接池
+redis_binary_pool = redis.ConnectionPool(
+    host=settings.CACHE_HOST,
+    port=settings.CACHE_PORT,
+    decode_responses=False,
+    connection_class=redis.SSLConnection,
+    socket_timeout=5,
+    socket_connect_timeout=5)
+
+local_cache = LocalCache(redis_pool, settings.CACHEKEY_LOCAL_GENERATION, settings.LOCAL_CACHE_PREFIXES,
+    settings.LOCAL_CACHE_TTL, settings.LOCAL_CACHE_CHECK_INTERVAL, settings.LOCAL_CACHE_MAX_VALUE_SIZE)
+
+# ping 任务队列，客户端取出的任务在提交结果前保留租约，租约到期后重新放回队列
+ping_job_queue = JobQueue(redis_pool, settings.CACHEKEY_PINGABLE, settings.JOB_LEASE_SECONDS)
+
 def myhash(text):
     if not isinstance(text, str):
         text = str(text)
@@ -40,10 +73,29 @@ def myhash(text):
     sha256_hash = hashlib.sha256(text_bytes)
     return sha256_hash.hexdigest()[:32]
 
-def get_mysql_connect(need_write = False, need_multi = False, db = settings.DB_DATABASE):
+def get_mysql_connect(need_write = False, need_multi = False, db = settings.DB_DATABASE, autocommit = False):
     host = settings.DB_WRITE_HOST if need_write else settings.DB_READ_HOST
     client_flag = pymysql.constants.CLIENT.MULTI_STATEMENTS if need_multi else 0
-    return pymysql.connect(host=host, user=settings.DB_USER, passwd=settings.DB_PASS, db=db, charset='utf8mb4', port=settings.DB_PORT, client_flag=client_flag, conv=conv)
+    return pymysql.connect(host=host, user=settings.DB_USER, passwd=settings.DB_PASS, db=db, charset='utf8mb4', port=settings.DB_PORT, client_flag=client_flag, conv=conv, autocommit=autocommit)
+
+# 读写分开的连接池，Lambda 热启动时保留
+# 只读连接使用 autocommit，避免复用连接时读到旧的事务快照
+mysql_pools = {}
+
+def get_mysql_pool(need_write = False, need_multi = False):
+    key = (need_write, need_multi)
+    if key not in mysql_pools:
+        mysql_pools[key] = MySQLPool(
+            lambda: get_mysql_connect(need_write, need_multi, autocommit = not need_write),
+            max_size = settings.MYSQL_POOL_MAX_SIZE,
+            max_idle = settings.MYSQL_POOL_MAX_IDLE,
+            ping_interval = settings.MYSQL_POOL_PING_INTERVAL)
+    return mysql_pools[key]
+
+@contextmanager
+def mysql_connection(need_write = False, need_multi = False):
+    with get_mysql_pool(need_write, need_multi).connection() as conn:
+        yield conn
 
 def mysql_create_database(database:str = None):
     if database == None:
@@ -85,86 +137,33 @@ def fetch_all_to_dict(cursor: pymysql.cursors.Cursor) -> List[Dict[str, Any]]:
 # 执行写
 def mysql_execute(sql:str, obj = None):
     #pymysql.connections.DEBUG = True
-    conn = get_mysql_connect(True)
-    cursor = conn.cursor()
-    cursor.execute(sql, obj)
-    results = cursor.fetchall()
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with mysql_connection(True) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sql, obj)
+            results = cursor.fetchall()
+        conn.commit()
     return results
 
 def mysql_select(sql:str, obj = None, fetchObject = True):
-    conn = get_mysql_connect(False)
-    cursor = conn.cursor()
-    cursor.execute(sql, obj)
-    if fetchObject:
-        results = fetch_all_to_dict(cursor)
-    else:
-        results = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    with mysql_connection(False) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sql, obj)
+            if fetchObject:
+                results = fetch_all_to_dict(cursor)
+            else:
+                results = cursor.fetchall()
     return results
 
-# 会打印结果
-def mysql_batch_execute(sql: str):
-    results = []
-    try:
-        conn = get_mysql_connect(need_write = True, need_multi = True)
-        cursor = conn.cursor()
-        # 分割SQL语句
-        sql_statements = sql.strip().split(";")
-        affected_rows = 0
-        # 执行每条SQL语句
-        for sql in sql_statements:
-            sql = sql.strip()
-            if sql:  # 忽略空语句
-                cursor.execute(sql)
-                keyaction = sql[:4].lower()
-                # 如果是 select/with/explain/show 开头的命令，需要获取详细数据
-                readaction = {'sele', 'with', 'expl', 'show'}
-                if keyaction in readaction:
-                    # 查询语句
-                    rows = cursor.fetchall()
-                    if rows:
-                        columns = [desc[0] for desc in cursor.description]
-                        print("列名:", " | ".join(columns))
-                        for row in rows:
-                            print(" | ".join(map(str, row)))
-                        results.append({
-                            'sql': sql,
-                            'type': 'query',
-                            'columns': ','.join(columns), #columns,
-                            'rows': [','.join(map(str, row)) for row in rows] # [list(map(str, row)) for row in rows]
-                        })
-                    else:
-                        print('无结果返回')
-                        results.append({
-                            'sql': sql,
-                            'type': 'query',
-                            'message': '无结果返回'
-                        })
-                else:
-                    affected_rows += cursor.rowcount
-                    # print(f"影响行数: {cursor.rowcount}")
-                    # 非查询语句
-                    results.append({
-                        'sql': sql,
-                        'type': 'update',
-                        'affected_rows': cursor.rowcount
-                    })
-                conn.commit()
-        if affected_rows > 0:
-            print(f"共影响行数: {affected_rows}")
+# 数据维护页面执行 sql，查询结果按行数截断，使用单独的写连接（截断的查询需要直接关闭连接）
+def mysql_batch_execute(sql: str, max_rows:int = settings.QUERY_MAX_ROWS, explain:bool = False, max_seconds:int = settings.QUERY_MAX_SECONDS):
+    console = QueryConsole(lambda: get_mysql_connect(need_write = True),
+        max_rows = min(max_rows, settings.QUERY_MAX_ROWS_LIMIT), max_cell = settings.QUERY_MAX_CELL,
+        max_seconds = max_seconds, explain = explain)
+    return console.run(sql)
 
-    except Exception as e:
-        print(f"{sql}\n错误: {str(e)}")
-        results.append({'error': str(e)})
-
-    finally:
-        if 'conn' in locals():
-            conn.close()
-    return results
+# source 为导入文件的标识，如 bucket/key:etag
+def get_import_checkpoint(source:str):
+    return SqlImportCheckpoint(redis_pool, settings.CACHEKEY_SQL_IMPORT + source)
 
 def mysql_select_onevalue(sql:str, obj = None, default = 0):
     row = mysql_select(sql, obj, False)
@@ -172,12 +171,53 @@ def mysql_select_onevalue(sql:str, obj = None, default = 0):
         return default
     return row[0][0]
 
+# 升级部署后、admin 的 migrate_* 执行之前，表结构还是旧的，读写按数据库中实际的表结构选择新旧方式，迁移完成后自动切换
+# 表结构在执行环境内缓存 SCHEMA_CHECK_INTERVAL 秒（表不存在时为空集合），语句出错时由 retry_on_schema_change 立即重新检测
+schema_columns = {}
+
+def get_table_columns(table:str):
+    checked = schema_columns.get(table)
+    if checked is None or time.time() - checked[0] > settings.SCHEMA_CHECK_INTERVAL:
+        rows = mysql_select('SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s', (table,), False)
+        checked = (time.time(), {row[0] for row in rows})
+        schema_columns[table] = checked
+    return checked[1]
+
+# admin 执行迁移后调用，同一执行环境中后续的操作立即按新结构执行
+def clear_table_columns():
+    schema_columns.clear()
+
+def has_column(table:str, column:str):
+    return column in get_table_columns(table)
+
+def has_table(table:str):
+    return len(get_table_columns(table)) > 0
+
+# 执行 func，数据库报错时重新检测 tables 的表结构，结构有变化（执行环境启动后完成了迁移）时按新结构重试一次
+def retry_on_schema_change(tables:list, func):
+    try:
+        return func()
+    except pymysql.MySQLError:
+        old = {table: schema_columns.pop(table, (0, None))[1] for table in tables}
+        if any(get_table_columns(table) != old[table] for table in tables):
+            print('table schema changed, retry.', tables)
+            return func()
+        raise
+
+def cache_encode(value):
+    return cache_codec.encode(value, settings.CACHE_CODEC == 'columnar', settings.CACHE_COMPRESS_THRESHOLD,
+        settings.CACHE_COMPRESS_LEVEL, settings.CACHE_COLUMNAR_MIN_ROWS)
+
 def cache_get(key:str):
     try:
-        r = redis.StrictRedis(connection_pool=redis_pool)
-        ret = r.get(key)
+        ret = local_cache.get(key)
+        if ret == None:
+            r = redis.StrictRedis(connection_pool=redis_binary_pool)
+            ret = r.get(key)
+            if ret:
+                local_cache.set(key, ret)
         if ret:
-            ret = json.loads(ret)
+            ret = cache_codec.decode(ret)
         return ret
     except Exception as e:
         print('cache get failed.', repr(e))
@@ -185,16 +225,52 @@ def cache_get(key:str):
 
 def cache_set(key:str, value, ttl:int = settings.CACHE_BASE_TTL):
     try:
-        r = redis.StrictRedis(connection_pool=redis_pool)
+        r = redis.StrictRedis(connection_pool=redis_binary_pool)
+        value = cache_encode(value)
+        local_cache.set(key, value, ttl)
         if ttl == 0:
-            return r.set(key, json.dumps(value))
-        return r.setex(key, ttl, json.dumps(value))
+            return r.set(key, value)
+        return r.setex(key, ttl, value)
     except Exception as e:
         print('cache set failed.', repr(e) , key, ttl, value)
         return None
 
+# 批量读取，返回与 keys 顺序一致的列表，不存在的为 None
+def cache_mget(keys:list):
+    rets = [local_cache.get(key) for key in keys]
+    try:
+        misses = [i for i, ret in enumerate(rets) if ret == None]
+        if len(misses) > 0:
+            r = redis.StrictRedis(connection_pool=redis_binary_pool)
+            for i, ret in zip(misses, r.mget([keys[i] for i in misses])):
+                if ret:
+                    local_cache.set(keys[i], ret)
+                    rets[i] = ret
+        return [cache_codec.decode(ret) if ret else None for ret in rets]
+    except Exception as e:
+        print('cache mget failed.', repr(e))
+        return [None] * len(keys)
+
+# 批量写入，mapping 为 {key: value}，通过一次 pipeline 提交
+def cache_mset(mapping:dict, ttl:int = settings.CACHE_BASE_TTL):
+    try:
+        r = redis.StrictRedis(connection_pool=redis_binary_pool)
+        pipe = r.pipeline(transaction=False)
+        for key, value in mapping.items():
+            value = cache_encode(value)
+            local_cache.set(key, value, ttl)
+            if ttl == 0:
+                pipe.set(key, value)
+            else:
+                pipe.setex(key, ttl, value)
+        return pipe.execute()
+    except Exception as e:
+        print('cache mset failed.', repr(e), list(mapping.keys()), ttl)
+        return None
+
 def cache_delete(key:str):
     try:
+        local_cache.delete(key)
         r = redis.StrictRedis(connection_pool=redis_pool)
         return r.delete(key)
     except Exception as e:
@@ -246,7 +322,12 @@ def cache_dump(key:str):
             'ttl': r.ttl(key)
         }
         if key_type == 'string':
-            details['value'] = r.get(key)
+            # 字符串可能是 cache_codec 编码的二进制数据，无法解码时按原始文本返回
+            value = redis.StrictRedis(connection_pool=redis_binary_pool).get(key)
+            try:
+                details['value'] = cache_codec.decode(value)
+            except ValueError:
+                details['value'] = value.decode('utf-8', errors='replace')
         elif key_type == 'list':
             details['length'] = r.llen(key)
             details['value'] = r.lrange(key, 0, -1)
@@ -274,11 +355,19 @@ def cache_mysql_get_onevalue(sql:str, default = 0, ttl:int = settings.CACHE_BASE
     return ret
 
 def delete_mysql_select_cache(sql:str, obj = None, fetchObject = True):
-    key = settings.CACHEKEY_SQL + 'sl_' + myhash(sql + str(obj) + str(fetchObject))
+    key = mysql_select_cache_key(sql, obj, fetchObject)
+    # 其他 Lambda 的进程内缓存通过代数计数器失效
+    try:
+        local_cache.invalidate()
+    except Exception as e:
+        print('local cache invalidate failed.', repr(e))
     return cache_delete(key)
 
+def mysql_select_cache_key(sql:str, obj = None, fetchObject = True):
+    return settings.CACHEKEY_SQL + 'sl_' + myhash(sql + str(obj) + str(fetchObject))
+
 def cache_mysql_select(sql:str, obj = None, fetchObject = True, ttl:int = settings.CACHE_BASE_TTL):
-    key = settings.CACHEKEY_SQL + 'sl_' + myhash(sql + str(obj) + str(fetchObject))
+    key = mysql_select_cache_key(sql, obj, fetchObject)
     val = cache_get(key)
     if val != None:
         return val
@@ -313,15 +402,18 @@ def get_citys_by_country_code(country_code, cityset:int = 0):
     return cache_mysql_select(
         'SELECT name as id,name,latitude,longitude FROM city WHERE country_code = %s group by name', (country_code,))
 
-def get_cityobject(filter:str, obj = None, limit:int = 50):
-    return cache_mysql_select('''
+def get_cityobject_sql(filter:str, limit:int = 50):
+    return '''
 select c.id as cityId,a.asn as asn,c.country_code as country,
 COALESCE(c.friendly_name, c.name) as name,c.region as region,
 a.name as asnName, a.domain as domain,
 c.latitude as latitude, c.longitude as longitude,
 a.type as asnType,a.ipcounts as ipcounts,
 INET_NTOA(i.start_ip) as startIp, INET_NTOA(i.end_ip) as endIp from city as c, asn as a,iprange as i
- where c.id = i.city_id and c.asn=a.asn and ''' + filter + f' limit {limit}', obj)
+ where c.id = i.city_id and c.asn=a.asn and ''' + filter + f' limit {limit}'
+
+def get_cityobject(filter:str, obj = None, limit:int = 50):
+    return cache_mysql_select(get_cityobject_sql(filter, limit), obj)
 
 def get_asns_by_country(country_code, cityset:int = 0):
     if cityset != 0:
@@ -347,18 +439,72 @@ def get_asns_by_country_city(country_code, city_name, cityset:int = 0):
 ) group by c.id,c.asn''',(country_code,city_name,cityids)) #这里加了 ,c.asn 为了把多条cidr记录合并
     return get_cityobject("c.country_code = %s and c.name = %s group by c.id,c.asn",(country_code,city_name,))
 
-def get_cityobject_by_ip(ip:str):
+def load_iprange_rows():
+    # 使用流式游标读取，避免一次性把整个 iprange 表加载到内存
+    with mysql_connection(False) as conn, conn.cursor(pymysql.cursors.SSCursor) as cursor:
+        cursor.execute('select start_ip,end_ip,city_id from iprange order by start_ip')
+        for row in cursor:
+            yield row
+
+iprange_index = IPRangeIndex(redis_pool, settings.CACHEKEY_IPRANGE_VERSION, load_iprange_rows,
+    settings.IPRANGE_INDEX_FILE, settings.IPRANGE_INDEX_CHECK_INTERVAL)
+
+def refresh_iprange_index():
+    # 递增版本号，各Lambda在下次检查时重建索引
+    return iprange_index.bump_version()
+
+def get_cityobject_by_ip_from_db(ip:str):
     ipno = ipaddress.IPv4Address(ip)._ip
     return get_cityobject("i.start_ip<=%s and i.end_ip>=%s group by c.id", (ipno,ipno))
 
+def get_cityobject_by_ip(ip:str):
+    if not iprange_index.refresh():
+        return get_cityobject_by_ip_from_db(ip)
+    found = iprange_index.lookup(ipaddress.IPv4Address(ip)._ip)
+    if found == None:
+        return []
+    cityobj = get_cityobject_by_id(found[2])
+    if cityobj == None or len(cityobj) == 0:
+        return []
+    # 返回命中的ip段（相邻段已合并），而不是该city_id的任意一段
+    city = dict(cityobj[0])
+    city['startIp'] = str(ipaddress.IPv4Address(found[0]))
+    city['endIp'] = str(ipaddress.IPv4Address(found[1]))
+    return [city]
+
 def get_cityid_by_ip(ip:str):
-    cityobj = get_cityobject_by_ip(ip)
+    if iprange_index.refresh():
+        found = iprange_index.lookup(ipaddress.IPv4Address(ip)._ip)
+        return 0 if found == None else found[2]
+    cityobj = get_cityobject_by_ip_from_db(ip)
     if cityobj == None or len(cityobj) == 0:
         return 0
     return cityobj[0]['cityId']
 
+CITYOBJECT_BY_ID_FILTER = "c.id=%s group by c.id"
+
 def get_cityobject_by_id(id:int):
-    return get_cityobject("c.id=%s group by c.id",(id,),limit=1)
+    return get_cityobject(CITYOBJECT_BY_ID_FILTER,(id,),limit=1)
+
+# 批量获取 city 对象，返回 {id: cityobj}，找不到的 id 不返回
+# 缓存 key 与 get_cityobject_by_id 相同，先一次 mget 读取缓存，未命中的一次 in 查询，再一次 pipeline 回写缓存
+def get_cityobjects_by_ids(ids):
+    ids = list(dict.fromkeys(int(id) for id in ids))
+    sql = get_cityobject_sql(CITYOBJECT_BY_ID_FILTER, 1)
+    keys = [mysql_select_cache_key(sql, (id,)) for id in ids]
+    cityobjs = {}
+    misses = []
+    for id, val in zip(ids, cache_mget(keys)):
+        if val == None:
+            misses.append(id)
+        elif len(val) > 0:
+            cityobjs[id] = val[0]
+    if len(misses) > 0:
+        rows = mysql_select(get_cityobject_sql('c.id in (' + ','.join(['%s'] * len(misses)) + ') group by c.id', len(misses)), misses)
+        found = {row['cityId']: row for row in rows}
+        cache_mset({mysql_select_cache_key(sql, (id,)): [found[id]] if id in found else [] for id in misses})
+        cityobjs.update(found)
+    return cityobjs
 
 def get_cityobject_by_keyword(keyword:str, limit=200):
     if keyword.lower().startswith('as'):
@@ -373,30 +519,120 @@ def get_cityobject_by_keyword(keyword:str, limit=200):
         obj = (f"%{keyword}%",)
     return get_cityobject(filter, obj, limit)
 
-def get_latency_rawdata_cross_city(sourceCityId:str, destCityId:str, limit:int):
+RAWDATA_CURSOR_PATTERN = r'^\d+-\d+-\d+-\d+$'
+
+def make_rawdata_cursor(row):
+    return f"{row['update_time']}-{row['src']}-{row['dist']}-{row['slot']}"
+
+# 按 (update_time, src, dist, slot) 倒序做 keyset 分页，cursor 为上一页最后一行，不使用 OFFSET
+# 每页的 sql 参数不同，会单独缓存，翻页时不会重新执行整个查询
+# 返回 (rows, next_cursor)，没有下一页时 next_cursor 为 None
+def get_latency_rawdata_cross_city(sourceCityId:str, destCityId:str, limit:int, cursor:str = None):
     pattern = r'^[\d,]+$'
-    print('rawdata query with:', sourceCityId, destCityId, limit)
+    print('rawdata query with:', sourceCityId, destCityId, limit, cursor)
     if not bool(re.match(pattern, sourceCityId)) or not bool(re.match(pattern, destCityId)):
-        return None
-    return cache_mysql_select(f'''
-select src_city_id as src, dist_city_id as dist, samples, latency_min as min, latency_max as max,
+        return None, None
+    # 还没有执行 migrate_statistics_slot 的旧表没有槽位，按 0 处理，同一秒写入的同一 cityid 对的记录在分页边界可能被跳过
+    slot = 'slot' if has_column('statistics', 'slot') else '0'
+    lost = statistics_lost_column('statistics')
+    where = ''
+    params = None
+    if cursor:
+        if not bool(re.match(RAWDATA_CURSOR_PATTERN, cursor)):
+            return None, None
+        params = tuple(int(v) for v in cursor.split('-'))
+        where = f'and (update_time, src_city_id, dist_city_id, {slot}) < (FROM_UNIXTIME(%s), %s, %s, %s)'
+    # 多取一条判断是否还有下一页
+    rows = cache_mysql_select(f'''
+select src_city_id as src, dist_city_id as dist, {slot} as slot, samples, {lost} as lost, latency_min as min, latency_max as max,
 latency_avg as avg,latency_p50 as p50,latency_p70 as p70,latency_p90 as p90,latency_p95 as p95,
 UNIX_TIMESTAMP(update_time) as update_time from statistics where src_city_id in ({sourceCityId})
- and dist_city_id in ({destCityId}) order by update_time desc limit {limit}
-''')
+ and dist_city_id in ({destCityId}) {where}
+order by update_time desc, src_city_id desc, dist_city_id desc, {slot} desc limit {limit + 1}
+''', params)
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, make_rawdata_cursor(rows[-1])
+    return rows, None
+
+# lost 和 sketch 列由 admin migrate_statistics_columns 增加，迁移之前查询时丢包数按0处理，不写入这两列
+def statistics_lost_column(table:str):
+    return 'lost' if has_column(table, 'lost') else '0'
+
+def statistics_sketch_enabled(table = 'statistics'):
+    return settings.STATISTICS_SKETCH and has_column(table, 'sketch')
+
+# statistics_rollup 表只在 init.sql 中定义，重新上传 init.sql 创建表之前继续直接读写 statistics
+def statistics_rollup_enabled():
+    return settings.STATISTICS_ROLLUP and has_table('statistics_rollup')
 
 def get_latency_data_cross_city(sourceCityId:str, destCityId:str):
     pattern = r'^[\d,]+$'
     print('query with:', sourceCityId, destCityId)
     if not bool(re.match(pattern, sourceCityId)) or not bool(re.match(pattern, destCityId)):
         return None
+    if statistics_rollup_enabled():
+        # 直接读取写入时已汇总好的结果
+        return cache_mysql_select(f'''
+select src_city_id as src, dist_city_id as dist, samples, {statistics_lost_column('statistics_rollup')} as lost, latency_min as min, latency_max as max,
+latency_avg as avg, latency_p50 as p50, latency_p70 as p70, latency_p90 as p90, latency_p95 as p95,
+ewma_avg, ewma_p50, ewma_p95
+from statistics_rollup where src_city_id in ({sourceCityId}) and dist_city_id in ({destCityId})
+''')
     return cache_mysql_select(f'''
-select src_city_id as src, dist_city_id as dist, sum(samples) as samples,
+select src_city_id as src, dist_city_id as dist, sum(samples) as samples, sum({statistics_lost_column('statistics')}) as lost,
 min(latency_min) as min,max(latency_max) as max,avg(latency_avg) as avg,avg(latency_p50) as p50,
 avg(latency_p70) as p70,avg(latency_p90) as p90,avg(latency_p95) as p95
 from statistics where src_city_id in ({sourceCityId}) and dist_city_id in ({destCityId}) group by src_city_id,dist_city_id
 ''')
 
+# 返回 {(src, dist): LatencySketch}，没有 sketch 的 cityid 对不包含在结果中
+# sketch 用 base64 文本查询，结果可以和其他查询一样缓存
+def get_latency_sketches_cross_city(sourceCityId:str, destCityId:str):
+    pattern = r'^[\d,]+$'
+    if not bool(re.match(pattern, sourceCityId)) or not bool(re.match(pattern, destCityId)):
+        return None
+    table = 'statistics_rollup' if statistics_rollup_enabled() else 'statistics'
+    if not statistics_sketch_enabled(table):
+        return {}
+    rows = cache_mysql_select(f'''
+select src_city_id as src, dist_city_id as dist, TO_BASE64(sketch) as sketch
+from {table} where src_city_id in ({sourceCityId}) and dist_city_id in ({destCityId}) and sketch is not null
+''')
+    sketches = {}
+    for row in rows:
+        pair = (row['src'], row['dist'])
+        if pair not in sketches:
+            sketches[pair] = LatencySketch(settings.STATISTICS_SKETCH_ACCURACY)
+        sketches[pair].merge(LatencySketch.decode(base64.b64decode(row['sketch'])))
+    return sketches
+
+# 用原始样本（单位ms）生成延迟分布，保存时单位为us
+def make_latency_sketch(samples):
+    sketch = LatencySketch(settings.STATISTICS_SKETCH_ACCURACY)
+    for sample in samples:
+        sketch.add(sample * 1000)
+    return sketch
+
+def merge_latency_sketches(sketches):
+    ret = LatencySketch(settings.STATISTICS_SKETCH_ACCURACY)
+    for sketch in sketches:
+        ret.merge(sketch)
+    return ret
+
+# 延迟分布的汇总数据，与 get_latency_data_cross_city 返回的字段一致，单位us
+def latency_sketch_summary(sketch):
+    return {
+        'samples': sketch.count,
+        'min': sketch.min,
+        'max': sketch.max,
+        'avg': sketch.avg(),
+        'p50': sketch.quantile(50),
+        'p70': sketch.quantile(70),
+        'p90': sketch.quantile(90),
+        'p95': sketch.quantile(95),
+    }
+
 CITYSET_DEFAULT_CACHE_SQL = 'select id,name,cityids as cityIds from `cityset` order by length(cityids) desc, name'
 
 def get_citysets():
@@ -417,37 +653,375 @@ def del_cityset(id:int):
     delete_mysql_select_cache(CITYSET_DEFAULT_CACHE_SQL)
     return ret
 
-def check_expired_iprange(days, limit):
-    return mysql_select('select start_ip,end_ip,city_id from iprange where lastcheck_time < date_sub(now(), interval %s day) order by lastcheck_time limit %s', (days, limit))
+# 本周期还没有检查过的ip段（lastcheck_time 在周期开始之前）
+def check_expired_iprange(limit):
+    return mysql_select('select start_ip,end_ip,city_id from iprange where lastcheck_time < from_unixtime(%s) order by lastcheck_time limit %s', (pingable_epoch_start(), limit))
+
+# 当前的全局发现周期，每 PINGABLE_EPOCH_DAYS 天加1
+def pingable_epoch(now = None):
+    return int((now or time.time()) // 86400 // settings.PINGABLE_EPOCH_DAYS)
+
+# 周期开始的 unix 时间，ip段按周期边界过期（而不是距上次检查 PINGABLE_EPOCH_DAYS 天），每个周期都会检查一次
+# 否则检查时间逐渐后移，ip段会跳过某个周期，seen 中留下 0 位，一直可ping的ip也不再算作稳定
+def pingable_epoch_start(epoch = None):
+    return (epoch if epoch is not None else pingable_epoch()) * settings.PINGABLE_EPOCH_DAYS * 86400
+
+# 每个ip段在一个周期内检查一次，但检查时间不固定，上一个周期探测到的ip在本周期的ip段检查之前仍然算作存活
+# 返回 (存活的最小 last_epoch, 保留的最小 last_epoch)，last_epoch 小于后者的ip已经连续4个周期没有探测到，由 sweep_pingable 删除
+def pingable_epoch_bounds(epoch = None):
+    live = (epoch if epoch is not None else pingable_epoch()) - 1
+    return live, live - settings.PINGABLE_HISTORY_EPOCHS + 1
+
+# admin migrate_pingable_epoch 执行之前 pingable 表还是旧的 lastresult 位图：检查ip段时整体右移1位、删除为0的ip，探测到时置最高位
+# 旧表的状态页面 ping 计数不做增量更新，只由 reconcile_status_counters 定时重新统计
+def pingable_epoch_enabled(table:str = 'pingable'):
+    return has_column(table, 'last_epoch')
+
+status_counters = StatusCounters(redis_pool, settings.CACHEKEY_STATUS_COUNTERS)
+
+# 可ping ip 在当前周期中的状态：(存活, 稳定, 丢失, 未被清理)
+def pingable_state(last_epoch, seen, live:int, keep:int):
+    if last_epoch == None:
+        return (0, 0, 0, 0)
+    alive = last_epoch >= live
+    return (int(alive), int(alive and seen >= int(settings.STABLE_PINGABLE_IP)), int(keep <= last_epoch < live), int(last_epoch >= keep))
+
+def apply_status_counters(deltas:dict, cities:dict = None):
+    try:
+        status_counters.apply(pingable_epoch(), deltas, cities)
+    except Exception as e:
+        print('status counters apply failed.', repr(e), deltas)
+
+# 从数据库重新统计状态页面的计数，由 admin 定时调用，也在计数不存在或周期变化时调用
+def reconcile_status_counters():
+    epoch = pingable_epoch()
+    live, keep = pingable_epoch_bounds(epoch)
+    start = pingable_epoch_start(epoch)
+    if pingable_epoch_enabled():
+        alive, stable, loss, kept = f'last_epoch>={live}', f'last_epoch>={live} and seen>=' + settings.STABLE_PINGABLE_IP, \
+            f'last_epoch<{live} and last_epoch>={keep}', f'last_epoch>={keep}'
+    else:
+        alive, stable, loss, kept = 'lastresult>=' + settings.NEW_PINGABLE_IP, 'lastresult>=' + settings.STABLE_PINGABLE_IP, \
+            'lastresult<' + settings.NEW_PINGABLE_IP, 'lastresult>0'
+    values = {
+        'ping-stable': mysql_select_onevalue(f'select count(1) from pingable where {stable}'),
+        'ping-new': mysql_select_onevalue(f'select count(1) from pingable where {alive}'),
+        'ping-loss': mysql_select_onevalue(f'select count(1) from pingable where {loss}'),
+        'cityid-pair': mysql_select_onevalue('select count(distinct src_city_id, dist_city_id) from statistics'),
+        'cidr-ready': mysql_select_onevalue(f'select count(1) from iprange where lastcheck_time >= from_unixtime({start})'),
+        'cidr-outdated': mysql_select_onevalue(f'select count(1) from iprange where lastcheck_time < from_unixtime({start})'),
+    }
+    cities = {row[0]: row[1] for row in mysql_select(f'select city_id, count(1) from pingable where {kept} group by city_id', None, False)}
+    status_counters.reset(epoch, values, cities)
+    return {**values, 'cityid-ping': len(cities), 'epoch': epoch}
+
+# 读取状态页面的计数，没有计数或周期变化后先从数据库重新统计
+def get_status_counters():
+    counters = status_counters.load(pingable_epoch())
+    if counters == None:
+        counters = reconcile_status_counters()
+    return counters
 
 def update_pingable_result(city_id, start_ip, end_ip):
-    # 通过 start_ip end_ip city_id 来更新对应 pingable 表的数据，更新 lastresult 右移1位高位为0，表示这个ip最新数据没有更新了
-    mysql_execute('update pingable set lastresult=lastresult>>1 where city_id=%s and ip>=%s and ip<=%s', (city_id, start_ip, end_ip))
-    # 检查 pingable 表，删除 lastresult 全为 0 的条目，因为该ip已经连续不可ping了（就算新的任务他又可ping了，重新插入就是）
-    mysql_execute('delete from pingable where lastresult=' + settings.DELETE_PINGABLE_IP)
-    # 更新 lastcheck_time 时间，避免马上再次检查
-    mysql_execute('update iprange set lastcheck_time = CURRENT_TIMESTAMP where city_id=%s and start_ip=%s', (city_id, start_ip))
+    update_pingable_results([{'city_id': city_id, 'start_ip': start_ip, 'end_ip': end_ip}])
+
+# datas: check_expired_iprange 返回的 [{'city_id','start_ip','end_ip'}, ...]，所有ip段在一个事务中更新
+# 存活状态按周期计算，重新检查ip段时不需要改写 pingable 表的数据，只从可ping ip集合中删除这些ip，重新探测可ping后会再加入
+def update_pingable_results(datas):
+    if len(datas) == 0:
+        return
+    removed, checked = retry_on_schema_change(['pingable'], lambda: write_pingable_results(datas))
+    apply_status_counters({'cidr-ready': checked, 'cidr-outdated': -checked})
+    for city_id, ips in removed:
+        try:
+            pingable_pool.remove(city_id, ips)
+        except Exception as e:
+            print('pingable pool remove failed.', repr(e), city_id)
+
+def write_pingable_results(datas):
+    removed = []
+    with mysql_connection(True) as conn:
+        with conn.cursor() as cursor:
+            epoch_enabled = pingable_epoch_enabled()
+            for data in datas:
+                params = (data['start_ip'], data['end_ip'], data['city_id'])
+                cursor.execute('select ip from pingable where ip>=%s and ip<=%s and city_id=%s', params)
+                removed.append((data['city_id'], [row[0] for row in cursor.fetchall()]))
+                if not epoch_enabled:
+                    # 旧表：lastresult 右移1位，高位为0表示这个ip最新数据没有更新了，连续不可ping（全为0）的ip删除
+                    cursor.execute('update pingable set lastresult=lastresult>>1 where ip>=%s and ip<=%s and city_id=%s', params)
+                    cursor.execute('delete from pingable where ip>=%s and ip<=%s and city_id=%s and lastresult=0', params)
+            # 更新 lastcheck_time 时间，避免马上再次检查；已经被其他任务更新过的不再更新，更新的行数就是过期变为已检查的 ip 段数
+            keys = [(data['city_id'], data['start_ip']) for data in datas]
+            checked = cursor.execute('update iprange set lastcheck_time = CURRENT_TIMESTAMP where (city_id,start_ip) in (' + ','.join(['(%s,%s)'] * len(keys)) + ')'
+                + ' and lastcheck_time < from_unixtime(%s)', [value for key in keys for value in key] + [pingable_epoch_start()])
+        conn.commit()
+    return removed, checked
+
+# 删除 last_epoch 过旧的ip（连续4个周期没有探测到，就算新的任务他又可ping了，重新插入就是），按 last_epoch 索引分批删除
+def sweep_pingable(batch_size:int = settings.PINGABLE_SWEEP_BATCH, max_seconds:int = settings.PINGABLE_SWEEP_MAX_SECONDS):
+    live, keep = pingable_epoch_bounds()
+    if not pingable_epoch_enabled():
+        # 旧表在检查ip段时已经删除了连续不可ping的ip
+        return {'status': 200, 'msg': 'pingable has no last_epoch column, run migrate_pingable_epoch first'}
+    deleted = 0
+    start = time.time()
+    while time.time() - start < max_seconds:
+        with mysql_connection(True) as conn:
+            with conn.cursor() as cursor:
+                count = cursor.execute('delete from pingable where last_epoch < %s limit %s', (keep, batch_size))
+            conn.commit()
+        deleted += count
+        if count < batch_size:
+            break
+    return {
+        'status': 200,
+        'msg': {'epoch': live + 1, 'keep_epoch': keep, 'deleted': deleted}
+    }
+
+# seen 的最高位表示 last_epoch 周期探测到，再次探测到时按相差的周期数右移后置最高位，同一周期内重复探测不变
+PINGABLE_UPSERT_SQL = ('INSERT INTO `{}`(`ip`,`city_id`,`last_epoch`,`seen`) VALUES(%s, %s, %s, ' + settings.NEW_PINGABLE_IP + ') '
+    'ON DUPLICATE KEY UPDATE seen=IF(last_epoch < VALUES(last_epoch), (seen >> (VALUES(last_epoch) - last_epoch)) | ' + settings.NEW_PINGABLE_IP + ', seen), '
+    'last_epoch=GREATEST(last_epoch, VALUES(last_epoch))')
+PINGABLE_LEGACY_UPSERT_SQL = ('INSERT INTO `{}`(`ip`,`city_id`,`lastresult`) VALUES(%s, %s, ' + settings.NEW_PINGABLE_IP + ') '
+    'ON DUPLICATE KEY UPDATE lastresult=lastresult|' + settings.NEW_PINGABLE_IP)
+
+# rows: [(city_id, ip), ...]，整个 /job 请求的可ping ip 在一个事务中按 batch_size 分批多行写入
+def update_pingable_ips(rows, batch_size:int = settings.PINGABLE_BATCH_SIZE, table:str = 'pingable'):
+    # 按 ip 排序写入，多个 Lambda 并发时加锁顺序一致，减少死锁
+    values = sorted({(ipaddress.IPv4Address(ip)._ip, city_id) for city_id, ip in rows})
+    if len(values) == 0:
+        return 0
+    deltas, cities = retry_on_schema_change([table], lambda: write_pingable_ips(values, batch_size, table))
+    if table == 'pingable':
+        if deltas != None:
+            apply_status_counters({'ping-new': deltas[0], 'ping-stable': deltas[1], 'ping-loss': deltas[2]}, cities)
+        try:
+            pingable_pool.add([(city_id, ipno) for ipno, city_id in values])
+        except Exception as e:
+            print('pingable pool add failed.', repr(e))
+    return len(values)
+
+# 返回状态页面计数的变化 (deltas, cities)，旧表返回 (None, None)
+def write_pingable_ips(values:list, batch_size:int, table:str):
+    epoch = pingable_epoch()
+    live, keep = pingable_epoch_bounds(epoch)
+    if not pingable_epoch_enabled(table):
+        with mysql_connection(True) as conn:
+            with conn.cursor() as cursor:
+                for i in range(0, len(values), batch_size):
+                    cursor.executemany(PINGABLE_LEGACY_UPSERT_SQL.format(table), values[i:i + batch_size])
+            conn.commit()
+        return None, None
+    sql = PINGABLE_UPSERT_SQL.format(table)
+    deltas = [0, 0, 0]
+    cities = {}
+    with mysql_connection(True) as conn:
+        with conn.cursor() as cursor:
+            for i in range(0, len(values), batch_size):
+                batch = values[i:i + batch_size]
+                if table == 'pingable':
+                    # 写入前读取这些ip原来的状态（按主键查询并加锁），计算状态页面计数的变化
+                    cursor.execute('SELECT ip, city_id, last_epoch, seen FROM pingable WHERE ip IN (' + ','.join(['%s'] * len(batch)) + ') FOR UPDATE',
+                        [ipno for ipno, city_id in batch])
+                    olds = {row[0]: row[1:] for row in cursor.fetchall()}
+                    for ipno, city_id in batch:
+                        old_city, last_epoch, seen = olds.get(ipno, (city_id, None, 0))
+                        before = pingable_state(last_epoch, seen, live, keep)
+                        if last_epoch == None:
+                            last_epoch, seen = epoch, int(settings.NEW_PINGABLE_IP)
+                        elif last_epoch < epoch:
+                            last_epoch, seen = epoch, (seen >> (epoch - last_epoch)) | int(settings.NEW_PINGABLE_IP)
+                        olds[ipno] = (old_city, last_epoch, seen)
+                        after = pingable_state(last_epoch, seen, live, keep)
+                        for j in range(3):
+                            deltas[j] += after[j] - before[j]
+                        if after[3] > before[3]:
+                            cities[old_city] = cities.get(old_city, 0) + 1
+                # executemany 会把 INSERT ... VALUES 改写为一条多行语句
+                cursor.executemany(sql, [(ipno, city_id, epoch) for ipno, city_id in batch])
+        conn.commit()
+    return deltas, cities
 
 def update_pingable_ip(city_id, ips):
-    for ip in ips:
-        ipno = ipaddress.IPv4Address(ip)._ip
-        # 128 = 10000000b
-        mysql_execute('INSERT INTO `pingable`(`ip`,`city_id`,`lastresult`) VALUES(%s, %s, ' + settings.NEW_PINGABLE_IP + ') ON DUPLICATE KEY UPDATE lastresult=lastresult|' + settings.NEW_PINGABLE_IP, (ipno, city_id))
+    return update_pingable_ips([(city_id, ip) for ip in ips])
+
+def load_pingable_pool_ips(city_id):
+    if not pingable_epoch_enabled():
+        rows = mysql_select('SELECT ip FROM pingable where city_id=%s and lastresult>=' + settings.NEW_PINGABLE_IP, (city_id,), False)
+    else:
+        rows = mysql_select('SELECT ip FROM pingable where city_id=%s and last_epoch>=%s', (city_id, pingable_epoch_bounds()[0]), False)
+    return [row[0] for row in rows]
+
+def load_pingable_cities():
+    if not pingable_epoch_enabled():
+        rows = mysql_select('SELECT city_id FROM pingable where lastresult>=' + settings.NEW_PINGABLE_IP + ' GROUP BY city_id', None, False)
+    else:
+        rows = mysql_select('SELECT city_id FROM pingable where last_epoch>=%s GROUP BY city_id', (pingable_epoch_bounds()[0],), False)
+    return [row[0] for row in rows]
+
+pingable_pool = PingablePool(redis_pool, settings.CACHEKEY_PINGABLE_POOL, settings.CACHEKEY_PINGABLE_CITIES,
+    load_pingable_pool_ips, load_pingable_cities, settings.PINGABLE_POOL_TTL)
+
+# statistics 表中除 cityid 对和槽位外的数据列，lost 和 sketch 只在表中已经有这两列时写入
+STATISTICS_DATA_COLUMNS = ['samples', 'latency_min', 'latency_max', 'latency_avg',
+    'latency_p50', 'latency_p70', 'latency_p90', 'latency_p95']
+
+def get_statistics_data_columns():
+    columns = list(STATISTICS_DATA_COLUMNS)
+    if has_column('statistics', 'lost'):
+        columns.append('lost')
+    if statistics_sketch_enabled():
+        columns.append('sketch')
+    return columns
+
+def make_statistics_insert_sql(columns:list):
+    return 'INSERT INTO `statistics`(src_city_id,dist_city_id,' + ','.join(columns) + \
+        ') VALUES(%(src_city_id)s,%(dist_city_id)s,' + ','.join(f'%({key})s' for key in columns) + ')'
+
+def make_statistics_slot_upsert_sql(columns:list):
+    return 'INSERT INTO `statistics`(src_city_id,dist_city_id,slot,' + ','.join(columns) + \
+        ') VALUES(%(src_city_id)s,%(dist_city_id)s,%(slot)s,' + ','.join(f'%({key})s' for key in columns) + \
+        ') ON DUPLICATE KEY UPDATE ' + ','.join(f'{key}=VALUES({key})' for key in columns) + ',update_time=CURRENT_TIMESTAMP'
 
 def update_statistics_data(datas):
-    return mysql_execute('''INSERT INTO `statistics`(src_city_id,dist_city_id,samples,latency_min,latency_max,latency_avg,
-latency_p50,latency_p70,latency_p90,latency_p95)
-VALUES(%(src_city_id)s,%(dist_city_id)s,%(samples)s,%(latency_min)s,%(latency_max)s,%(latency_avg)s,
-%(latency_p50)s,%(latency_p70)s,%(latency_p90)s,%(latency_p95)s)''',datas)
-
-def delete_oldest_statistics_data(src_city_id, dist_city_id, limit = settings.MAX_RECORDS_PER_CITYID):
-    return mysql_execute('''DELETE FROM `statistics`
-WHERE (src_city_id = %s AND dist_city_id = %s) 
-AND update_time NOT IN (
-    SELECT update_time FROM (
-        SELECT update_time FROM `statistics` WHERE src_city_id = %s AND dist_city_id = %s
-        ORDER BY update_time DESC LIMIT %s) t
-);''', (src_city_id, dist_city_id, src_city_id, dist_city_id, limit))
+    return update_statistics_datas([datas])
+
+# 在写入前调用，返回 statistics 中还没有数据的 cityid 对数量，用于维护状态页面的 cityid-pair 计数
+def count_new_statistics_pairs(cursor, pairs:list):
+    cursor.execute('SELECT src_city_id, dist_city_id FROM `statistics` WHERE (src_city_id, dist_city_id) IN ('
+        + ','.join(['(%s,%s)'] * len(pairs)) + ') GROUP BY src_city_id, dist_city_id', [id for pair in pairs for id in pair])
+    return len(pairs) - len(cursor.fetchall())
+
+# 为每条数据分配槽位：cityid对的槽位未用满时取最小的空槽位，否则覆盖 update_time 最旧的槽位
+def assign_statistics_slots(cursor, datas:list, pairs:list, limit:int):
+    # 锁住涉及的cityid对，避免同城市的多个探测点并发写入时选中同一个槽位
+    cursor.execute('SELECT src_city_id, dist_city_id, slot, update_time FROM `statistics` WHERE (src_city_id, dist_city_id) IN ('
+        + ','.join(['(%s,%s)'] * len(pairs)) + ') FOR UPDATE', [id for pair in pairs for id in pair])
+    slots = {pair: {} for pair in pairs}
+    for src_city_id, dist_city_id, slot, update_time in cursor.fetchall():
+        if slot < limit:
+            slots[(src_city_id, dist_city_id)][slot] = update_time
+    rows = []
+    for data in datas:
+        used = slots[(data['src_city_id'], data['dist_city_id'])]
+        if len(used) < limit:
+            slot = min(set(range(limit)) - used.keys())
+        else:
+            slot = min(used, key=lambda x: (used[x], x))
+        # 本批次刚写入的槽位视为最新
+        used[slot] = datetime.max
+        rows.append({**data, 'slot': slot})
+    return rows
+
+# 按最新数据更新 cityid 对的指数加权移动平均，同一批次中同一 cityid 对的多条数据会依次累计
+STATISTICS_EWMA_UPSERT_SQL = '''INSERT INTO `statistics_rollup`(src_city_id,dist_city_id,ewma_avg,ewma_p50,ewma_p95)
+VALUES(%(src_city_id)s,%(dist_city_id)s,%(latency_avg)s,%(latency_p50)s,%(latency_p95)s)
+ON DUPLICATE KEY UPDATE ''' + ','.join(f'{key}={key}*{1 - settings.STATISTICS_EWMA_ALPHA}+VALUES({key})*{settings.STATISTICS_EWMA_ALPHA}'
+    for key in ('ewma_avg', 'ewma_p50', 'ewma_p95'))
+
+# 从 statistics 重新汇总 cityid 对的数据，pairs 为 None 时汇总全部，reset_ewma 时指数加权移动平均也重置为汇总平均值
+# 两个表都有 lost 列时才汇总丢包数
+def refresh_statistics_rollup(cursor, pairs = None, reset_ewma = False):
+    lost = has_column('statistics', 'lost') and has_column('statistics_rollup', 'lost')
+    sql = f'''INSERT INTO `statistics_rollup`(src_city_id,dist_city_id,records,samples,{'lost,' if lost else ''}latency_min,latency_max,latency_avg,
+latency_p50,latency_p70,latency_p90,latency_p95,ewma_avg,ewma_p50,ewma_p95)
+SELECT src_city_id,dist_city_id,count(1),sum(samples),{'sum(lost),' if lost else ''}min(latency_min),max(latency_max),avg(latency_avg),
+avg(latency_p50),avg(latency_p70),avg(latency_p90),avg(latency_p95),avg(latency_avg),avg(latency_p50),avg(latency_p95)
+FROM `statistics` '''
+    params = None
+    if pairs != None:
+        sql += 'WHERE (src_city_id, dist_city_id) IN (' + ','.join(['(%s,%s)'] * len(pairs)) + ') '
+        params = [id for pair in pairs for id in pair]
+    sql += f'''GROUP BY src_city_id,dist_city_id
+ON DUPLICATE KEY UPDATE records=VALUES(records),samples=VALUES(samples),{'lost=VALUES(lost),' if lost else ''}latency_min=VALUES(latency_min),
+latency_max=VALUES(latency_max),latency_avg=VALUES(latency_avg),latency_p50=VALUES(latency_p50),
+latency_p70=VALUES(latency_p70),latency_p90=VALUES(latency_p90),latency_p95=VALUES(latency_p95)'''
+    if reset_ewma:
+        sql += ',ewma_avg=VALUES(ewma_avg),ewma_p50=VALUES(ewma_p50),ewma_p95=VALUES(ewma_p95)'
+    cursor.execute(sql, params)
+
+# 合并 cityid 对所有记录的延迟分布，保存到汇总表，没有 sketch 的旧记录不参与合并
+def refresh_statistics_rollup_sketch(cursor, pairs:list):
+    cursor.execute('SELECT src_city_id, dist_city_id, sketch FROM `statistics` WHERE (src_city_id, dist_city_id) IN ('
+        + ','.join(['(%s,%s)'] * len(pairs)) + ') AND sketch IS NOT NULL', [id for pair in pairs for id in pair])
+    sketches = {}
+    for src_city_id, dist_city_id, sketch in cursor.fetchall():
+        pair = (src_city_id, dist_city_id)
+        if pair not in sketches:
+            sketches[pair] = LatencySketch(settings.STATISTICS_SKETCH_ACCURACY)
+        sketches[pair].merge(LatencySketch.decode(sketch))
+    if len(sketches) > 0:
+        cursor.executemany('UPDATE `statistics_rollup` SET sketch=%s WHERE src_city_id=%s AND dist_city_id=%s',
+            [(sketch.encode(), src_city_id, dist_city_id) for (src_city_id, dist_city_id), sketch in sketches.items()])
+
+# 写入 statistics 后，在同一事务中更新涉及的 cityid 对的汇总数据
+def update_statistics_rollup(cursor, datas:list, pairs:list):
+    cursor.executemany(STATISTICS_EWMA_UPSERT_SQL, datas)
+    refresh_statistics_rollup(cursor, pairs)
+    if statistics_sketch_enabled() and statistics_sketch_enabled('statistics_rollup'):
+        refresh_statistics_rollup_sketch(cursor, pairs)
+
+# 从头重建 statistics_rollup 表的数据，表结构只在 init.sql 中定义，表不存在时返回 None
+def rebuild_statistics_rollup():
+    with mysql_connection(True) as conn:
+        with conn.cursor() as cursor:
+            if cursor.execute("SHOW TABLES LIKE 'statistics_rollup'") == 0:
+                return None
+            # 表可能刚由 init.sql 创建或刚执行过迁移
+            clear_table_columns()
+            refresh_statistics_rollup(cursor, None, True)
+            if statistics_sketch_enabled() and statistics_sketch_enabled('statistics_rollup'):
+                cursor.execute('SELECT src_city_id, dist_city_id FROM `statistics_rollup`')
+                pairs = cursor.fetchall()
+                for i in range(0, len(pairs), settings.PINGABLE_BATCH_SIZE):
+                    refresh_statistics_rollup_sketch(cursor, pairs[i:i + settings.PINGABLE_BATCH_SIZE])
+            # 删除 statistics 中已经不存在的 cityid 对
+            cursor.execute('''DELETE r FROM `statistics_rollup` r LEFT JOIN `statistics` s
+ON r.src_city_id = s.src_city_id AND r.dist_city_id = s.dist_city_id WHERE s.src_city_id IS NULL''')
+            cursor.execute('SELECT count(1) FROM `statistics_rollup`')
+            ret = cursor.fetchone()[0]
+        conn.commit()
+    return ret
+
+# 还没有执行 migrate_statistics_slot 的旧表没有槽位：插入后找到每个 cityid 对第 limit 新的 update_time，删除比它更旧的记录
+def delete_oldest_statistics_datas(cursor, pairs:list, limit:int):
+    params = [id for pair in pairs for id in pair]
+    params.append(limit)
+    cursor.execute('''DELETE s FROM `statistics` s JOIN (
+    SELECT src_city_id, dist_city_id, update_time FROM (
+        SELECT src_city_id, dist_city_id, update_time,
+        ROW_NUMBER() OVER (PARTITION BY src_city_id, dist_city_id ORDER BY update_time DESC) AS rn
+        FROM `statistics` WHERE (src_city_id, dist_city_id) IN (''' + ','.join(['(%s,%s)'] * len(pairs)) + ''')
+    ) t WHERE rn = %s
+) c ON s.src_city_id = c.src_city_id AND s.dist_city_id = c.dist_city_id AND s.update_time < c.update_time''', params)
+
+def write_statistics_datas(datas:list, pairs:list, limit:int):
+    with mysql_connection(True) as conn:
+        with conn.cursor() as cursor:
+            if has_column('statistics', 'slot'):
+                # 按 (src_city_id, dist_city_id, slot) 覆盖最旧的记录，不需要删除
+                rows = assign_statistics_slots(cursor, datas, pairs, limit)
+                created = count_new_statistics_pairs(cursor, pairs)
+                cursor.executemany(make_statistics_slot_upsert_sql(get_statistics_data_columns()), rows)
+            else:
+                created = count_new_statistics_pairs(cursor, pairs)
+                cursor.executemany(make_statistics_insert_sql(get_statistics_data_columns()), datas)
+                delete_oldest_statistics_datas(cursor, pairs, limit)
+            if statistics_rollup_enabled():
+                update_statistics_rollup(cursor, datas, pairs)
+        conn.commit()
+    return created
+
+# 一次 /job 请求的所有 data 任务结果，一条多行语句写入，每个 cityid 对固定 limit 个槽位，新数据覆盖最旧的槽位
+# data 任务没有租约，写入失败结果就丢失了，迁移前后都必须能写入
+def update_statistics_datas(datas:list, limit = settings.MAX_RECORDS_PER_CITYID):
+    if len(datas) == 0:
+        return 0
+    pairs = sorted({(data['src_city_id'], data['dist_city_id']) for data in datas})
+    created = retry_on_schema_change(['statistics', 'statistics_rollup'], lambda: write_statistics_datas(datas, pairs, limit))
+    apply_status_counters({'cityid-pair': created})
+    return len(datas)
 
 def friendly_intval(sec:int):
     if sec > 86400:
@@ -504,100 +1078,128 @@ def friendly_cityasn(city):
 # 稳定可ping数量，新增可ping数量，最近不可ping数量
 # 可用cidr数量，过期cidr数量，cidr队列长度
 # 已知cityid数量，可ping的cityid数量，有数据的cityid pair数量
-def query_statistics_data(datas = ''):
-    if datas == '':
-        datas = 'all-country,all-city,all-asn,ping-stable,ping-new,ping-loss,cidr-ready,cidr-outdated,cidr-queue,cityid-all,cityid-ping,cityid-pair,ping-clients,data-clients,speed-ping-get,speed-ping-set,speed-data-get,speed-data-set'
+# 批量查询在线客户端所在的城市，返回 {ip: cityobj}，使用内存索引时只需要一次批量查询 city 对象
+def get_cityobjects_by_ips(ips):
+    if not iprange_index.refresh():
+        cityobjs = {}
+        for ip in ips:
+            city = get_cityobject_by_ip_from_db(ip)
+            if city and len(city) > 0:
+                cityobjs[ip] = city[0]
+        return cityobjs
+    founds = {ip: iprange_index.lookup(ipaddress.IPv4Address(ip)._ip) for ip in ips}
+    cities = get_cityobjects_by_ids(found[2] for found in founds.values() if found != None)
+    cityobjs = {}
+    for ip, found in founds.items():
+        if found != None and found[2] in cities:
+            city = dict(cities[found[2]])
+            city['startIp'] = str(ipaddress.IPv4Address(found[0]))
+            city['endIp'] = str(ipaddress.IPv4Address(found[1]))
+            cityobjs[ip] = city
+    return cityobjs
+
+# 在线客户端列表：城市一次批量查询，任务队列长度和处理能力一次 pipeline 读取
+def query_online_clients(agent:str):
+    ping_tracker = OnlineIPTracker(redis_pool, settings.CACHEKEY_ONLINE_SERVERS + agent)
+    online = ping_tracker.get_online_ips()
+    cityobjs = get_cityobjects_by_ips([ip for ip, timestamp in online])
+    online = [(ip, timestamp) for ip, timestamp in online if ip in cityobjs]
+    capacities = DetectorCapacity.get_batch_metrics(redis_pool, settings.CACHEKEY_DETECTOR + agent, [ip for ip, timestamp in online], settings.DETECTOR_BATCH[agent][0])
+    queues = []
+    if agent == 'data' and len(online) > 0:
+        pipe = redis.StrictRedis(connection_pool=redis_pool).pipeline(transaction=False)
+        for ip, timestamp in online:
+            pipe.llen(settings.CACHEKEY_CITYJOB + str(cityobjs[ip]['cityId']))
+        queues = pipe.execute()
+    clients = []
+    for i, (ip, timestamp) in enumerate(online):
+        msg = friendly_intval(time.time() - timestamp)
+        if agent == 'data':
+            msg += ', Queue: ' + str(queues[i])
+        msg += f", Batch: {capacities[ip]['batch']}, Turnaround: {capacities[ip]['turnaround']}s"
+        clients.append({
+            'ip': ip,
+            'region': friendly_cityandasnno(cityobjs[ip]),
+            'status': msg
+        })
+    return clients
+
+def query_statistics_value(data:str):
+    if data == 'cidr-queue':
+        return cache_listlen(settings.CACHEKEY_PINGABLE)
+    if data == 'cidr-inflight':
+        return ping_job_queue.inflight()
+    if data == 'cache-local':
+        # 当前 Lambda 实例的进程内缓存命中情况
+        return local_cache.get_metrics()
+    if data in {'speed-ping-get','speed-ping-set','speed-data-get','speed-data-set'}:
+        return SpeedCounter(redis_pool, settings.CACHEKEY_RECENT_TASKS + data).get_count()
+    if data in {'ping-clients','data-clients'}:
+        return query_online_clients(data[:4])
     supports = {
         'all-country':'select count(1) from country',
         'all-city':'select count(1) from (select country_code,name from city group by country_code,name) as a',
         'all-asn':'select count(1) from asn',
-        'ping-stable':'select count(1) from pingable where lastresult>=' + settings.STABLE_PINGABLE_IP,
-        'ping-new':'select count(1) from pingable where lastresult>=' + settings.NEW_PINGABLE_IP,
-        'ping-loss':'select count(1) from pingable where lastresult<=' + settings.LOSS_PINGABLE_IP,
-
-        'cidr-ready':'select count(1) from iprange where lastcheck_time >= date_sub(now(), interval 14 day)',
-        'cidr-outdated':'select count(1) from iprange where lastcheck_time < date_sub(now(), interval 14 day)',
-
         'cityid-all':'select count(1) from city',
-        'cityid-ping':'select count(distinct city_id) from pingable where lastresult>' + settings.DELETE_PINGABLE_IP,
-        'cityid-pair':'select count(distinct src_city_id, dist_city_id) from statistics',
-        # 'select count(1) from (select 1 from statistics group by src_city_id, dist_city_id) as a'
     }
-    outs = {}
-    for data in datas.split(','):
-        if data == 'cidr-queue':
-            outs[data] = cache_listlen(settings.CACHEKEY_PINGABLE)
-        elif data in {'speed-ping-get','speed-ping-set','speed-data-get','speed-data-set'}:
-            speed_counter = SpeedCounter(redis_pool, settings.CACHEKEY_RECENT_TASKS + data)
-            outs[data] = speed_counter.get_count()
-        elif data in {'ping-clients','data-clients'}:
-            ping_tracker = OnlineIPTracker(redis_pool, settings.CACHEKEY_ONLINE_SERVERS + data[:4])
-            ping_clients = []
-            for ip, timestamp in ping_tracker.get_online_ips():
-                city = get_cityobject_by_ip(ip)
-                if city and len(city) > 0:
-                    msg = friendly_intval(time.time() - timestamp)
-                    if data == 'data-clients':
-                        msg += ', Queue: ' + str(cache_listlen(settings.CACHEKEY_CITYJOB + str(city[0]['cityId'])))
-                    ping_clients.append({
-                        'ip': ip,
-                        'region': friendly_cityandasnno(city[0]),
-                        'status': msg
-                    })
-            outs[data] = ping_clients
-        else:
-            outs[data] = mysql_select_onevalue(supports[data])
-    return outs
+    return mysql_select_onevalue(supports[data])
+
+# 每项统计的缓存分组：数据库计数变化慢，缓存时间长；队列、速度和在线客户端缓存几秒
+# 进程内缓存指标和写入时维护的计数（一次读取 redis 哈希表）不缓存
+def statistics_cache_group(data:str):
+    if data == 'cache-local' or data in StatusCounters.FIELDS:
+        return None
+    if data in {'ping-clients','data-clients'}:
+        return 'clients'
+    if data.startswith('speed-') or data in {'cidr-queue','cidr-inflight'}:
+        return 'redis'
+    return 'db'
+
+# 先一次 mget 读取缓存，未命中的统计项在线程池中并发查询，再按分组的缓存时间回写
+def query_statistics_data(datas = ''):
+    if datas == '':
+        datas = 'all-country,all-city,all-asn,ping-stable,ping-new,ping-loss,cidr-ready,cidr-outdated,cidr-queue,cidr-inflight,cityid-all,cityid-ping,cityid-pair,ping-clients,data-clients,speed-ping-get,speed-ping-set,speed-data-get,speed-data-set,cache-local'
+    datas = list(dict.fromkeys(datas.split(',')))
+    cached = [data for data in datas if statistics_cache_group(data) != None]
+    outs = {data: value for data, value in zip(cached, cache_mget([settings.CACHEKEY_STATISTICS + data for data in cached])) if value != None}
+    if any(data in StatusCounters.FIELDS for data in datas):
+        counters = get_status_counters()
+        outs.update({data: counters[data] for data in datas if data in StatusCounters.FIELDS})
+    misses = [data for data in datas if data not in outs]
+    if len(misses) > 0:
+        if any(statistics_cache_group(data) == 'clients' for data in misses):
+            # 先在当前线程加载 iprange 索引，避免多个线程同时重建
+            iprange_index.refresh()
+        with ThreadPoolExecutor(max_workers=min(settings.STATISTICS_WORKERS, len(misses))) as executor:
+            for data, value in zip(misses, executor.map(query_statistics_value, misses)):
+                outs[data] = value
+        for group, ttl in settings.STATISTICS_CACHE_TTL.items():
+            mapping = {settings.CACHEKEY_STATISTICS + data: outs[data] for data in misses if statistics_cache_group(data) == group}
+            if len(mapping) > 0:
+                cache_mset(mapping, ttl)
+    return {data: outs[data] for data in datas}
+
+sqs_client = None
+
+# 所有线程和请求共用一个 SQS 客户端，第一次使用时创建
+def get_sqs_client():
+    global sqs_client
+    if sqs_client is None:
+        sqs_client = boto3.client('sqs')
+    return sqs_client
 
 def send_sqs_messages_batch(queue_url: str, messages: List[Dict[str, Any]]) -> Dict:
     """
-    批量发送 JSON 消息到 SQS 队列
+    批量发送 JSON 消息到 SQS 队列，按条数和 256KB 限制打包后在线程池中并发发送，失败的条目按指数退避重试
     Args:
         queue_url (str): SQS 队列的 URL
         messages (List[Dict]): JSON 消息列表
     
     Returns:
-        Dict: 发送结果，包含成功和失败的消息
+        Dict: 发送结果，包含成功和失败的消息，以及批次数和重试次数
     """
-    sqs = boto3.client('sqs')
-    # 准备批量发送的条目，将消息转换为 JSON 字符串
-    entries = [
-        {
-            'Id': str(i),  # 批次中消息的唯一标识
-            'MessageBody': json.dumps(message)  # 将字典转换为 JSON 字符串
-        }
-        for i, message in enumerate(messages)
-    ]
-    # 每批最多发送 10 条消息
-    results = {
-        'successful': [],
-        'failed': []
-    }
-    # 分批处理
-    for i in range(0, len(entries), 10):
-        batch = entries[i:i + 10]
-        try:
-            response = sqs.send_message_batch(
-                QueueUrl=queue_url,
-                Entries=batch
-            )
-            # 收集结果
-            if 'Successful' in response:
-                results['successful'].extend(response['Successful'])
-            if 'Failed' in response:
-                results['failed'].extend(response['Failed'])                
-        except Exception as e:
-            # 如果整个批次发送失败，将所有消息标记为失败
-            failed_messages = [
-                {
-                    'Id': entry['Id'],
-                    'Error': str(e)
-                }
-                for entry in batch
-            ]
-            results['failed'].extend(failed_messages)
-    return results
-
+    sender = SqsBatchSender(get_sqs_client(), settings.SQS_SEND_WORKERS, settings.SQS_SEND_RETRIES)
+    return sender.send(queue_url, messages)
 
 def get_sqs_queue_size(queue_url: str) -> dict:
     """
@@ -608,8 +1210,7 @@ def get_sqs_queue_size(queue_url: str) -> dict:
         dict: 包含队列大小信息的字典
     """
     try:
-        # 创建 SQS 客户端
-        sqs = boto3.client('sqs')
+        sqs = get_sqs_client()
         # 获取队列属性
         response = sqs.get_queue_attributes(
             QueueUrl=queue_url,
@@ -655,52 +1256,107 @@ def split_ip_range(start_ip, end_ip, step = 16384):
         i += step
     return subnets
 
+def iprange_ping_jobs(datas):
+    messages = []
+    for data in datas:
+        for subnet in split_ip_range(data['start_ip'], data['end_ip']):
+            messages.append({"type": "pingable", "start_ip": subnet[0], "end_ip": subnet[1], "city_id": data['city_id']})
+    return messages
+
 # 由于 lambda 中 运行 fping 权限不够，所以不使用cron运行了，改为本地运行，因此使用redis队列来传递任务，通过api获取任务
+# 使用 redis 队列时由 produce_ping_jobs 补充任务，/job 请求只取任务
 def refresh_iprange_check(queue_url = ''):
+    if queue_url == '':
+        return produce_ping_jobs()
     max_buffer_cidr = 100
-    if queue_url != '':
-        # 获取队列大小
-        result = get_sqs_queue_size(queue_url)
-        # print(result)
-        if result['statusCode'] != 200:
-            return {
-                'status': result['statusCode'],
-                'msg': result['error']
-            }
-        len = result['queue_size']['visible_messages']
-    else:
-        # 检查 redis 队列长度
-        len = cache_listlen(settings.CACHEKEY_PINGABLE)
+    # 获取队列大小
+    result = get_sqs_queue_size(queue_url)
+    # print(result)
+    if result['statusCode'] != 200:
+        return {
+            'status': result['statusCode'],
+            'msg': result['error']
+        }
+    len = result['queue_size']['visible_messages']
     if len >= max_buffer_cidr:
         return {
             'status': 200,
             'msg': 'Queue is full, skip this round check'
         }
 
-    # 检查 iprange 表，根据 lastcheck_time 排序，找出 lastcheck_time < now - 7days 的数据，准备进行更新
-    datas = check_expired_iprange(days=14, limit=20)
-    # print(datas)
-    # 通过 start_ip end_ip city_id 来更新对应 pingable 表的数据，更新 lastresult 右移1位高位为0，表示这个ip最新数据没有更新了
-    # 检查 pingable 表，删除 lastresult 全为 0 的条目，因为该ip已经连续不可ping了（就算新的任务他又可ping了，重新插入就是）
-    messages = []
-    for data in datas:
-        # print(data)
-        update_pingable_result(data['city_id'], data['start_ip'], data['end_ip'])
-        subnets = split_ip_range(data['start_ip'], data['end_ip'])
-        for subnet in subnets:
-            messages.append({"type": "pingable", "start_ip": subnet[0], "end_ip": subnet[1], "city_id": data['city_id']})
-    # 提交 start_ip end_ip city_id 的 ping 探测任务到 queue 中，queue 陆续完成探测任务时，会去更新对应 ip 的 lastresult 值，把新移位的值置为1000b，不存在的会插入
-    if queue_url != '':
-        result = send_sqs_messages_batch(queue_url, messages)
-        # print(result)
-    else:
-        for message in messages:
-            result = cache_push(settings.CACHEKEY_PINGABLE, message)
+    # 检查 iprange 表，根据 lastcheck_time 排序，找出本周期还没有检查过的数据，准备进行更新
+    datas = check_expired_iprange(limit=20)
+    update_pingable_results(datas)
+    # 提交 start_ip end_ip city_id 的 ping 探测任务到 queue 中，queue 陆续完成探测任务时，会更新对应 ip 的 last_epoch 和 seen，不存在的会插入
+    result = send_sqs_messages_batch(queue_url, iprange_ping_jobs(datas))
     return {
         'status': 200,
         'msg': result
     }
 
+ping_producer_lock = FencedLock(redis_pool, '{' + settings.CACHEKEY_PINGABLE + '}:lock', settings.PING_PRODUCER_LOCK_SECONDS)
+
+# 补充 ping 任务直到队列达到 high_water，由 admin Lambda 定时执行
+# 持有锁才执行，同一时间只有一个实例检查过期的ip段，不会重复下发同一个ip段
+# 每一轮先延长锁，写入队列时校验 fencing token，锁过期被其他实例取得后本实例的任务写入失败并停止
+# 先写入队列再更新数据库，数据库更新失败时ip段下次还会被选中，只会多探测一次，不会漏掉
+def produce_ping_jobs(high_water:int = settings.PING_QUEUE_HIGH_WATER, max_seconds:int = settings.PING_PRODUCER_MAX_SECONDS):
+    token = ping_producer_lock.acquire()
+    if token is None:
+        return {
+            'status': 200,
+            'msg': f'Producer {ping_producer_lock.holder()} is running, skip this round'
+        }
+    ranges = 0
+    jobs = 0
+    queued = 0
+    start = time.time()
+    try:
+        while time.time() - start < max_seconds:
+            queued = ping_job_queue.size()
+            if queued >= high_water:
+                break
+            # 检查 iprange 表，根据 lastcheck_time 排序，找出本周期还没有检查过的数据，准备进行更新
+            datas = check_expired_iprange(limit=20)
+            if len(datas) == 0 or not ping_producer_lock.extend(token):
+                break
+            messages = iprange_ping_jobs(datas)
+            if ping_job_queue.push_fenced(messages, ping_producer_lock.key, token) < 0:
+                print('ping producer lost lock.', token)
+                break
+            update_pingable_results(datas)
+            ranges += len(datas)
+            jobs += len(messages)
+            queued += len(messages)
+    finally:
+        ping_producer_lock.release(token)
+    return {
+        'status': 200,
+        'msg': {'token': token, 'ranges': ranges, 'jobs': jobs, 'queued': queued}
+    }
+
+def push_ping_jobs(jobs:list):
+    try:
+        return ping_job_queue.push(jobs)
+    except Exception as e:
+        print('push ping jobs failed.', repr(e), len(jobs))
+        return None
+
+# 取出最多 count 个 ping 任务，返回 [(任务id, 任务), ...]，任务id需要在提交结果时确认
+def lease_ping_jobs(count:int):
+    try:
+        return ping_job_queue.lease(count)
+    except Exception as e:
+        print('lease ping jobs failed.', repr(e), count)
+        return []
+
+def ack_ping_jobs(ids:list):
+    try:
+        return ping_job_queue.ack(ids)
+    except Exception as e:
+        print('ack ping jobs failed.', repr(e), ids)
+        return 0
+
 # 根据不同的source city，获取需要ping的任务
 def get_pingjob_by_cityid(src_city_id:int):
     last_city_id = 0
@@ -710,40 +1366,40 @@ def get_pingjob_by_cityid(src_city_id:int):
     # 在redis中先查找有没有已经缓存的数据
     data = cache_pop(settings.CACHEKEY_CITYJOB + str(src_city_id))
     if data:
-        # 先判断 data 是否为 int，如果是，表示需要从数据库找到下一批城市id，然后再次缓存到redis中
+        # 先判断 data 是否为 int，如果是，表示需要从城市列表找到下一批城市id，然后再次缓存到redis中
         if not isinstance(data, int):
             return_city_id = data['city_id']
         else:
-            # 如果是 int，说明缓存中已经没有数据了，需要从数据库中查询，然后再缓存到redis中
+            # 如果是 int，说明缓存中已经没有数据了，需要从城市列表中查询，然后再缓存到redis中
             last_city_id = data
-    # 如果没有数据了，从数据库中查询，然后缓存到redis中
+    # 如果没有数据了，从城市列表中查询，然后缓存到redis中
     if return_city_id == 0:
-        sql = 'SELECT city_id FROM pingable where city_id>%s and lastresult>=' + settings.NEW_PINGABLE_IP + ' GROUP BY city_id limit 50'
-        ipdatas = mysql_select(sql, (last_city_id,))
-        if ipdatas == None or len(ipdatas) == 0:
+        # 有可ping ip的城市列表保存在 redis 中，按 city_id 翻页
+        city_ids = pingable_pool.cities_after(last_city_id, 50)
+        if len(city_ids) == 0:
             # 如果没有数据了，从头开始查询
             if last_city_id != 0:
-                ipdatas = mysql_select(sql, (0,))
+                city_ids = pingable_pool.cities_after(0, 50)
         # 如果都没有数据，则返回 None
-        if ipdatas != None and len(ipdatas)>0:
-            for ipdata in ipdatas:
+        if len(city_ids) > 0:
+            for city_id in city_ids:
                 if return_city_id == 0:
-                    return_city_id = ipdata['city_id']
+                    return_city_id = city_id
                 else:
-                    cache_push(settings.CACHEKEY_CITYJOB + str(src_city_id), ipdata)
-                last_city_id = ipdata['city_id']
+                    cache_push(settings.CACHEKEY_CITYJOB + str(src_city_id), {'city_id': city_id})
+                last_city_id = city_id
             # 缓存最后一个 city_id，用于缓存取光后，继续下次的查询
             cache_push(settings.CACHEKEY_CITYJOB + str(src_city_id), last_city_id)
             # print(f'got {len(ipdatas)} cityids with {src_city_id} last_id {last_city_id}')
     if return_city_id == 0:
         return None
-    # 查找该city_id的可用ip列表
-    iplists = mysql_select('SELECT ip FROM pingable where city_id=%s and lastresult>=' + settings.NEW_PINGABLE_IP + ' order by RAND() LIMIT 100;', (return_city_id,), False)
-    if iplists == None or len(iplists) == 0:
+    # 从该city_id的可ping ip集合中随机取100个
+    ips = pingable_pool.random_ips(return_city_id, 100)
+    if len(ips) == 0:
         return None
     return {
         'city_id': return_city_id,
-        'ips': [x[0] for x in iplists]
+        'ips': ips
     }
 
 def update_speed_status(job:str, count:int, isread:bool):
@@ -758,6 +1414,12 @@ def update_client_status(ip:str, agent:str):
     tracker.update_ip(ip)
     return cache_get(settings.CACHEKEY_PAUSE)
 
+# agent=ping or data，返回该客户端的处理能力统计
+def get_detector_capacity(ip:str, agent:str):
+    default_batch, max_batch = settings.DETECTOR_BATCH[agent]
+    return DetectorCapacity(redis_pool, settings.CACHEKEY_DETECTOR + agent, ip, default_batch, max_batch,
+        settings.DETECTOR_TARGET_SECONDS, settings.DETECTOR_HEADROOM, idle_interval=settings.DETECTOR_IDLE_INTERVAL)
+
 # 计算数组的 Pxx 取值
 # 该函数可以使用 np.percentile(sorted_data, 75) 代替，只是npmpy库太大
 # 要求 sorted_data 是已排序列表，p: 分位数 (0-100)
@@ -787,25 +1449,47 @@ def get_cookie(cookies:str, key:str, default_val=''):
     end = cookies.find(";", start)
     return cookies[start:] if end == -1 else cookies[start:end]
 
+session_tokens = SessionTokens(redis_pool, settings.CACHEKEY_USERREVOKED, settings.AUTH_TOKEN_KEY,
+    settings.AUTH_TOKEN_MAX_EXPIRE, settings.AUTH_REVOCATION_REFRESH)
+
 def validate_user_token(auth:int, token:str):
     if auth == settings.AUTH_NOTNEED:
         return True
-    if not token:
-        return False
-    if not token.isalnum():
-        return False
-    val = cache_get(settings.CACHEKEY_USERAUTH + myhash(token))
+    val = get_user_info_by_token(token)
     if val != None and (auth & val["auth"]) == auth:
         return True
     return False
 
+# 签名 token 在进程内校验；升级前签发的 token 仍从 redis 中读取，过期后不再使用
 def get_user_info_by_token(token:str):
     if not token:
         return None
+    if SessionTokens.is_signed(token):
+        return session_tokens.verify(token)
     if not token.isalnum():
         return None
     return cache_get(settings.CACHEKEY_USERAUTH + myhash(token))
 
+# 签发登录 token，返回与 validate_user 相同的结构
+def issue_user_token(user:str, auth:int, expire:int = settings.CACHE_LONG_TTL):
+    token, expire = session_tokens.issue(user, auth, expire)
+    return {
+        "token": token,
+        "user": user,
+        "auth": auth,
+        "expire": expire
+    }
+
+# 注销：签名 token 加入吊销记录，旧 token 直接删除
+def revoke_user_token(token:str):
+    if not token:
+        return False
+    if SessionTokens.is_signed(token):
+        return session_tokens.revoke(token)
+    if not token.isalnum():
+        return False
+    return bool(cache_delete(settings.CACHEKEY_USERAUTH + myhash(token)))
+
 # if ssouser exist, user = ssouser@user
 def validate_user(user:str, ssouser:str, password:str, expire:int = settings.CACHE_LONG_TTL):
     if not user.isalnum():
@@ -818,14 +1502,7 @@ def validate_user(user:str, ssouser:str, password:str, expire:int = settings.CAC
     if ret[0]['password'] == myhash(myhash(password)+user+'myuserencrpt'):
         if ssouser:
             user = ssouser + '@' + user
-        key = myhash(str(time.time()) + user)
-        cache_set(settings.CACHEKEY_USERAUTH + myhash(key), {"user":user, "auth":ret[0]['auth']}, expire)
-        return {
-            "token": key,
-            "user": user,
-            "auth": ret[0]['auth'],
-            "expire": expire
-        }
+        return issue_user_token(user, ret[0]['auth'], expire)
     return None
 
 # is_valid, errors, stats = create_user()
@@ -855,6 +1532,8 @@ def create_user(user:str, password:str, auth:int=settings.AUTH_BASEUSER):
         }
     password = myhash(myhash(password)+user+'myuserencrpt')
     mysql_execute('INSERT INTO `user`(`name`,`password`,`auth`) VALUES(%s, %s, %s) ON DUPLICATE KEY UPDATE password=%s,auth=%s', (user, password, auth, password, auth))
+    # 修改密码或权限后，该用户之前签发的 token 全部失效
+    session_tokens.revoke_user(user)
     return {
         'statusCode': 200,
         'result': 'success'
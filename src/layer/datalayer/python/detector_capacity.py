@@ -0,0 +1,109 @@
+import math
+import redis
+import time
+from speed_counter import SpeedCounter
+
+# 每个探测客户端（按来源ip）的处理能力统计，用于决定每次下发的任务数和下次请求的间隔
+# 状态保存在哈希表 {cache_key}{ip} 中：
+#   t     上次下发任务的时间     n     上次下发的任务数（提交结果后清零）
+#   batch 下次下发的任务数       spj   每个任务耗时的指数加权移动平均（秒）
+#   tat   一批任务往返时间的指数加权移动平均（秒）
+#   idle  没有任务时的请求间隔，连续没有任务时加倍
+# 最近一小时下发和返回的任务数用 SpeedCounter 统计，key 为 {cache_key}{ip}-get / -set
+# 调整方式：提交的结果少于下发的任务数（超时或丢失）时任务数减半，否则按 目标时间*余量/每个任务耗时 计算，每次最多翻倍
+# 下发任务后的请求间隔按 任务数*每个任务耗时*余量 计算，慢的客户端不会在上一批完成前又领到新任务
+class DetectorCapacity:
+    def __init__(self, redis_pool, cache_key:str, ip:str, default_batch:int, max_batch:int,
+                 target_seconds:int = 120, headroom:float = 0.8, alpha:float = 0.3,
+                 idle_interval:tuple = (60, 3600), expire:int = 86400):
+        self.redis = redis.StrictRedis(connection_pool=redis_pool)
+        self.key = cache_key + ip
+        self.default_batch = default_batch
+        self.max_batch = max_batch
+        self.target_seconds = target_seconds
+        self.headroom = headroom
+        self.alpha = alpha
+        self.min_idle, self.max_idle = idle_interval
+        self.expire = expire
+        self.dispatched = SpeedCounter(redis_pool, self.key + '-get')
+        self.returned = SpeedCounter(redis_pool, self.key + '-set')
+        self.state = None
+
+    def _load(self):
+        if self.state is None:
+            state = self.redis.hgetall(self.key)
+            self.state = {
+                't': float(state.get('t', 0)),
+                'n': int(state.get('n', 0)),
+                'batch': int(state.get('batch', self.default_batch)),
+                'spj': float(state.get('spj', 0)),
+                'tat': float(state.get('tat', 0)),
+                'idle': int(state.get('idle', self.min_idle)),
+            }
+        return self.state
+
+    def _save(self):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hset(self.key, mapping=self.state)
+        pipe.expire(self.key, self.expire)
+        pipe.execute()
+
+    def _ewma(self, old:float, value:float):
+        return value if old <= 0 else self.alpha * value + (1 - self.alpha) * old
+
+    def record_results(self, count:int):
+        # 客户端提交了 count 个任务的结果；没有提交结果直接请求新任务时 count 为 0，上一批任务按丢失处理
+        state = self._load()
+        if count > 0:
+            self.returned.update_count(count)
+        if state['n'] > 0 and state['t'] > 0:
+            turnaround = max(time.time() - state['t'], 0.001)
+            state['tat'] = self._ewma(state['tat'], turnaround)
+            if count > 0:
+                state['spj'] = self._ewma(state['spj'], turnaround / count)
+            if count < state['n']:
+                state['batch'] = max(state['batch'] // 2, 1)
+            elif state['spj'] > 0:
+                batch = int(self.target_seconds * self.headroom / state['spj'])
+                state['batch'] = max(min(batch, state['batch'] * 2, self.max_batch), 1)
+            state['n'] = 0
+            self._save()
+        return state['batch']
+
+    def record_dispatch(self, count:int):
+        # 记录本次下发的任务数，返回下次请求的间隔秒数
+        state = self._load()
+        state['t'] = time.time()
+        state['n'] = count
+        if count > 0:
+            self.dispatched.update_count(count)
+            state['idle'] = self.min_idle
+            # 还没有耗时统计时 1 秒后再请求
+            interval = max(math.ceil(count * state['spj'] * self.headroom), 1)
+        else:
+            # 连续没有任务时逐步拉长间隔，有任务后恢复
+            interval = state['idle']
+            state['idle'] = min(state['idle'] * 2, self.max_idle)
+        self._save()
+        return interval
+
+    def get_metrics(self):
+        state = self._load()
+        return {
+            'batch': state['batch'],
+            'turnaround': round(state['tat'], 1),
+            'seconds_per_job': round(state['spj'], 2),
+            'dispatched': self.dispatched.get_count(),
+            'returned': self.returned.get_count(),
+        }
+
+    @staticmethod
+    def get_batch_metrics(redis_pool, cache_key:str, ips:list, default_batch:int):
+        # 在线客户端列表使用，一次管道读取多个客户端的 batch 和 tat，返回 {ip: {'batch', 'turnaround'}}
+        if len(ips) == 0:
+            return {}
+        pipe = redis.StrictRedis(connection_pool=redis_pool).pipeline(transaction=False)
+        for ip in ips:
+            pipe.hmget(cache_key + ip, 'batch', 'tat')
+        return {ip: {'batch': int(batch or default_batch), 'turnaround': round(float(tat or 0), 1)}
+                for ip, (batch, tat) in zip(ips, pipe.execute())}
@@ -0,0 +1,49 @@
+import re
+from array import array
+
+# fping 输出解析，整个输出只用正则扫描一遍，不逐个 token 尝试 float()
+# fping -C 11 -q 的 stderr，每个目标一行，ip 按最长的目标补齐空格，- 表示丢包：
+#   2.17.168.71  : 370 370 370 - 373 370 370 370 370 370 370
+#   38.107.236.100 : duplicate for [0], 64 bytes, 34.4 ms
+# 只匹配 "ip : 数字或-" 的行，duplicate 行在冒号后的第一个字符就匹配失败，[DEBUG]、ICMP 错误等行也不会匹配
+COUNT_LINE = re.compile(r'^(\S+) *: ([\d. -]+)\r?$', re.M)
+# fping -a 的 stdout，每行一个可ping的ip
+ALIVE_LINE = re.compile(r'^((?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(?:\.(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3})\r?$', re.M)
+
+# 解析 fping -C 的输出，所有目标的延迟（ms）保存在同一个 array('f') 中，一次转换为浮点数
+# 返回 (rtts, targets)，targets 为 [(ip, start, end, 丢包数), ...]，rtts[start:end] 为该目标收到的延迟
+def parse_count_output(output:str):
+    targets = []
+    values = []
+    pos = 0
+    for ip, rest in COUNT_LINE.findall(output):
+        lost = rest.count('-')
+        # fping 的每个结果之间只有一个空格
+        count = rest.count(' ') + 1 - lost
+        targets.append((ip, pos, pos + count, lost))
+        values.append(rest)
+        pos += count
+    try:
+        rtts = array('f', map(float, ' '.join(values).replace('-', ' ').split()))
+    except ValueError:
+        # 有格式异常的行，如 1.2.3，逐行解析并跳过异常的行
+        return parse_count_lines(output)
+    if len(rtts) != pos:
+        return parse_count_lines(output)
+    return rtts, targets
+
+def parse_count_lines(output:str):
+    rtts = array('f')
+    targets = []
+    for ip, rest in COUNT_LINE.findall(output):
+        try:
+            values = array('f', map(float, rest.replace('-', ' ').split()))
+        except ValueError:
+            continue
+        targets.append((ip, len(rtts), len(rtts) + len(values), rest.count('-')))
+        rtts.extend(values)
+    return rtts, targets
+
+# 返回 fping -a 输出中的 ip 列表
+def parse_alive_output(output:str):
+    return ALIVE_LINE.findall(output)
@@ -0,0 +1,120 @@
+import array
+import bisect
+import os
+import struct
+import time
+import redis
+
+# iprange 表的内存区间索引，替代 start_ip<=ip and end_ip>=ip 的范围查询
+# 三个 array('I') 分别保存 start/end/city_id，按 start 排序后二分查找，相邻且同 city_id 的段会合并
+# 索引会快照到 /tmp，同一执行环境重新加载模块时可直接读取；redis 中的版本号变化时重新构建
+class IPRangeIndex:
+    MAGIC = b'IPRX'
+    HEADER = struct.Struct('<4sQI')
+
+    def __init__(self, redis_pool, cache_key:str, loader, snapshot_file:str, check_interval:int = 60):
+        self.redis = redis.StrictRedis(connection_pool=redis_pool)
+        self.key = cache_key
+        # loader 返回按 start_ip 排序的 (start_ip, end_ip, city_id) 可迭代对象
+        self.loader = loader
+        self.snapshot_file = snapshot_file
+        # 多少秒检查一次 redis 中的版本号，避免每次查找都访问 redis
+        self.check_interval = check_interval
+        self.version = None
+        self.checked = 0
+        self.starts = array.array('I')
+        self.ends = array.array('I')
+        self.city_ids = array.array('I')
+
+    def get_version(self):
+        ret = self.redis.get(self.key)
+        return int(ret) if ret else 0
+
+    def bump_version(self):
+        # 导入 iprange 数据后调用，通知所有 Lambda 重建索引
+        return self.redis.incr(self.key)
+
+    def build(self, rows):
+        starts = array.array('I')
+        ends = array.array('I')
+        city_ids = array.array('I')
+        for start_ip, end_ip, city_id in rows:
+            if city_ids and city_ids[-1] == city_id and start_ip <= ends[-1] + 1:
+                # 与上一段相邻或重叠，且属于同一个 city_id，直接合并
+                if end_ip > ends[-1]:
+                    ends[-1] = end_ip
+                continue
+            starts.append(start_ip)
+            ends.append(end_ip)
+            city_ids.append(city_id)
+        self.starts, self.ends, self.city_ids = starts, ends, city_ids
+
+    def save_snapshot(self):
+        tmpfile = self.snapshot_file + '.tmp'
+        with open(tmpfile, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.version, len(self.starts)))
+            self.starts.tofile(f)
+            self.ends.tofile(f)
+            self.city_ids.tofile(f)
+        # 先写临时文件再替换，避免读到写了一半的快照
+        os.replace(tmpfile, self.snapshot_file)
+
+    def load_snapshot(self, version:int):
+        try:
+            with open(self.snapshot_file, 'rb') as f:
+                magic, snap_version, count = self.HEADER.unpack(f.read(self.HEADER.size))
+                if magic != self.MAGIC or snap_version != version:
+                    return False
+                starts = array.array('I')
+                ends = array.array('I')
+                city_ids = array.array('I')
+                starts.fromfile(f, count)
+                ends.fromfile(f, count)
+                city_ids.fromfile(f, count)
+        except (OSError, EOFError, struct.error):
+            return False
+        self.starts, self.ends, self.city_ids = starts, ends, city_ids
+        return True
+
+    def refresh(self):
+        # 返回索引是否可用，不可用时调用方应回退到数据库查询
+        now = time.time()
+        if self.version is not None and now - self.checked < self.check_interval:
+            return True
+        try:
+            version = self.get_version()
+        except Exception as e:
+            print('iprange index version check failed.', repr(e))
+            # redis 不可用时继续使用已有索引
+            return self.version is not None
+        self.checked = now
+        if version == self.version:
+            return True
+        if self.load_snapshot(version):
+            self.version = version
+            return True
+        try:
+            self.build(self.loader())
+        except Exception as e:
+            print('iprange index build failed.', repr(e))
+            return self.version is not None
+        self.version = version
+        try:
+            self.save_snapshot()
+        except OSError as e:
+            print('iprange index snapshot failed.', repr(e))
+        return True
+
+    def lookup(self, ipno:int):
+        # 返回 (start_ip, end_ip, city_id)，找不到返回 None
+        i = bisect.bisect_right(self.starts, ipno) - 1
+        if i < 0 or self.ends[i] < ipno:
+            return None
+        return (self.starts[i], self.ends[i], self.city_ids[i])
+
+    def get_metrics(self):
+        return {
+            'version': self.version,
+            'ranges': len(self.starts),
+            'bytes': len(self.starts) * self.starts.itemsize * 3,
+        }
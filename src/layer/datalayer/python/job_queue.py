@@ -0,0 +1,119 @@
+import json
+import time
+import redis
+
+# 租约方式的任务队列：任务取出后记录在处理中的有序集合里（score 为租约到期时间），客户端提交结果后确认删除
+# 客户端取出任务后退出、没有提交结果的，租约到期后重新放回队列，不需要等到下一轮 iprange 过期检查
+# 待处理任务仍然是 queue_key 的列表，兼容原来的 rpush/llen，处理中的任务保存在：
+#   {queue_key}:lease  有序集合，成员为任务id，score 为租约到期时间
+#   {queue_key}:jobs   哈希表，任务id -> 任务内容
+#   {queue_key}:seq    任务id计数器
+# key 使用 {queue_key} 的哈希标签，与 queue_key 在集群中属于同一个 slot，可以在一个 lua 脚本中操作
+
+# 先把租约到期的任务放回队列头部，再原子地取出最多 N 个任务并记录租约
+# KEYS: queue, lease, jobs, seq  ARGV: 数量, 当前时间, 租约到期时间, 每次最多放回的任务数
+LEASE_SCRIPT = '''
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[2], 'LIMIT', 0, tonumber(ARGV[4]))
+for i, id in ipairs(expired) do
+    local job = redis.call('HGET', KEYS[3], id)
+    if job then
+        redis.call('LPUSH', KEYS[1], job)
+        redis.call('HDEL', KEYS[3], id)
+    end
+    redis.call('ZREM', KEYS[2], id)
+end
+local ret = {#expired}
+for i = 1, tonumber(ARGV[1]) do
+    local job = redis.call('LPOP', KEYS[1])
+    if not job then
+        break
+    end
+    local id = redis.call('INCR', KEYS[4])
+    redis.call('HSET', KEYS[3], id, job)
+    redis.call('ZADD', KEYS[2], ARGV[3], id)
+    table.insert(ret, id)
+    table.insert(ret, job)
+end
+return ret
+'''
+
+# 确认任务完成，返回确认成功的数量，已经到期被放回队列的任务确认失败，会再执行一次
+# KEYS: lease, jobs  ARGV: 任务id...
+ACK_SCRIPT = '''
+local count = 0
+for i, id in ipairs(ARGV) do
+    if redis.call('ZREM', KEYS[1], id) == 1 then
+        redis.call('HDEL', KEYS[2], id)
+        count = count + 1
+    end
+end
+return count
+'''
+
+# 校验 fencing token 后再写入队列，token 不是当前锁的值时不写入，返回 -1
+# KEYS: queue, lock  ARGV: token, 任务...
+PUSH_FENCED_SCRIPT = '''
+if redis.call('GET', KEYS[2]) ~= ARGV[1] then
+    return -1
+end
+return redis.call('RPUSH', KEYS[1], unpack(ARGV, 2))
+'''
+
+class JobQueue:
+    def __init__(self, redis_pool, queue_key:str, lease_seconds:int = 600, max_requeue:int = 100):
+        self.redis = redis.StrictRedis(connection_pool=redis_pool)
+        self.key = queue_key
+        self.lease_key = '{' + queue_key + '}:lease'
+        self.jobs_key = '{' + queue_key + '}:jobs'
+        self.seq_key = '{' + queue_key + '}:seq'
+        self.lease_seconds = lease_seconds
+        self.max_requeue = max_requeue
+        self.lease_script = self.redis.register_script(LEASE_SCRIPT)
+        self.ack_script = self.redis.register_script(ACK_SCRIPT)
+        self.push_fenced_script = self.redis.register_script(PUSH_FENCED_SCRIPT)
+        self.stats = {'leased': 0, 'acked': 0, 'requeued': 0}
+
+    def push(self, jobs:list):
+        if len(jobs) == 0:
+            return 0
+        return self.redis.rpush(self.key, *[json.dumps(job) for job in jobs])
+
+    def push_fenced(self, jobs:list, lock_key:str, token:int):
+        # lock_key 需要使用 {queue_key} 哈希标签，与队列在同一个 slot
+        # lua 的 unpack 参数个数有限制，分批写入，每批都校验 token
+        ret = 0
+        for i in range(0, len(jobs), 1000):
+            ret = self.push_fenced_script(keys=[self.key, lock_key], args=[token] + [json.dumps(job) for job in jobs[i:i + 1000]])
+            if ret < 0:
+                break
+        return ret
+
+    def lease(self, count:int):
+        # 返回 [(任务id, 任务), ...]
+        now = time.time()
+        ret = self.lease_script(keys=[self.key, self.lease_key, self.jobs_key, self.seq_key],
+            args=[count, now, now + self.lease_seconds, self.max_requeue])
+        self.stats['requeued'] += int(ret[0])
+        jobs = [(str(ret[i]), json.loads(ret[i + 1])) for i in range(1, len(ret), 2)]
+        self.stats['leased'] += len(jobs)
+        return jobs
+
+    def ack(self, ids:list):
+        if len(ids) == 0:
+            return 0
+        count = self.ack_script(keys=[self.lease_key, self.jobs_key], args=ids)
+        self.stats['acked'] += count
+        return count
+
+    def size(self):
+        return self.redis.llen(self.key)
+
+    def inflight(self):
+        return self.redis.zcard(self.lease_key)
+
+    def get_metrics(self):
+        return {
+            'queued': self.size(),
+            'inflight': self.inflight(),
+            **self.stats
+        }
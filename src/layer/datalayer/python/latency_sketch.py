@@ -0,0 +1,124 @@
+import math
+
+# 可合并的延迟分布（对数分桶直方图，与 DDSketch 相同的分桶方式）
+# 值落入第 i 个桶表示 gamma^(i-1) < v <= gamma^i，取桶的代表值时相对误差不超过 accuracy
+# 多个 sketch 合并只需要把同一个桶的计数相加，合并后的分位数和直接用全部原始样本计算的结果误差一致
+# min/max/sum 单独精确保存，所以最小、最大和平均延迟没有误差
+# 编码格式：版本号，accuracy 的万分比，count，zero，min，max，sum，桶数，然后每个桶为 (与上一个桶号的差值，计数)，全部为 varint
+class LatencySketch:
+    VERSION = 1
+
+    def __init__(self, accuracy:float = 0.01):
+        # accuracy 以万分比保存，编码后可以还原出完全相同的 gamma
+        self.accuracy = round(accuracy * 10000) / 10000
+        self.gamma = (1 + self.accuracy) / (1 - self.accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.count = 0
+        # 小于 1 的值（单位us）不分桶，按 0 处理
+        self.zero = 0
+        self.min = 0
+        self.max = 0
+        self.sum = 0
+
+    def add(self, value, count:int = 1):
+        value = int(value)
+        if self.count == 0 or value < self.min:
+            self.min = value
+        if self.count == 0 or value > self.max:
+            self.max = value
+        self.count += count
+        self.sum += value * count
+        if value < 1:
+            self.zero += count
+            return
+        index = math.ceil(math.log(value) / self.log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        if other.accuracy != self.accuracy:
+            raise ValueError(f'can not merge sketch with accuracy {other.accuracy} into {self.accuracy}')
+        if self.count == 0 or other.min < self.min:
+            self.min = other.min
+        if self.count == 0 or other.max > self.max:
+            self.max = other.max
+        self.count += other.count
+        self.zero += other.zero
+        self.sum += other.sum
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        return self
+
+    def quantile(self, p:float):
+        # 与 np_percentile 相同，取第 int(p/100*(n-1)) 个样本（从0开始）
+        if self.count == 0:
+            return None
+        rank = int(p / 100.0 * (self.count - 1))
+        if rank == 0:
+            return float(self.min)
+        if rank == self.count - 1:
+            return float(self.max)
+        if rank < self.zero:
+            return 0.0
+        seen = self.zero
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                value = 2 * self.gamma ** index / (self.gamma + 1)
+                return float(min(max(value, self.min), self.max))
+        return float(self.max)
+
+    def avg(self):
+        return self.sum / self.count if self.count else None
+
+    def encode(self):
+        out = bytearray()
+        for value in (self.VERSION, round(self.accuracy * 10000), self.count, self.zero, self.min, self.max, self.sum, len(self.buckets)):
+            write_varint(out, value)
+        last = 0
+        for index in sorted(self.buckets):
+            # 桶号可能为负数（值小于1时不会出现，这里保持通用），使用 zigzag 编码
+            delta = index - last
+            write_varint(out, (delta << 1) ^ (delta >> 63))
+            write_varint(out, self.buckets[index])
+            last = index
+        return bytes(out)
+
+    @classmethod
+    def decode(cls, data):
+        pos = 0
+        values = []
+        for i in range(8):
+            value, pos = read_varint(data, pos)
+            values.append(value)
+        version, accuracy, count, zero, min, max, sum, size = values
+        if version != cls.VERSION:
+            raise ValueError(f'unknown sketch version {version}')
+        sketch = cls(accuracy / 10000)
+        sketch.count, sketch.zero, sketch.min, sketch.max, sketch.sum = count, zero, min, max, sum
+        index = 0
+        for i in range(size):
+            delta, pos = read_varint(data, pos)
+            count, pos = read_varint(data, pos)
+            index += (delta >> 1) ^ -(delta & 1)
+            sketch.buckets[index] = count
+        return sketch
+
+def write_varint(out:bytearray, value:int):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def read_varint(data, pos:int):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
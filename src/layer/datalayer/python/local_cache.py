@@ -0,0 +1,109 @@
+import time
+import redis
+import threading
+from collections import OrderedDict
+
+# 还没有读取过代数计数器
+UNKNOWN_GENERATION = object()
+
+# 进程内的 LRU 缓存（L1），放在 redis 前面，Lambda 热启动时同一个 key 不需要再访问 redis
+# 保存的是 redis 中的原始字符串，每次命中重新解码，避免调用方修改返回对象污染缓存
+# 只缓存 prefixes 中配置的 key 前缀，每个前缀单独限制条数
+# 失效通过 redis 中的代数计数器实现，每 check_interval 秒检查一次，变化时清空所有 L1 缓存
+# 读写加锁，可以在线程池中并发使用
+class LocalCache:
+    def __init__(self, redis_pool, cache_key:str, prefixes:dict, ttl:int = 60, check_interval:int = 5, max_value_size:int = 262144):
+        self.redis = redis.StrictRedis(connection_pool=redis_pool)
+        self.key = cache_key
+        self.prefixes = prefixes
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.max_value_size = max_value_size
+        self.buckets = {prefix: OrderedDict() for prefix in prefixes}
+        self.generation = UNKNOWN_GENERATION
+        self.checked = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0, 'invalidations': 0}
+        self.lock = threading.RLock()
+
+    def _bucket(self, key:str):
+        for prefix, bucket in self.buckets.items():
+            if key.startswith(prefix):
+                return prefix, bucket
+        return None, None
+
+    def _check_generation(self):
+        now = time.time()
+        if now - self.checked < self.check_interval:
+            return
+        self.checked = now
+        try:
+            generation = self.redis.get(self.key)
+        except Exception as e:
+            print('local cache generation check failed.', repr(e))
+            return
+        if generation != self.generation:
+            if self.generation is not UNKNOWN_GENERATION:
+                self.clear()
+                self.stats['invalidations'] += 1
+            self.generation = generation
+
+    def get(self, key:str):
+        prefix, bucket = self._bucket(key)
+        if bucket == None:
+            return None
+        self._check_generation()
+        with self.lock:
+            return self._get(bucket, key)
+
+    def _get(self, bucket, key:str):
+        item = bucket.get(key)
+        if item == None:
+            self.stats['misses'] += 1
+            return None
+        value, expire = item
+        if expire < time.time():
+            del bucket[key]
+            self.stats['expired'] += 1
+            self.stats['misses'] += 1
+            return None
+        bucket.move_to_end(key)
+        self.stats['hits'] += 1
+        return value
+
+    def set(self, key:str, value, ttl:int = 0):
+        prefix, bucket = self._bucket(key)
+        if bucket == None or len(value) > self.max_value_size:
+            return
+        self._check_generation()
+        # 不超过 redis 中的过期时间
+        if ttl <= 0 or ttl > self.ttl:
+            ttl = self.ttl
+        with self.lock:
+            bucket[key] = (value, time.time() + ttl)
+            bucket.move_to_end(key)
+            while len(bucket) > self.prefixes[prefix]:
+                bucket.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def delete(self, key:str):
+        prefix, bucket = self._bucket(key)
+        if bucket != None:
+            with self.lock:
+                bucket.pop(key, None)
+
+    def invalidate(self):
+        # 通知所有 Lambda 清空 L1 缓存
+        self.clear()
+        self.generation = str(self.redis.incr(self.key))
+        self.checked = time.time()
+
+    def clear(self):
+        with self.lock:
+            for bucket in self.buckets.values():
+                bucket.clear()
+
+    def get_metrics(self):
+        return {
+            'items': {prefix: len(bucket) for prefix, bucket in self.buckets.items()},
+            **self.stats
+        }
@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+import pymysql
+from pymysql.constants import SERVER_STATUS
+
+# 模块级的 MySQL 连接池，Lambda 热启动时复用已建立的 TLS/认证连接
+# 取出连接时，空闲超过 ping_interval 的先 ping 检查，空闲超过 max_idle 的直接关闭重建
+class MySQLPool:
+    def __init__(self, connect, max_size:int = 4, max_idle:int = 300, ping_interval:int = 5):
+        # connect 为创建新连接的函数
+        self.connect = connect
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.ping_interval = ping_interval
+        # 空闲连接 (conn, 最后使用时间)，右侧为最近使用的
+        self.idle = deque()
+        self.lock = threading.Lock()
+        self.stats = {'created': 0, 'reused': 0, 'recycled': 0, 'broken': 0}
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _checkout(self):
+        while True:
+            now = time.time()
+            expired = []
+            with self.lock:
+                # 最老的连接在左侧，先清理超过最大空闲时间的
+                while self.idle and now - self.idle[0][1] > self.max_idle:
+                    expired.append(self.idle.popleft()[0])
+                item = self.idle.pop() if self.idle else None
+            for conn in expired:
+                self.stats['recycled'] += 1
+                self._close(conn)
+            if item == None:
+                break
+            conn, last_used = item
+            if now - last_used > self.ping_interval:
+                try:
+                    conn.ping(reconnect=False)
+                except Exception:
+                    self.stats['broken'] += 1
+                    self._close(conn)
+                    continue
+            self.stats['reused'] += 1
+            return conn
+        self.stats['created'] += 1
+        return self.connect()
+
+    def _checkin(self, conn, broken:bool):
+        if not broken and conn.open:
+            try:
+                # 调用方没有提交的事务，放回连接池前回滚，避免长时间持有锁
+                if conn.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+                    conn.rollback()
+            except Exception:
+                broken = True
+        else:
+            broken = True
+        with self.lock:
+            if not broken and len(self.idle) < self.max_size:
+                self.idle.append((conn, time.time()))
+                return
+        if broken:
+            self.stats['broken'] += 1
+        self._close(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self._checkout()
+        broken = False
+        try:
+            yield conn
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+            # 连接级错误，不再放回连接池
+            broken = True
+            raise
+        except Exception:
+            # 语句错误不影响连接，回滚后可继续使用
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+            raise
+        finally:
+            self._checkin(conn, broken)
+
+    def close_all(self):
+        with self.lock:
+            conns = [item[0] for item in self.idle]
+            self.idle.clear()
+        for conn in conns:
+            self._close(conn)
+
+    def get_metrics(self):
+        return {
+            'idle': len(self.idle),
+            **self.stats
+        }
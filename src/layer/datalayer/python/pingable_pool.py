@@ -0,0 +1,105 @@
+import redis
+
+# 每个城市可ping ip 的 redis 集合，分配 data 任务时用 SRANDMEMBER 随机取 ip，不再 ORDER BY RAND() 查询 pingable 表
+# 有可ping ip 的城市保存在一个有序集合中（score 为 city_id），按 city_id 翻页
+# 集合不存在时从数据库重建，重建后加入哨兵成员 0（不是有效的ip/city_id），用来区分 "已重建但为空" 和 "还没有重建"
+# 写入 pingable 表时同步加入集合，ip 过期时从集合删除，集合设置过期时间，过期后重新从数据库重建，修正可能的不一致
+class PingablePool:
+    SENTINEL = '0'
+
+    def __init__(self, redis_pool, pool_key:str, cities_key:str, ip_loader, city_loader, ttl:int = 86400):
+        self.redis = redis.StrictRedis(connection_pool=redis_pool)
+        self.pool_key = pool_key
+        self.cities_key = cities_key
+        # ip_loader(city_id) 返回该城市可ping的 ip（整数）列表，city_loader() 返回有可ping ip 的 city_id 列表
+        self.ip_loader = ip_loader
+        self.city_loader = city_loader
+        self.ttl = ttl
+        self.stats = {'rebuild_pool': 0, 'rebuild_cities': 0}
+
+    def _pool(self, city_id):
+        return self.pool_key + str(city_id)
+
+    def _rebuild(self, key, members, add):
+        pipe = self.redis.pipeline(transaction=False)
+        for i in range(0, len(members), 1000):
+            add(pipe, key, members[i:i + 1000])
+        add(pipe, key, [self.SENTINEL])
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    def rebuild_pool(self, city_id):
+        ips = [str(ip) for ip in self.ip_loader(city_id)]
+        self._rebuild(self._pool(city_id), ips, lambda pipe, key, members: pipe.sadd(key, *members))
+        self.stats['rebuild_pool'] += 1
+        return ips
+
+    def rebuild_cities(self):
+        city_ids = [int(city_id) for city_id in self.city_loader()]
+        self._rebuild(self.cities_key, city_ids, lambda pipe, key, members: pipe.zadd(key, {str(id): int(id) for id in members}))
+        self.stats['rebuild_cities'] += 1
+        return city_ids
+
+    def add(self, rows):
+        # rows: [(city_id, ip整数), ...]，集合还没有重建时也直接加入，重建时会补齐其他 ip
+        pools = {}
+        for city_id, ip in rows:
+            pools.setdefault(city_id, []).append(str(ip))
+        if len(pools) == 0:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for city_id, ips in pools.items():
+            pipe.sadd(self._pool(city_id), *ips)
+        pipe.zadd(self.cities_key, {str(city_id): city_id for city_id in pools})
+        pipe.execute()
+
+    def remove(self, city_id, ips):
+        key = self._pool(city_id)
+        pipe = self.redis.pipeline(transaction=False)
+        if len(ips) > 0:
+            pipe.srem(key, *[str(ip) for ip in ips])
+        pipe.sismember(key, self.SENTINEL)
+        pipe.scard(key)
+        built, count = pipe.execute()[-2:]
+        # 集合重建过且只剩哨兵时，城市已经没有可ping ip 了；集合不存在（过期或还没有重建）时不能判断，下次使用时从数据库重建
+        if built and count <= 1:
+            self.redis.zrem(self.cities_key, str(city_id))
+
+    def random_ips(self, city_id, count:int = 100):
+        key = self._pool(city_id)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.sismember(key, self.SENTINEL)
+        # 多取一个，去掉可能取到的哨兵
+        pipe.srandmember(key, count + 1)
+        built, members = pipe.execute()
+        if not built:
+            members = self.rebuild_pool(city_id)
+            if len(members) == 0:
+                self.redis.zrem(self.cities_key, str(city_id))
+            elif len(members) > count:
+                members = self.redis.srandmember(key, count + 1)
+        return [int(ip) for ip in members if ip != self.SENTINEL][:count]
+
+    def cities_after(self, last_city_id:int, limit:int = 50):
+        # 返回 city_id 大于 last_city_id 的前 limit 个有可ping ip 的城市
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zscore(self.cities_key, self.SENTINEL)
+        pipe.zrangebyscore(self.cities_key, f'({last_city_id}', '+inf', start=0, num=limit)
+        built, city_ids = pipe.execute()
+        if built == None:
+            self.rebuild_cities()
+            city_ids = self.redis.zrangebyscore(self.cities_key, f'({last_city_id}', '+inf', start=0, num=limit)
+        return [int(city_id) for city_id in city_ids]
+
+    def reset(self):
+        # 删除所有集合，下次使用时从数据库重建
+        count = self.redis.delete(self.cities_key)
+        for key in self.redis.scan_iter(match=self.pool_key + '*', count=1000):
+            count += self.redis.delete(key)
+        return count
+
+    def get_metrics(self):
+        return {
+            'cities': max(self.redis.zcard(self.cities_key) - 1, 0),
+            **self.stats
+        }
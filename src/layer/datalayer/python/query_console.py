@@ -0,0 +1,105 @@
+import time
+import pymysql
+from sql_stream import split_sql_statements
+
+# 数据维护页面和 admin exec_sql 使用的 sql 执行器，可以安全地查询大表
+# 查询使用服务端游标（SSCursor）逐行读取，每条语句最多返回 max_rows 行，超过时标记 truncated 并直接关闭连接，不读取剩余的行
+# （SSCursor.close 会把剩余的行全部读完，因此截断后不关闭游标，关闭连接后下一条语句使用新的连接）
+# 会话设置 max_execution_time，单条 SELECT 超时由 MySQL 终止；所有语句的总时间超过 max_seconds 后不再执行后面的语句
+# 结果按列返回：{'sql', 'type': 'query', 'columns': [...], 'rows': [[...], ...], 'row_count', 'truncated', 'seconds'[, 'plan']}
+# 或 {'sql', 'type': 'update', 'affected_rows', 'seconds'}，出错时为 {'sql', 'error'} 并停止执行；每条语句只打印一行摘要
+class QueryConsole:
+    EXPLAIN_ACTIONS = ('select', 'with')
+
+    def __init__(self, connect, max_rows:int = 1000, max_cell:int = 1024, max_seconds:int = 25, explain:bool = False):
+        self.connect = connect
+        self.max_rows = max_rows
+        self.max_cell = max_cell
+        self.max_seconds = max_seconds
+        self.explain = explain
+        self.conn = None
+
+    def _connection(self):
+        if self.conn is None:
+            self.conn = self.connect()
+            with self.conn.cursor() as cursor:
+                cursor.execute('SET SESSION max_execution_time = %s', (int(self.max_seconds * 1000),))
+        return self.conn
+
+    def _discard(self):
+        # 直接关闭连接，不读取未读完的结果
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+            self.conn = None
+
+    def cell(self, value):
+        if value is None or isinstance(value, (int, float)):
+            return value
+        if isinstance(value, (bytes, bytearray)):
+            try:
+                value = value.decode('utf-8')
+            except UnicodeDecodeError:
+                value = '0x' + value[:self.max_cell].hex()
+        else:
+            value = str(value)
+        if len(value) > self.max_cell:
+            return value[:self.max_cell] + f'...({len(value)} chars)'
+        return value
+
+    def _plan(self, sql:str):
+        with self._connection().cursor() as cursor:
+            cursor.execute('EXPLAIN ' + sql)
+            return {'columns': [desc[0] for desc in cursor.description], 'rows': [[self.cell(v) for v in row] for row in cursor.fetchall()]}
+
+    def _execute(self, sql:str):
+        result = {'sql': sql}
+        if self.explain and sql[:6].lower().startswith(self.EXPLAIN_ACTIONS):
+            result['plan'] = self._plan(sql)
+        conn = self._connection()
+        cursor = conn.cursor(pymysql.cursors.SSCursor)
+        cursor.execute(sql)
+        if cursor.description is None:
+            result.update({'type': 'update', 'affected_rows': cursor.rowcount})
+            cursor.close()
+            conn.commit()
+            return result
+        rows = cursor.fetchmany(self.max_rows + 1)
+        result.update({
+            'type': 'query',
+            'columns': [desc[0] for desc in cursor.description],
+            'rows': [[self.cell(v) for v in row] for row in rows[:self.max_rows]],
+            'row_count': min(len(rows), self.max_rows),
+            'truncated': len(rows) > self.max_rows
+        })
+        if result['truncated']:
+            result['message'] = f'only the first {self.max_rows} rows are returned'
+            self._discard()
+        else:
+            cursor.close()
+        return result
+
+    def run(self, sql:str):
+        results = []
+        deadline = time.time() + self.max_seconds
+        try:
+            for statement in split_sql_statements(sql):
+                if time.time() > deadline:
+                    results.append({'sql': statement, 'error': f'skipped, exceeded {self.max_seconds} seconds'})
+                    break
+                start = time.perf_counter()
+                try:
+                    result = self._execute(statement)
+                except Exception as e:
+                    self._discard()
+                    results.append({'sql': statement, 'error': str(e)})
+                    print(f"{statement[:200]}\n错误: {str(e)}")
+                    break
+                result['seconds'] = round(time.perf_counter() - start, 3)
+                results.append(result)
+                print(f"{statement[:200]} -> {result.get('row_count', result.get('affected_rows'))} rows{' (truncated)' if result.get('truncated') else ''} in {result['seconds']}s")
+        finally:
+            self._discard()
+        return results
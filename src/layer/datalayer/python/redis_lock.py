@@ -0,0 +1,54 @@
+import redis
+
+# 带 fencing token 的 redis 锁，用于只允许一个 Lambda 执行的后台任务
+# 每次加锁从 {lock_key}:fence 计数器取一个递增的 token 作为锁的值，持有者的写操作带上 token，
+# 在 lua 脚本中先检查锁的值仍然等于 token 再写入，锁过期后被其他实例取得时，旧的持有者写入失败，不会覆盖新持有者的结果
+# 需要校验 token 的 key 要和 lock_key 在集群中属于同一个 slot（使用相同的哈希标签）
+
+# KEYS: lock, fence  ARGV: 锁的过期时间
+ACQUIRE_SCRIPT = '''
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+local token = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[1], token, 'EX', tonumber(ARGV[1]))
+return token
+'''
+
+# KEYS: lock  ARGV: token, 锁的过期时间（为空时删除锁）
+RENEW_SCRIPT = '''
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == '' then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('EXPIRE', KEYS[1], tonumber(ARGV[2]))
+end
+return 1
+'''
+
+class FencedLock:
+    def __init__(self, redis_pool, lock_key:str, ttl:int = 60):
+        self.redis = redis.StrictRedis(connection_pool=redis_pool)
+        self.key = lock_key
+        self.fence_key = lock_key + ':fence'
+        self.ttl = ttl
+        self.acquire_script = self.redis.register_script(ACQUIRE_SCRIPT)
+        self.renew_script = self.redis.register_script(RENEW_SCRIPT)
+
+    def acquire(self):
+        # 返回 token，锁被其他实例持有时返回 None
+        token = int(self.acquire_script(keys=[self.key, self.fence_key], args=[self.ttl]))
+        return token if token > 0 else None
+
+    def extend(self, token:int):
+        # 仍然持有锁时延长过期时间，返回 False 表示锁已经过期或被其他实例取得
+        return self.renew_script(keys=[self.key], args=[token, self.ttl]) == 1
+
+    def release(self, token:int):
+        return self.renew_script(keys=[self.key], args=[token, '']) == 1
+
+    def holder(self):
+        token = self.redis.get(self.key)
+        return int(token) if token else None
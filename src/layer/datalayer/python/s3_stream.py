@@ -0,0 +1,103 @@
+import io
+
+# 可写的流，写入的数据按 part_size 分片直接用 S3 分片上传，内存中最多保留一个分片，不需要先写到 BytesIO 或本地文件
+# 不支持 seek，zipfile 写入不可 seek 的流时使用数据描述符，可以直接包装
+# S3 要求除最后一个分片外每个分片至少 5MB，最多 10000 个分片；总大小不足一个分片时直接 put_object
+# 使用 with 语句：正常退出时完成上传，发生异常时取消分片上传，不会留下不完整的文件
+class S3MultipartWriter(io.RawIOBase):
+    MIN_PART_SIZE = 5 * 1024 * 1024
+
+    def __init__(self, s3, bucket:str, key:str, part_size:int = 8 * 1024 * 1024):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, self.MIN_PART_SIZE)
+        self.buffer = bytearray()
+        self.parts = []
+        self.upload_id = None
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        if len(self.buffer) >= self.part_size:
+            self._upload_part()
+        return len(data)
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        number = len(self.parts) + 1
+        response = self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=bytes(self.buffer))
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': number})
+        self.buffer = bytearray()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.upload_id is None:
+            self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+        else:
+            if len(self.buffer) > 0:
+                self._upload_part()
+            self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={'Parts': self.parts})
+        self.buffer = bytearray()
+        super().close()
+
+    def abort(self):
+        if self.closed:
+            return
+        if self.upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        self.buffer = bytearray()
+        super().close()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+# 可 seek 的 S3 对象读取流，每次读取使用 Range 请求，不需要先下载到本地文件
+# 使用 io.BufferedReader 包装，按缓冲区大小批量读取，zipfile 可以直接读取其中的文件
+class S3ObjectReader(io.RawIOBase):
+    def __init__(self, s3, bucket:str, key:str):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        head = s3.head_object(Bucket=bucket, Key=key)
+        self.length = head['ContentLength']
+        self.etag = head['ETag'].strip('"')
+        self.pos = 0
+        self.requests = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset:int, whence:int = io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.length
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def readinto(self, b):
+        if self.pos >= self.length or len(b) == 0:
+            return 0
+        end = min(self.pos + len(b), self.length) - 1
+        data = self.s3.get_object(Bucket=self.bucket, Key=self.key, Range=f'bytes={self.pos}-{end}')['Body'].read()
+        self.requests += 1
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
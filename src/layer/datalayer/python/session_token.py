@@ -0,0 +1,109 @@
+import base64
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+import redis
+
+# 无状态的登录 token：payload.签名，payload 为 base64url 编码的 "用户:权限:过期时间:签发时间(毫秒):随机id"，签名为 HMAC-SHA256
+# 校验只在进程内计算签名，不需要访问 redis；token 中只有字母、数字和 -_.，可以直接放在 cookie 中（cookie 用 | 分隔，前端按 = 切分）
+# 注销和修改密码通过 redis 哈希表 {cache_key} 中的吊销记录实现，每个 Lambda 每 refresh_interval 秒读取一次整个哈希表：
+#   t:随机id -> token 的过期时间，注销单个 token
+#   u:用户   -> 毫秒时间，该用户在这个时间之前签发的 token 全部失效（修改密码）
+# 记录在对应的 token 都过期后清理，哈希表保持很小
+# secret 为空（没有配置密钥）时不签发 token，也不接受任何签名 token
+class SessionTokens:
+    def __init__(self, redis_pool, cache_key:str, secret:bytes, max_expire:int = 2592000, refresh_interval:int = 5):
+        self.redis = redis.StrictRedis(connection_pool=redis_pool)
+        self.key = cache_key
+        self.secret = secret
+        self.max_expire = max_expire
+        self.refresh_interval = refresh_interval
+        self.revoked_tokens = {}
+        self.revoked_users = {}
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def is_signed(token:str):
+        return '.' in token
+
+    def _sign(self, payload:str):
+        digest = hmac.new(self.secret, payload.encode('utf-8'), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+    def issue(self, user:str, auth:int, expire:int):
+        if not self.secret:
+            raise ValueError('session token secret is not configured')
+        expire = min(expire, self.max_expire)
+        now = time.time()
+        fields = f'{user}:{auth}:{int(now) + expire}:{int(now * 1000)}:{secrets.token_hex(8)}'
+        payload = base64.urlsafe_b64encode(fields.encode('utf-8')).rstrip(b'=').decode()
+        return payload + '.' + self._sign(payload), expire
+
+    def decode(self, token:str):
+        # 返回 {'user', 'auth', 'expire', 'issued', 'id'}，签名错误或过期时返回 None，不检查吊销
+        payload, _, signature = token.partition('.')
+        if not self.secret or not payload or not hmac.compare_digest(signature, self._sign(payload)):
+            return None
+        try:
+            # 用户名中可能有 :，从右边切分，其他字段都不含 :
+            user, auth, expire, issued, id = base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)).decode('utf-8').rsplit(':', 4)
+            claims = {'user': user, 'auth': int(auth), 'expire': int(expire), 'issued': int(issued), 'id': id}
+        except ValueError:
+            return None
+        if claims['expire'] < time.time():
+            return None
+        return claims
+
+    def _refresh(self):
+        now = time.time()
+        if now - self.checked < self.refresh_interval:
+            return
+        with self.lock:
+            if now - self.checked < self.refresh_interval:
+                return
+            try:
+                values = self.redis.hgetall(self.key)
+            except Exception as e:
+                # redis 不可用时继续使用已有的吊销记录
+                print('session revocation refresh failed.', repr(e))
+                return
+            self.revoked_tokens = {field[2:]: int(value) for field, value in values.items() if field.startswith('t:')}
+            self.revoked_users = {field[2:]: int(value) for field, value in values.items() if field.startswith('u:')}
+            self.checked = now
+
+    def verify(self, token:str):
+        # 返回 {'user', 'auth'}，token 无效、过期或已吊销时返回 None
+        claims = self.decode(token)
+        if claims == None:
+            return None
+        self._refresh()
+        if claims['id'] in self.revoked_tokens or claims['issued'] < self.revoked_users.get(claims['user'], 0):
+            return None
+        return {'user': claims['user'], 'auth': claims['auth']}
+
+    def _revoke(self, field:str, value:int):
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hset(self.key, field, value)
+        pipe.hgetall(self.key)
+        values = pipe.execute()[1]
+        # 清理对应 token 都已过期的记录
+        expired = [name for name, val in values.items() if (name.startswith('t:') and int(val) < now)
+                   or (name.startswith('u:') and int(val) / 1000 + self.max_expire < now)]
+        if len(expired) > 0:
+            self.redis.hdel(self.key, *expired)
+        # 本实例立即生效，其他实例在 refresh_interval 秒内生效
+        self.checked = 0
+
+    def revoke(self, token:str):
+        claims = self.decode(token)
+        if claims == None:
+            return False
+        self._revoke('t:' + claims['id'], claims['expire'])
+        return True
+
+    def revoke_user(self, user:str):
+        self._revoke('u:' + user, int(time.time() * 1000))
@@ -1,6 +1,7 @@
 import boto3
 import json
 import os
+import hashlib
 
 CACHE_BASE_TTL=3600
 CACHE_LONG_TTL=86400
@@ -17,20 +18,116 @@ CACHEKEY_ONLINE_SERVERS = 'online'
 CACHEKEY_RECENT_TASKS = 'task'
 # 用于登录用户授权
 CACHEKEY_USERAUTH = 'user'
+# 用于登录 token 的吊销记录（注销、修改密码）
+CACHEKEY_USERREVOKED = 'userrevoked'
 # 用于暂停客户端任务，value为重试时间，如3600秒
 CACHEKEY_PAUSE = 'pause'
+# 用于进程内缓存的代数计数器，递增后各Lambda清空进程内缓存
+CACHEKEY_LOCAL_GENERATION = 'lgen'
+# 用于iprange内存索引的版本号，导入iprange数据后递增，通知各Lambda重建索引
+CACHEKEY_IPRANGE_VERSION = 'iprver'
+# 用于每个城市可ping ip的集合，key 后接 city_id
+CACHEKEY_PINGABLE_POOL = 'pool'
+# 用于有可ping ip的城市列表
+CACHEKEY_PINGABLE_CITIES = 'pcity'
+# 用于每个探测客户端的处理能力统计，key 后接 ping/data 和客户端ip
+CACHEKEY_DETECTOR = 'det'
+# 用于 SQL 文件导入的断点，key 后接文件标识
+CACHEKEY_SQL_IMPORT = 'import'
+# 用于状态页面统计数据的短时间缓存，key 后接统计项名称
+CACHEKEY_STATISTICS = 'stat'
+# 用于状态页面写入时维护的计数（可ping ip、城市、ip段）
+CACHEKEY_STATUS_COUNTERS = 'status'
 
-# 每个cityid对保存的最新记录条数，默认7次
+# 进程内缓存（L1）：按key前缀限制的最多条数，缓存时间，检查代数计数器的间隔秒数，单条缓存的最大长度
+LOCAL_CACHE_PREFIXES = {CACHEKEY_SQL + 'sl_': 1000, CACHEKEY_SQL + 'ov_': 200}
+LOCAL_CACHE_TTL = 60
+LOCAL_CACHE_CHECK_INTERVAL = 5
+LOCAL_CACHE_MAX_VALUE_SIZE = 256 * 1024
+
+# 缓存编码：columnar 对表格形式的查询结果按列编码，json 只使用 json 编码
+# 编码后超过 CACHE_COMPRESS_THRESHOLD 字节时使用 zlib 压缩，表格形式至少 CACHE_COLUMNAR_MIN_ROWS 行才使用列式编码
+CACHE_CODEC = 'columnar'
+CACHE_COMPRESS_THRESHOLD = 1024
+CACHE_COMPRESS_LEVEL = 6
+CACHE_COLUMNAR_MIN_ROWS = 16
+
+# iprange内存索引的快照文件，以及检查版本号的间隔秒数
+IPRANGE_INDEX_FILE = '/tmp/iprange_index.bin'
+IPRANGE_INDEX_CHECK_INTERVAL = 60
+
+# 每个cityid对保存的最新记录条数，默认7次，statistics 表中每个cityid对固定这么多个槽位，新数据覆盖最旧的槽位
 MAX_RECORDS_PER_CITYID = 7
+# 升级后按数据库实际的表结构选择新旧读写方式，表结构的缓存秒数，执行 admin migrate_* 后最多这么久切换到新结构
+SCHEMA_CHECK_INTERVAL = 300
+# 是否使用 statistics_rollup 表，写入时更新每个cityid对的汇总数据，查询延迟时直接读取汇总结果
+# 表不存在时（还没有重新上传 init.sql）自动使用 statistics 表
+STATISTICS_ROLLUP = True
+# 汇总表中指数加权移动平均的系数，越大越偏向最新数据
+STATISTICS_EWMA_ALPHA = 0.3
+# 是否为每条统计数据保存可合并的延迟分布（sketch 列），多个cityid对汇总时可以计算真实的分位数
+# 需要 statistics 和 statistics_rollup 表有 sketch 列（admin 执行 migrate_statistics_columns），没有 sketch 列时不保存
+STATISTICS_SKETCH = True
+# 延迟分布分位数的相对误差
+STATISTICS_SKETCH_ACCURACY = 0.01
+
+# /api/performance 原始数据分页的每页条数，客户端支持 gzip 时每页可以更多
+# alb 调用 Lambda 有 1MB 限制，未压缩 2000 条记录大概 670KB
+RAWDATA_PAGE_SIZE = 2000
+RAWDATA_GZIP_PAGE_SIZE = 5000
+# 响应体超过此长度且客户端支持时使用 gzip 压缩
+RESPONSE_GZIP_MIN_SIZE = 1024
+
+# 批量写入可ping ip时每条语句的行数
+PINGABLE_BATCH_SIZE = int(os.environ.get('PINGABLE_BATCH_SIZE', '500'))
+# 可ping ip集合的过期时间，过期后从数据库重建
+PINGABLE_POOL_TTL = 86400
+# ping 任务的租约时间，客户端取出任务后超过这个时间没有提交结果，任务会重新放回队列
+JOB_LEASE_SECONDS = 600
+# ping 任务队列的高水位，produce_ping_jobs 补充任务直到队列达到这个长度
+PING_QUEUE_HIGH_WATER = 500
+# produce_ping_jobs 锁的过期时间和每次执行的最长时间（秒），定时每分钟执行一次
+PING_PRODUCER_LOCK_SECONDS = 60
+PING_PRODUCER_MAX_SECONDS = 50
+# mysql_dump 并行导出的表数，以及 S3 分片上传的分片大小（每个表最多占用一个分片的内存）
+MYSQL_DUMP_WORKERS = 4
+MYSQL_DUMP_PART_SIZE = 8 * 1024 * 1024
+# exec_sqlfile 每个事务提交的语句数，读取文件的缓冲区大小，以及 Lambda 剩余多少秒时保存断点并重新调用自己继续导入
+SQL_IMPORT_BATCH_STATEMENTS = 20
+SQL_IMPORT_READ_SIZE = 8 * 1024 * 1024
+SQL_IMPORT_TIME_MARGIN = 60
+# zip 中操作不同表的 sql 文件并行导入的线程数（每个线程一个写连接）
+SQL_IMPORT_WORKERS = 4
+# 状态页面统计项并发查询的线程数（不超过连接池大小），各分组统计结果的缓存秒数
+STATISTICS_WORKERS = 4
+STATISTICS_CACHE_TTL = {'db': 60, 'redis': 5, 'clients': 10}
+# /api/runsql 和 exec_sql 每条查询默认返回的行数和最大行数，单元格最大长度，执行时间上限（秒）
+QUERY_MAX_ROWS = 500
+QUERY_MAX_ROWS_LIMIT = 10000
+QUERY_MAX_CELL = 1024
+QUERY_MAX_SECONDS = 25
+# admin exec_sql 的执行时间上限（秒），admin Lambda 超时为15分钟，用于执行较慢的维护语句（如 ALTER TABLE）
+ADMIN_QUERY_MAX_SECONDS = 840
+# 发送 SQS 消息的并发线程数和失败重试次数
+SQS_SEND_WORKERS = int(os.environ.get('SQS_SEND_WORKERS', '8'))
+SQS_SEND_RETRIES = 5
+# 每个探测客户端每次下发的任务数：(初始值, 最大值)，按客户端处理能力在 1 到最大值之间调整
+DETECTOR_BATCH = {'ping': (20, 100), 'data': (10, 50)}
+# 一批任务的目标处理时间（秒），按 DETECTOR_HEADROOM 留出余量，需要小于 JOB_LEASE_SECONDS
+DETECTOR_TARGET_SECONDS = 120
+DETECTOR_HEADROOM = 0.8
+# 没有任务时的请求间隔（秒），从最小值开始，连续没有任务时加倍直到最大值
+DETECTOR_IDLE_INTERVAL = (60, 3600)
 
-# 可ping ip的存活时间，只用最近4次就可以了
-STABLE_PINGABLE_IP = '15' # 1111b
-NEW_PINGABLE_IP = '8' # 1000b
-LOSS_PINGABLE_IP = '7' # 0111b
-DELETE_PINGABLE_IP = '0' # 00000000b
-#STABLE_PINGABLE_IP = '240' # 11110000b
-#NEW_PINGABLE_IP = '128' # 10000000b
-#LOSS_PINGABLE_IP = '127' # 01111111b
+# 可ping ip的存活状态按全局的发现周期（epoch）计算，epoch = 天数 // PINGABLE_EPOCH_DAYS，iprange 在每个周期开始后重新检查一次
+# pingable 表的 last_epoch 为最近一次探测到的周期，seen 为 last_epoch 及之前3个周期是否探测到的位图，只用最近4次就可以了
+PINGABLE_EPOCH_DAYS = 14
+PINGABLE_HISTORY_EPOCHS = 4
+STABLE_PINGABLE_IP = '15' # 1111b 最近4个周期都探测到
+NEW_PINGABLE_IP = '8' # 1000b last_epoch 周期探测到
+# 后台每次删除过期ip的条数，以及每次执行的最长时间（秒）
+PINGABLE_SWEEP_BATCH = 5000
+PINGABLE_SWEEP_MAX_SECONDS = 600
 
 # 权限划分
 # 不需要授权
@@ -41,6 +138,9 @@ AUTH_BASEUSER = 1
 AUTH_READONLY = 1 | 2
 # 系统管理员
 AUTH_ADMIN = 1 | 2 | 4
+# 登录 token 的最长有效期（秒），吊销记录在本地缓存的刷新间隔（秒）
+AUTH_TOKEN_MAX_EXPIRE = 30 * 86400
+AUTH_REVOCATION_REFRESH = 5
 
 S3_BUCKET = os.environ.get('S3_BUCKET', 'cloudperf')
 
@@ -51,6 +151,10 @@ DB_READ_HOST = os.environ.get('DB_READ_HOST', 'rds-r.cloudperf.vpc')
 DB_WRITE_HOST = os.environ.get('DB_WRITE_HOST', 'rds.cloudperf.vpc')
 DB_PORT = int(os.environ.get('DB_PORT', '3306'))
 DB_DATABASE='cloudperf'
+# 连接池每种连接最多保留的空闲连接数，空闲超过多少秒关闭，空闲超过多少秒取出时先ping检查
+MYSQL_POOL_MAX_SIZE = int(os.environ.get('MYSQL_POOL_MAX_SIZE', '4'))
+MYSQL_POOL_MAX_IDLE = int(os.environ.get('MYSQL_POOL_MAX_IDLE', '300'))
+MYSQL_POOL_PING_INTERVAL = int(os.environ.get('MYSQL_POOL_PING_INTERVAL', '5'))
 DB_SECRET = os.environ.get('DB_SECRET', '')
 if DB_SECRET != '':
     secrets_manager = boto3.client('secretsmanager')
@@ -61,3 +165,6 @@ if DB_SECRET != '':
 else:
     DB_USER = os.environ.get('DB_USER', '')
     DB_PASS = os.environ.get('DB_PASS', '')
+# 登录 token 的签名密钥，没有配置时由数据库密码派生，所有 Lambda 使用相同的密钥，修改数据库密码后已签发的 token 全部失效
+# 两者都没有配置时密钥为空，不签发也不接受签名 token（不能使用公开可推算的密钥）
+AUTH_TOKEN_KEY = os.environ.get('AUTH_TOKEN_KEY', '').encode('utf-8') or (hashlib.sha256(('cloudperf-token:' + DB_PASS).encode('utf-8')).digest() if DB_PASS else b'')
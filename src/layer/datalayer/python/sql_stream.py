@@ -0,0 +1,107 @@
+import io
+import re
+import redis
+
+# 从二进制流中逐条读取 SQL 语句，按块读取，不需要把整个文件读到内存中
+# 一条语句用一个正则匹配到分号为止：'...' "..." `...`（包括反斜杠转义）和 -- # /* */ 注释作为整体匹配，其中的分号不结束语句
+# 使用占有量词，块中的语句不完整时直接匹配失败，不会回溯；注释必须匹配到结束符，块边界处不完整的注释不会被当作正文
+# 按字节匹配，utf-8 多字节字符中不会出现 ASCII 字节，不需要先解码；返回每条语句结束后在流中的字节偏移，用于断点续传
+# 不支持 DELIMITER 命令（mysqldump 和 admin 导出的文件都不使用）
+STATEMENT = re.compile(rb"""(?:[^;'"`#/-]++|'(?:[^'\\]++|\\.)*+'|"(?:[^"\\]++|\\.)*+"|`[^`]*+`|/\*.*?\*/|/(?!\*)|#[^\n]*+\n|--(?:[ \t\r][^\n]*+)?\n|-(?!-[ \t\r\n]))*+;""", re.S)
+# 判断语句是否只有注释，/*! */ 是会执行的版本注释，不去掉
+COMMENT = re.compile(rb"/\*(?!!).*?\*/|#[^\n]*\n|--(?:[ \t\r][^\n]*)?\n", re.S)
+COMMENT_TEXT = re.compile(COMMENT.pattern.decode(), re.S)
+
+def has_statement(data:bytes):
+    head = data.lstrip()[:1]
+    if head in (b'-', b'#', b'/'):
+        return COMMENT.sub(b'', data + b'\n').strip() != b''
+    return head != b''
+
+def iter_sql_statements(stream, offset:int = 0, chunk_size:int = 1 << 20, max_statement:int = 64 << 20):
+    # stream 需要已经位于 offset 处，返回 (语句, 语句结束后的字节偏移)
+    buf = b''
+    pos = 0
+    base = offset # buf[0] 在流中的偏移
+    eof = False
+    while True:
+        m = STATEMENT.match(buf, pos)
+        if m:
+            statement = buf[pos:m.end() - 1]
+            pos = m.end()
+            if has_statement(statement):
+                yield statement.decode('utf-8').strip(), base + pos
+            continue
+        if eof:
+            break
+        if len(buf) - pos > max_statement:
+            raise ValueError(f'statement at offset {base + pos} exceeds {max_statement} bytes or has unterminated quote')
+        # 语句比块大时按剩余长度读取，避免反复匹配
+        chunk = stream.read(max(chunk_size, len(buf) - pos))
+        if not chunk:
+            eof = True
+        buf = buf[pos:] + chunk
+        base += pos
+        pos = 0
+    # 最后一条语句可以没有分号
+    if has_statement(buf[pos:]):
+        yield buf[pos:].decode('utf-8').strip(), base + len(buf)
+
+# 语句开头操作的表名，以及 CREATE TABLE 中外键引用的表，用于判断导入文件之间的依赖
+TABLE_STATEMENT = re.compile(r"(?:INSERT\s+(?:IGNORE\s+)?INTO|REPLACE\s+INTO|CREATE\s+TABLE(?:\s+IF\s+NOT\s+EXISTS)?|DROP\s+TABLE(?:\s+IF\s+EXISTS)?|"
+    r"ALTER\s+TABLE|LOCK\s+TABLES|TRUNCATE(?:\s+TABLE)?|DELETE\s+FROM|UPDATE)\s+`?(\w+)`?", re.I)
+REFERENCES = re.compile(r"REFERENCES\s+`?(\w+)`?", re.I)
+
+# 读取流开头最多 limit 字节，返回 (操作的表, 外键引用的表)
+# 读取的内容被截断时最后一条语句不完整（可能截断在多字节字符或表名中间），按忽略错误解码，只使用其中后面还有内容的表名
+def scan_sql_tables(stream, limit:int = 1 << 20):
+    data = stream.read(limit + 1)
+    truncated = len(data) > limit
+    data = data[:limit]
+    statements = []
+    pos = 0
+    while True:
+        m = STATEMENT.match(data, pos)
+        if not m:
+            break
+        statements.append((data[pos:m.end() - 1], True))
+        pos = m.end()
+    statements.append((data[pos:], not truncated))
+    tables = set()
+    references = set()
+    for statement, complete in statements:
+        if not has_statement(statement):
+            continue
+        statement = statement.decode('utf-8', errors='ignore')
+        statement = COMMENT_TEXT.sub('', statement + '\n').strip()
+        m = TABLE_STATEMENT.match(statement)
+        if m and (complete or m.end() < len(statement)):
+            tables.add(m.group(1).lower())
+            if m.group(0)[:6].upper() == 'CREATE':
+                references.update(r.group(1).lower() for r in REFERENCES.finditer(statement) if complete or r.end() < len(statement))
+    return tables, references - tables
+
+def split_sql_statements(sql:str):
+    return [statement for statement, offset in iter_sql_statements(io.BytesIO(sql.encode('utf-8')))]
+
+# 导入进度保存在 redis 哈希表中：文件名 -> 已提交的字节偏移，全部完成的文件为 done
+# key 包含源文件的标识（如 S3 的 ETag），文件内容变化后不会使用旧的进度
+class SqlImportCheckpoint:
+    DONE = 'done'
+
+    def __init__(self, redis_pool, cache_key:str, ttl:int = 604800):
+        self.redis = redis.StrictRedis(connection_pool=redis_pool)
+        self.key = cache_key
+        self.ttl = ttl
+
+    def load(self):
+        return self.redis.hgetall(self.key)
+
+    def save(self, name:str, offset):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hset(self.key, name, offset)
+        pipe.expire(self.key, self.ttl)
+        pipe.execute()
+
+    def clear(self):
+        self.redis.delete(self.key)
@@ -0,0 +1,100 @@
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+# SQS 批量发送：按条数（最多10条）和总大小（最多256KB）打包，在线程池中并发发送，共用一个 boto3 客户端（客户端是线程安全的）
+# 批次中失败的条目（SenderFault 为 false，如限流、服务端错误）和整批失败（限流、网络错误）按指数退避重试
+# SenderFault 为 true 的条目（如消息格式错误）和超过最大长度的消息不重试，直接记录为失败
+MAX_BATCH_COUNT = 10
+MAX_BATCH_BYTES = 262144
+# 整批重试的错误码，其他 ClientError 为请求本身的问题，重试也不会成功
+RETRY_ERROR_CODES = {'ThrottlingException', 'RequestThrottled', 'ServiceUnavailable', 'InternalError', 'InternalFailure',
+                     'AWS.SimpleQueueService.RequestThrottled', 'KmsThrottled', 'RequestLimitExceeded'}
+
+class SqsBatchSender:
+    def __init__(self, client, max_workers:int = 8, max_retries:int = 5, base_delay:float = 0.1, max_delay:float = 5):
+        self.client = client
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def pack(self, entries:list):
+        # 按顺序打包，条数或总大小超过限制时开始新的一批，返回 (批次列表, 超过最大长度的条目)
+        batches = []
+        oversize = []
+        batch = []
+        size = 0
+        for entry in entries:
+            length = len(entry['MessageBody'].encode('utf-8'))
+            if length > MAX_BATCH_BYTES:
+                oversize.append(entry)
+                continue
+            if len(batch) >= MAX_BATCH_COUNT or size + length > MAX_BATCH_BYTES:
+                batches.append(batch)
+                batch = []
+                size = 0
+            batch.append(entry)
+            size += length
+        if batch:
+            batches.append(batch)
+        return batches, oversize
+
+    def _backoff(self, attempt:int):
+        # full jitter，避免多个线程同时重试
+        time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt))))
+
+    def _send_batch(self, queue_url:str, batch:list):
+        successful = []
+        failed = []
+        retries = 0
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                retries += 1
+                self._backoff(attempt - 1)
+            try:
+                response = self.client.send_message_batch(QueueUrl=queue_url, Entries=batch)
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code', '')
+                error = {'Code': code, 'Message': str(e)}
+                if code in RETRY_ERROR_CODES:
+                    continue
+                break
+            except Exception as e:
+                # 网络错误等，整批重试
+                error = {'Code': type(e).__name__, 'Message': str(e)}
+                continue
+            successful.extend(response.get('Successful', []))
+            retry_ids = set()
+            for entry in response.get('Failed', []):
+                if entry.get('SenderFault'):
+                    failed.append(entry)
+                else:
+                    retry_ids.add(entry['Id'])
+            batch = [entry for entry in batch if entry['Id'] in retry_ids]
+            if len(batch) == 0:
+                return successful, failed, retries
+            error = {'Code': 'BatchEntryFailed', 'Message': 'entry failed after retries'}
+        failed.extend({'Id': entry['Id'], 'SenderFault': False, 'Code': error['Code'], 'Message': error['Message']} for entry in batch)
+        return successful, failed, retries
+
+    def send(self, queue_url:str, messages:list):
+        # messages 为 JSON 对象列表，返回 {'successful': [...], 'failed': [...], 'batches': 批次数, 'retries': 重试次数}
+        entries = [{'Id': str(i), 'MessageBody': json.dumps(message)} for i, message in enumerate(messages)]
+        batches, oversize = self.pack(entries)
+        results = {
+            'successful': [],
+            'failed': [{'Id': entry['Id'], 'SenderFault': True, 'Code': 'MessageTooLong', 'Message': 'message exceeds 256KB'} for entry in oversize],
+            'batches': len(batches),
+            'retries': 0
+        }
+        if len(batches) == 0:
+            return results
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as executor:
+            for successful, failed, retries in executor.map(lambda batch: self._send_batch(queue_url, batch), batches):
+                results['successful'].extend(successful)
+                results['failed'].extend(failed)
+                results['retries'] += retries
+        return results
@@ -0,0 +1,63 @@
+import json
+import time
+import redis
+
+# 状态页面的计数（可ping ip、城市、ip段等），在写入数据时增量维护，读取时不需要扫描大表
+# 计数保存在哈希表 {cache_key} 中，epoch 字段为计数对应的发现周期；每个城市存活（未被清理）的 ip 数保存在 {cache_key}:city 中，用于维护 cityid-ping
+# 跨周期时存活、丢失的划分整体变化，无法增量计算，周期变化后增量不再写入，由 reconcile 从数据库重新统计
+# ip 段过期（cidr-ready 变为 cidr-outdated）只和时间有关，也依靠定时 reconcile 修正
+
+# KEYS: counters, cities  ARGV: epoch, 计数增量 json, 城市增量 json
+APPLY_SCRIPT = '''
+if redis.call('HGET', KEYS[1], 'epoch') ~= ARGV[1] then
+    return 0
+end
+for field, delta in pairs(cjson.decode(ARGV[2])) do
+    redis.call('HINCRBY', KEYS[1], field, delta)
+end
+for city, delta in pairs(cjson.decode(ARGV[3])) do
+    local count = redis.call('HINCRBY', KEYS[2], city, delta)
+    if count == delta and delta > 0 then
+        redis.call('HINCRBY', KEYS[1], 'cityid-ping', 1)
+    elseif count <= 0 then
+        redis.call('HDEL', KEYS[2], city)
+        if count - delta > 0 then
+            redis.call('HINCRBY', KEYS[1], 'cityid-ping', -1)
+        end
+    end
+end
+return 1
+'''
+
+class StatusCounters:
+    FIELDS = ('ping-stable', 'ping-new', 'ping-loss', 'cityid-ping', 'cityid-pair', 'cidr-ready', 'cidr-outdated')
+
+    def __init__(self, redis_pool, cache_key:str):
+        self.redis = redis.StrictRedis(connection_pool=redis_pool)
+        # 两个 key 使用相同的哈希标签，lua 脚本和事务中可以同时操作
+        self.key = '{' + cache_key + '}'
+        self.city_key = self.key + ':city'
+        self.apply_script = self.redis.register_script(APPLY_SCRIPT)
+
+    def load(self, epoch:int):
+        # 返回计数，没有统计过或不是 epoch 周期的计数时返回 None
+        values = self.redis.hgetall(self.key)
+        if values.get('epoch') != str(epoch):
+            return None
+        return {field: int(values.get(field, 0)) for field in self.FIELDS}
+
+    def apply(self, epoch:int, deltas:dict, cities:dict = None):
+        deltas = {field: delta for field, delta in deltas.items() if delta != 0}
+        cities = {str(city): delta for city, delta in (cities or {}).items() if delta != 0}
+        if len(deltas) == 0 and len(cities) == 0:
+            return True
+        return self.apply_script(keys=[self.key, self.city_key], args=[epoch, json.dumps(deltas), json.dumps(cities)]) == 1
+
+    def reset(self, epoch:int, values:dict, cities:dict):
+        # 用数据库统计的结果替换所有计数，统计期间写入的增量会被覆盖，误差由下一次 reconcile 修正
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.delete(self.city_key)
+        if len(cities) > 0:
+            pipe.hset(self.city_key, mapping=cities)
+        pipe.hset(self.key, mapping={**values, 'cityid-ping': len(cities), 'epoch': epoch, 'time': int(time.time())})
+        pipe.execute()
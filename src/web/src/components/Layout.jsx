@@ -132,7 +132,13 @@ export default function Layout() {
 
     }, [location, navigate]);
 
-    const handleLogout = () => {
+    const handleLogout = async () => {
+        try {
+            // Revoke the token on the server, clear the cookie even if it fails
+            await fetch('/api/logout', { method: 'POST' });
+        } catch (err) {
+            console.error('Logout failed:', err);
+        }
         document.cookie = 'cp_token=; path=/; expires=Thu, 01 Jan 1970 00:00:01 GMT';
         navigate('/login');
     };
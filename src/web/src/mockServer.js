@@ -140,6 +140,8 @@ export function startMockServer() {
                 return new Response(401, {}, { error: "Invalid credentials" });
             });
 
+            this.post("/logout", () => "success");
+
             // Status endpoint
             this.get("/status", () => ({
                 activeNodes: Math.floor(Math.random() * 100 + 200),
@@ -29,7 +29,8 @@ import {
     TableHead,
     TableRow,
     Checkbox,
-    FormControlLabel
+    FormControlLabel,
+    Alert
 } from '@mui/material';
 import {
     BarChart,
@@ -298,7 +299,7 @@ export default function NetworkSearch() {
                 fetchPerformanceData(srcCityIds, destCityIds, false),
                 fetchPerformanceData(srcCityIds, destCityIds, true)
             ]);
-            const compData = { ...data, rawData };
+            const compData = { ...data, rawData: rawData.rows, rawDataTruncated: rawData.truncated };
             setPerformanceData(compData);
         } catch (error) {
             console.error('Error fetching performance data:', error);
@@ -755,6 +756,11 @@ export default function NetworkSearch() {
                                         </Select>
                                     </FormControl>
                                 </Box>
+                                {performanceData.rawDataTruncated && (
+                                    <Alert severity="warning" sx={{ mb: 2 }}>
+                                        Only the first {performanceData.rawData.length} records are loaded, narrow the source or destination selection to see all records.
+                                    </Alert>
+                                )}
                                 <ResponsiveContainer width="100%" height={300}>
                                     <ScatterChart margin={{ top: 20, right: 20, bottom: 20, left: 20 }}>
                                         <CartesianGrid strokeDasharray="3 3" />
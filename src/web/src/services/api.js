@@ -2,6 +2,9 @@ const API_BASE_URL = import.meta.env.VITE_API_URL || '/api';
 
 const TIMEOUT_MS = 300000; // 5 mins timeout
 
+// Stop following X-Next-Cursor after this many pages, the result is marked as truncated
+const MAX_RAWDATA_PAGES = 20;
+
 const fetchWithTimeout = async (url, options = {}) => {
     const controller = new AbortController();
     const timeout = setTimeout(() => controller.abort(), TIMEOUT_MS);
@@ -93,9 +96,21 @@ export const fetchPerformanceData = async (srcCityIds = [], destCityIds = [], ra
         const params = new URLSearchParams();
         if (srcCityIds.length) params.append('src', srcCityIds.join(','));
         if (destCityIds.length) params.append('dist', destCityIds.join(','));
-        if (rawData) params.append('rawData', '1')
-        const response = await fetchWithTimeout(`${API_BASE_URL}/performance?${params.toString()}`);
-        return handleJsonResponse(response);
+        if (!rawData) {
+            const response = await fetchWithTimeout(`${API_BASE_URL}/performance?${params.toString()}`);
+            return handleJsonResponse(response);
+        }
+        // rawData is paginated, follow X-Next-Cursor until the last page, returns { rows, truncated }
+        params.append('rawData', '1');
+        const rows = [];
+        for (let page = 0; page < MAX_RAWDATA_PAGES; page++) {
+            const response = await fetchWithTimeout(`${API_BASE_URL}/performance?${params.toString()}`);
+            rows.push(...await handleJsonResponse(response));
+            const cursor = response.headers.get('X-Next-Cursor');
+            if (!cursor) return { rows, truncated: false };
+            params.set('cursor', cursor);
+        }
+        return { rows, truncated: true };
     } catch (error) {
         console.error('Error fetching performance data:', error);
         throw error;
@@ -0,0 +1,12 @@
+import os
+import sys
+import pytest
+
+# datalayer 层的纯 python 模块测试，直接从 layer 目录导入
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../src/layer/datalayer/python'))
+
+@pytest.fixture
+def redis_pool():
+    # 与 settings.redis_pool 一致，decode_responses=True；需要 fakeredis[lua]
+    fakeredis = pytest.importorskip('fakeredis')
+    return fakeredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True).connection_pool
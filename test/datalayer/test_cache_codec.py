@@ -0,0 +1,43 @@
+import json
+import pytest
+import cache_codec
+
+ROWS = [{'id': i, 'rtt': i * 1.5, 'big': 2 ** 60 + i, 'name': f'城市{i}', 'extra': None if i % 2 else {'a': [i]}} for i in range(100)]
+
+@pytest.mark.parametrize('value', [
+    ROWS,
+    ROWS[:3],
+    [{'id': 1, 'n': 2 ** 53 + 1}] * 20,
+    [{'x': 1.0}, {'x': 2}] * 10,
+    {'a': 1, 'b': [1, 2, 3]},
+    list(range(1000)),
+    'x' * 5000,
+    [],
+    None,
+])
+def test_round_trip(value):
+    assert cache_codec.decode(cache_codec.encode(value)) == value
+
+def test_small_value_is_json():
+    # 小数据保存为 json 文本，旧版本可以直接读取
+    data = cache_codec.encode({'a': 1})
+    assert json.loads(data) == {'a': 1}
+
+def test_columnar_and_compressed():
+    data = cache_codec.encode(ROWS)
+    assert data[:1] == cache_codec.MAGIC
+    assert data[1] == cache_codec.FORMAT_COLUMNAR | cache_codec.FLAG_ZLIB
+    assert len(data) < len(cache_codec.json_bytes(ROWS))
+
+def test_not_table():
+    rows = [{'a': 1, 'b': 2}] * 20 + [{'b': 2, 'a': 1}]
+    assert not cache_codec.is_table(rows)
+    assert cache_codec.decode(cache_codec.encode(rows)) == rows
+
+def test_decode_legacy_json():
+    assert cache_codec.decode('[{"a": 1}]') == [{'a': 1}]
+    assert cache_codec.decode(b'{"a": 1}') == {'a': 1}
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        cache_codec.decode(cache_codec.MAGIC + b'\x03{}')
@@ -0,0 +1,26 @@
+import time
+import pytest
+from detector_capacity import DetectorCapacity
+
+@pytest.fixture
+def capacity(redis_pool):
+    return DetectorCapacity(redis_pool, 'cap', '10.0.0.1', 10, 100, target_seconds=120, headroom=0.8)
+
+def test_dispatch_interval_without_history(capacity):
+    assert capacity.record_dispatch(10) == 1
+
+def test_dispatch_interval_follows_seconds_per_job(capacity, monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(time, 'time', lambda: now)
+    capacity.record_dispatch(10)
+    # 10 个任务用了 50 秒，每个任务 5 秒
+    now = 1050.0
+    assert capacity.record_results(10) == 19
+    # 19*5*0.8=76
+    assert capacity.record_dispatch(19) == 76
+
+def test_idle_interval_backoff(capacity):
+    assert capacity.record_dispatch(0) == 60
+    assert capacity.record_dispatch(0) == 120
+    capacity.record_dispatch(5)
+    assert capacity.record_dispatch(0) == 60
@@ -0,0 +1,34 @@
+from fping_parser import parse_alive_output, parse_count_lines, parse_count_output
+
+COUNT_OUTPUT = '''2.17.168.71    : 370 370.5 - 373
+38.107.236.100 : duplicate for [0], 64 bytes, 34.4 ms
+38.107.236.100 : - - - -
+10.0.0.1       : 1.25 2 3 4\r
+[DEBUG] something : 1 2
+'''
+
+def targets_rtts(result):
+    rtts, targets = result
+    return {ip: ([round(v, 2) for v in rtts[start:end]], lost) for ip, start, end, lost in targets}
+
+def test_count_output():
+    assert targets_rtts(parse_count_output(COUNT_OUTPUT)) == {
+        '2.17.168.71': ([370.0, 370.5, 373.0], 1),
+        '38.107.236.100': ([], 4),
+        '10.0.0.1': ([1.25, 2.0, 3.0, 4.0], 0),
+    }
+
+def test_count_output_malformed_line():
+    # 格式异常的行被跳过，其他行的结果不受影响
+    output = '1.1.1.1 : 1 2\n2.2.2.2 : 1.2.3 4\n3.3.3.3 : - 5\n'
+    expected = {'1.1.1.1': ([1.0, 2.0], 0), '3.3.3.3': ([5.0], 1)}
+    assert targets_rtts(parse_count_output(output)) == expected
+    assert targets_rtts(parse_count_lines(output)) == expected
+
+def test_count_output_empty():
+    rtts, targets = parse_count_output('')
+    assert len(rtts) == 0 and targets == []
+
+def test_alive_output():
+    output = '1.2.3.4\n10.0.0.255\r\n256.1.1.1\n1.2.3\nICMP Host Unreachable from 1.1.1.1\n01.2.3.4\n'
+    assert parse_alive_output(output) == ['1.2.3.4', '10.0.0.255']
@@ -0,0 +1,50 @@
+import pytest
+from iprange_index import IPRangeIndex
+
+ROWS = [(10, 19, 1), (20, 29, 1), (25, 40, 1), (50, 59, 2), (60, 69, 3), (100, 199, 3)]
+
+@pytest.fixture
+def index(redis_pool, tmp_path):
+    loads = []
+    def loader():
+        loads.append(1)
+        return ROWS
+    index = IPRangeIndex(redis_pool, 'iprangeversion', loader, str(tmp_path / 'iprange.idx'))
+    index.loads = loads
+    return index
+
+def test_build_and_lookup(index):
+    index.build(ROWS)
+    # 相邻或重叠且 city_id 相同的段合并
+    assert list(index.starts) == [10, 50, 60, 100]
+    assert index.lookup(9) is None
+    assert index.lookup(10) == (10, 40, 1)
+    assert index.lookup(40) == (10, 40, 1)
+    assert index.lookup(45) is None
+    assert index.lookup(55) == (50, 59, 2)
+    assert index.lookup(60) == (60, 69, 3)
+    assert index.lookup(150) == (100, 199, 3)
+    assert index.lookup(200) is None
+
+def test_empty_index(index):
+    index.build([])
+    assert index.lookup(1) is None
+    assert index.get_metrics()['ranges'] == 0
+
+def test_refresh_and_snapshot(index, redis_pool, tmp_path):
+    assert index.refresh()
+    assert index.lookup(55) == (50, 59, 2)
+    assert len(index.loads) == 1
+    # 同一执行环境的新实例直接读取快照，不调用 loader
+    other = IPRangeIndex(redis_pool, 'iprangeversion', lambda: pytest.fail('should load snapshot'), str(tmp_path / 'iprange.idx'))
+    assert other.refresh()
+    assert other.lookup(150) == (100, 199, 3)
+    # 版本号变化后重新构建
+    index.bump_version()
+    index.checked = 0
+    assert index.refresh()
+    assert index.version == 1 and len(index.loads) == 2
+
+def test_build_failure(index):
+    index.loader = lambda: 1 / 0
+    assert not index.refresh()
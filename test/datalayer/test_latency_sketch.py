@@ -0,0 +1,55 @@
+import random
+import pytest
+from latency_sketch import LatencySketch
+
+def percentile(values, p):
+    values = sorted(values)
+    return float(values[int(p / 100.0 * (len(values) - 1))])
+
+def make(values, accuracy=0.01):
+    sketch = LatencySketch(accuracy)
+    for v in values:
+        sketch.add(v)
+    return sketch
+
+def test_quantiles_within_accuracy():
+    rnd = random.Random(1)
+    values = [int(rnd.lognormvariate(10, 1)) for i in range(5000)] + [0] * 50
+    sketch = make(values)
+    for p in (1, 10, 50, 90, 99, 99.9):
+        expected = percentile(values, p)
+        assert abs(sketch.quantile(p) - expected) <= expected * 0.01 + 1e-9
+    assert sketch.quantile(0) == min(values)
+    assert sketch.quantile(100) == max(values)
+    assert sketch.avg() == sum(values) / len(values)
+
+def test_encode_round_trip():
+    rnd = random.Random(2)
+    sketch = make([rnd.randint(0, 10 ** 7) for i in range(1000)], 0.02)
+    decoded = LatencySketch.decode(sketch.encode())
+    assert decoded.accuracy == sketch.accuracy
+    assert decoded.gamma == sketch.gamma
+    assert (decoded.count, decoded.zero, decoded.min, decoded.max, decoded.sum) == (sketch.count, sketch.zero, sketch.min, sketch.max, sketch.sum)
+    assert decoded.buckets == sketch.buckets
+    assert LatencySketch.decode(LatencySketch().encode()).count == 0
+
+def test_merge_equals_single_sketch():
+    rnd = random.Random(3)
+    values = [rnd.randint(0, 10 ** 6) for i in range(3000)]
+    merged = LatencySketch()
+    for i in range(0, len(values), 500):
+        merged.merge(LatencySketch.decode(make(values[i:i + 500]).encode()))
+    whole = make(values)
+    assert merged.buckets == whole.buckets
+    assert (merged.count, merged.min, merged.max, merged.sum) == (whole.count, whole.min, whole.max, whole.sum)
+    assert merged.quantile(50) == whole.quantile(50)
+
+def test_merge_accuracy_mismatch():
+    with pytest.raises(ValueError):
+        make([1], 0.01).merge(make([1], 0.02))
+
+def test_empty():
+    sketch = LatencySketch()
+    assert sketch.quantile(50) is None
+    assert sketch.avg() is None
+    assert sketch.merge(LatencySketch()).count == 0
@@ -0,0 +1,28 @@
+import pytest
+from pingable_pool import PingablePool
+
+IPS = {1: [11, 12], 2: [21]}
+
+@pytest.fixture
+def pool(redis_pool):
+    return PingablePool(redis_pool, 'pool', 'pcity', lambda city_id: IPS.get(city_id, []), lambda: list(IPS))
+
+def test_random_ips_rebuild(pool):
+    assert sorted(pool.random_ips(1)) == [11, 12]
+    assert pool.random_ips(3) == []
+    assert pool.cities_after(0) == [1, 2]
+    assert pool.cities_after(1) == [2]
+
+def test_remove_last_ip(pool):
+    pool.cities_after(0)
+    pool.random_ips(2)
+    pool.remove(2, [21])
+    assert pool.random_ips(2) == []
+    assert pool.cities_after(0) == [1]
+
+def test_remove_without_pool(pool):
+    # 城市的集合不存在（过期或还没有重建）时，不能把城市从有序集合中删除
+    pool.cities_after(0)
+    pool.remove(1, [11])
+    assert pool.cities_after(0) == [1, 2]
+    assert sorted(pool.random_ips(1)) == [11, 12]
@@ -0,0 +1,87 @@
+import base64
+import hashlib
+import hmac
+import time
+import pytest
+from session_token import SessionTokens
+
+@pytest.fixture
+def tokens(redis_pool):
+    return SessionTokens(redis_pool, 'userrevoked', b'secret', max_expire=3600, refresh_interval=60)
+
+def test_issue_and_verify(tokens):
+    token, expire = tokens.issue('alice', 2, 86400)
+    assert expire == 3600
+    assert SessionTokens.is_signed(token)
+    assert all(c.isalnum() or c in '-_.' for c in token)
+    assert tokens.verify(token) == {'user': 'alice', 'auth': 2}
+    claims = tokens.decode(token)
+    assert claims['user'] == 'alice' and abs(claims['expire'] - time.time() - 3600) <= 1
+
+def test_unicode_user(tokens):
+    token, expire = tokens.issue('用户', 1, 60)
+    assert tokens.verify(token) == {'user': '用户', 'auth': 1}
+
+def test_tampered_token(tokens):
+    token, expire = tokens.issue('alice', 1, 60)
+    payload, signature = token.split('.')
+    other, expire = tokens.issue('bob', 4, 60)
+    assert tokens.verify(other.split('.')[0] + '.' + signature) is None
+    assert tokens.verify(payload + '.' + signature[:-1]) is None
+    assert tokens.verify(payload + '.') is None
+    assert tokens.verify('.' + signature) is None
+    assert tokens.verify('not-a-token') is None
+
+def test_wrong_secret(tokens, redis_pool):
+    token, expire = tokens.issue('alice', 1, 60)
+    assert SessionTokens(redis_pool, 'userrevoked', b'other').verify(token) is None
+
+def test_expired(tokens):
+    token, expire = tokens.issue('alice', 1, -1)
+    assert tokens.verify(token) is None
+
+def test_revoke(tokens, redis_pool):
+    token, expire = tokens.issue('alice', 1, 60)
+    other, expire = tokens.issue('alice', 1, 60)
+    # 另一个实例在刷新吊销记录前仍然认为 token 有效
+    instance = SessionTokens(redis_pool, 'userrevoked', b'secret', max_expire=3600, refresh_interval=60)
+    assert instance.verify(token) is not None
+    assert tokens.revoke(token)
+    assert tokens.verify(token) is None
+    assert tokens.verify(other) is not None
+    assert instance.verify(token) is not None
+    instance.checked = 0
+    assert instance.verify(token) is None
+    assert not tokens.revoke('bad.token')
+
+def test_revoke_user(tokens):
+    token, expire = tokens.issue('alice', 1, 60)
+    other, expire = tokens.issue('bob', 1, 60)
+    time.sleep(0.002)
+    tokens.revoke_user('alice')
+    assert tokens.verify(token) is None
+    assert tokens.verify(other) is not None
+    # 修改密码后重新签发的 token 有效
+    time.sleep(0.002)
+    token, expire = tokens.issue('alice', 1, 60)
+    assert tokens.verify(token) is not None
+
+def test_revoke_cleanup(tokens):
+    tokens.redis.hset(tokens.key, mapping={'t:old': int(time.time()) - 10, 'u:old': int((time.time() - 7200) * 1000)})
+    token, expire = tokens.issue('alice', 1, 60)
+    tokens.revoke(token)
+    assert set(tokens.redis.hkeys(tokens.key)) == {'t:' + tokens.decode(token)['id']}
+
+def test_user_with_colon(tokens):
+    token, expire = tokens.issue('sso:alice', 1, 60)
+    assert tokens.verify(token) == {'user': 'sso:alice', 'auth': 1}
+
+def test_no_secret(tokens, redis_pool):
+    # 没有配置密钥时不签发 token，也不接受用空密钥签名的 token
+    unsigned = SessionTokens(redis_pool, 'userrevoked', b'')
+    with pytest.raises(ValueError):
+        unsigned.issue('alice', 1, 60)
+    token, expire = SessionTokens(redis_pool, 'userrevoked', b'x').issue('alice', 1, 60)
+    payload = token.split('.')[0]
+    forged = payload + '.' + base64.urlsafe_b64encode(hmac.new(b'', payload.encode(), hashlib.sha256).digest()).rstrip(b'=').decode()
+    assert unsigned.verify(forged) is None
@@ -0,0 +1,73 @@
+import io
+import pytest
+from sql_stream import iter_sql_statements, scan_sql_tables, split_sql_statements
+
+SQL = '''-- mysqldump 文件头
+/*!40101 SET NAMES utf8mb4 */;
+DROP TABLE IF EXISTS `city`;
+CREATE TABLE `city` (`id` int, `name` varchar(64)) COMMENT='a;b';
+INSERT INTO `city` VALUES (1,'北京;'),(2,'it''s'),(3,"x\\";y"),(4,'a\\\\');
+# 注释中的 ; 不结束语句
+INSERT INTO `city` VALUES (5,'--'),(6,'/*;*/');
+/* 块注释; */ select 1--1;
+select `a;b` from city
+'''
+
+EXPECTED = [
+    "-- mysqldump 文件头\n/*!40101 SET NAMES utf8mb4 */",
+    "DROP TABLE IF EXISTS `city`",
+    "CREATE TABLE `city` (`id` int, `name` varchar(64)) COMMENT='a;b'",
+    "INSERT INTO `city` VALUES (1,'北京;'),(2,'it''s'),(3,\"x\\\";y\"),(4,'a\\\\')",
+    "# 注释中的 ; 不结束语句\nINSERT INTO `city` VALUES (5,'--'),(6,'/*;*/')",
+    "/* 块注释; */ select 1--1",
+    "select `a;b` from city",
+]
+
+def test_split_quotes_and_comments():
+    assert split_sql_statements(SQL) == EXPECTED
+
+def test_line_comments():
+    # -- 后面必须是空白或换行才是注释，单独的 -- 不能吞掉下一行
+    assert split_sql_statements('--\nDROP TABLE a;\nCREATE TABLE b(x int);') == ['--\nDROP TABLE a', 'CREATE TABLE b(x int)']
+    assert split_sql_statements('-- a;\r\n--\tb;\nselect 1-1;') == ['-- a;\r\n--\tb;\nselect 1-1']
+    assert split_sql_statements('select 1 # x;\n;\n-- ;\n') == ['select 1 # x;']
+
+def test_only_comments():
+    assert split_sql_statements('-- a\n/* b; */;\n# c\n;  ') == []
+    assert split_sql_statements('/*!40014 SET x=1 */;') == ['/*!40014 SET x=1 */']
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 16, 1 << 20])
+def test_chunk_boundaries(chunk_size):
+    data = SQL.encode('utf-8')
+    statements = list(iter_sql_statements(io.BytesIO(data), chunk_size=chunk_size))
+    assert [statement for statement, offset in statements] == EXPECTED
+    # 偏移为语句结束（分号之后）的字节位置，最后一条没有分号的语句为文件末尾
+    for statement, offset in statements[:-1]:
+        assert data[offset - 1:offset] == b';'
+    assert statements[-1][1] == len(data)
+
+@pytest.mark.parametrize('chunk_size', [1, 5, 1 << 20])
+def test_resume_offsets(chunk_size):
+    data = SQL.encode('utf-8')
+    statements = list(iter_sql_statements(io.BytesIO(data), chunk_size=chunk_size))
+    for i, (statement, offset) in enumerate(statements):
+        stream = io.BytesIO(data)
+        stream.seek(offset)
+        assert list(iter_sql_statements(stream, offset, chunk_size=chunk_size)) == statements[i + 1:]
+
+def test_unterminated_quote():
+    with pytest.raises(ValueError):
+        list(iter_sql_statements(io.BytesIO(b"select 'abc" + b'x' * 64), chunk_size=8, max_statement=32))
+
+def test_scan_tables():
+    sql = b'CREATE TABLE `iprange` (`city_id` int, FOREIGN KEY (`city_id`) REFERENCES `city` (`id`));\nINSERT INTO `iprange` VALUES (1);'
+    assert scan_sql_tables(io.BytesIO(sql)) == ({'iprange'}, {'city'})
+
+def test_scan_tables_truncated():
+    # 读取的内容截断在任意位置（包括多字节字符和表名中间）都不能报错，也不能返回截断的表名
+    sql = "INSERT INTO `city` VALUES (1,'北京'),(2,'上海');\nINSERT INTO `city_extra` VALUES (3);".encode('utf-8')
+    for limit in range(1, len(sql)):
+        tables, references = scan_sql_tables(io.BytesIO(sql), limit)
+        assert tables <= {'city', 'city_extra'}
+        assert references == set()
+    assert scan_sql_tables(io.BytesIO(sql), len(sql))[0] == {'city', 'city_extra'}
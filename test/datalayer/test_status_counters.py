@@ -0,0 +1,32 @@
+import pytest
+from status_counters import StatusCounters
+
+@pytest.fixture
+def counters(redis_pool):
+    counters = StatusCounters(redis_pool, 'status')
+    counters.reset(5, {field: 0 for field in StatusCounters.FIELDS if field != 'cityid-ping'}, {'1': 2})
+    return counters
+
+def test_load(counters):
+    assert counters.load(4) is None
+    values = counters.load(5)
+    assert values['cityid-ping'] == 1
+    assert set(values) == set(StatusCounters.FIELDS)
+
+def test_apply(counters):
+    assert counters.apply(5, {'ping-new': 3, 'ping-loss': 0}, {1: 1, 2: 2})
+    values = counters.load(5)
+    assert values['ping-new'] == 3
+    assert values['cityid-ping'] == 2
+    # 城市的 ip 全部清理后 cityid-ping 减少
+    assert counters.apply(5, {'ping-new': -1}, {1: -3, 2: -1})
+    values = counters.load(5)
+    assert values['ping-new'] == 2
+    assert values['cityid-ping'] == 1
+    assert counters.redis.hgetall(counters.city_key) == {'2': '1'}
+
+def test_apply_other_epoch(counters):
+    # 周期变化后增量不再写入，等待 reconcile
+    assert not counters.apply(6, {'ping-new': 1}, {3: 1})
+    assert counters.load(5)['ping-new'] == 0
+    assert counters.apply(6, {}, {})